@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+
+Benchmark the accumulation of cycle data in c3d_MATLAB_export.
+
+Synthetic per-trial results (as returned by gaitutils collect_trial_data) are
+accumulated for an increasing number of trials, with the previous approach
+(growing the result matrices with np.hstack for every trial) and with the
+ChunkedAccumulator used by c3d_MATLAB_export.main(). The time per trial stays
+constant for the accumulator (linear scaling), whereas for np.hstack it grows
+with the number of trials (quadratic scaling).
+
+No c3d files are needed.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import io
+import time
+import contextlib
+from collections import defaultdict, namedtuple
+import numpy as np
+
+import c3d_MATLAB_export as export
+
+# numbers of trials to test
+NTRIALS = [50, 100, 200, 400, 800]
+# cycles per trial and variable
+NCYCLES = 6
+FRAMERATE = 100.0
+
+_Trial = namedtuple('_Trial', ['framerate', 'eclipse_tag'])
+_Cycle = namedtuple('_Cycle', ['start', 'end', 'trial'])
+
+
+def _synth_trial(rng):
+    """Synthetic (data, cycles) for a trial, like collect_trial_data returns"""
+    tr = _Trial(FRAMERATE, sorted(export.VALID_ECLIPSE_TAGS)[0])
+    starts = rng.integers(0, 500, NCYCLES)
+    cycs = [_Cycle(start, start + rng.integers(90, 130), tr) for start in starts]
+    data = {
+        'model': {
+            var: rng.standard_normal((NCYCLES, 101)) for var in export.MODEL_VAR_NAMES
+        },
+        'emg': {
+            var: rng.standard_normal((NCYCLES, 1000)) for var in export.EMG_VAR_NAMES
+        },
+    }
+    cycles = {
+        'model': {var: cycs for var in export.MODEL_VAR_NAMES},
+        'emg': {var: cycs for var in export.EMG_VAR_NAMES},
+    }
+    return data, cycles
+
+
+def _export_hstack(trials):
+    """The previous implementation of the accumulation"""
+    model_res = defaultdict(lambda: np.zeros((101, 0)))
+    emg_res = defaultdict(lambda: np.zeros((1000, 0)))
+    model_delta_t = defaultdict(lambda: [])
+    for data, cycles in trials:
+        for var_name in export.MODEL_VAR_NAMES:
+            var_data = data['model'][var_name]
+            model_res[var_name] = np.hstack((model_res[var_name], var_data.T))
+            for cyc in cycles['model'][var_name]:
+                delta_t = ((cyc.end - cyc.start) / cyc.trial.framerate) / var_data.shape[1]
+                model_delta_t[var_name].append(delta_t)
+        for var_name in export.EMG_VAR_NAMES:
+            emg_res[var_name] = np.hstack((emg_res[var_name], data['emg'][var_name].T))
+    for var_name in export.MODEL_VAR_NAMES_TO_DIFF:
+        delta_t = np.array(model_delta_t[var_name])
+        model_res[var_name + '_dt'] = np.diff(model_res[var_name], axis=0) / delta_t
+    return model_res, emg_res
+
+
+def _export_chunked(trials):
+    """The current implementation, as in c3d_MATLAB_export.main()"""
+    model_res = defaultdict(lambda: export.ChunkedAccumulator(101))
+    emg_res = defaultdict(lambda: export.ChunkedAccumulator(1000))
+    model_delta_t = defaultdict(export.ChunkedAccumulator)
+    for k, (data, cycles) in enumerate(trials):
+        selected = export._select_trial_data(str(k), data, cycles)
+        export._add_trial_data(model_res, emg_res, model_delta_t, selected)
+    return export._finalize(model_res, emg_res, model_delta_t)
+
+
+def _time_it(fun, *args):
+    """Return (time in seconds, result), with the progress output suppressed"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        res = fun(*args)
+        return time.perf_counter() - t0, res
+
+
+def run_benchmark(seed=0):
+    """Run the benchmark and return a list of result dicts"""
+    rng = np.random.default_rng(seed)
+    all_trials = [_synth_trial(rng) for _ in range(max(NTRIALS))]
+    results = list()
+    for ntrials in NTRIALS:
+        trials = all_trials[:ntrials]
+        t_old, (model_old, emg_old) = _time_it(_export_hstack, trials)
+        t_new, (model_new, emg_new) = _time_it(_export_chunked, trials)
+        max_diff = max(
+            np.max(np.abs(res_new[var] - res_old[var]))
+            for res_old, res_new in [(model_old, model_new), (emg_old, emg_new)]
+            for var in res_new
+        )
+        results.append(
+            {
+                'ntrials': ntrials,
+                'hstack_ms_per_trial': 1e3 * t_old / ntrials,
+                'chunked_ms_per_trial': 1e3 * t_new / ntrials,
+                'max_abs_diff': max_diff,
+            }
+        )
+    return results
+
+
+def _print_results(results):
+    hdr = '%8s %18s %19s %13s' % (
+        'trials',
+        'hstack ms/trial',
+        'chunked ms/trial',
+        'max abs diff',
+    )
+    print(hdr)
+    print('-' * len(hdr))
+    for res in results:
+        print(
+            '%8d %18.2f %19.2f %13.2e'
+            % (
+                res['ntrials'],
+                res['hstack_ms_per_trial'],
+                res['chunked_ms_per_trial'],
+                res['max_abs_diff'],
+            )
+        )
+
+
+if __name__ == '__main__':
+    print(
+        '%d model and %d EMG variables, %d cycles per trial'
+        % (len(export.MODEL_VAR_NAMES), len(export.EMG_VAR_NAMES), NCYCLES)
+    )
+    _print_results(run_benchmark())
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+
+Benchmark suite for the EMG envelope pipeline (rectify_emg_c3d.py).
+
+Synthetic C3D trials of realistic sizes are written into a temporary directory
+and run through each stage of the pipeline separately:
+
+read : decode the analog data from the c3d file (ezc3d)
+hpf : high pass filter
+lpf : rectify and low pass filter (linear envelope)
+rms : sliding RMS of the high passed data
+resample : downsample the envelope to the frame rate
+normalize : normalize the envelope to the gait cycles
+xlsx : write the individual cycles into a workbook
+
+For each stage, the latency (best of several runs) and the peak memory
+allocated during the stage (measured in a separate run) are recorded. The
+memory is measured by tracemalloc, except for the read stage: tracemalloc does
+not see the native allocations of ezc3d, so the peak increase of the RSS of a
+fresh process (sampled by psutil) is used instead. The results can be saved
+as a JSON baseline and compared against a previous baseline, e.g.
+
+python bench_pipeline.py --save baseline.json
+python bench_pipeline.py --compare baseline.json
+
+The comparison reports stages that are slower or use more memory than the
+baseline by more than the given tolerance, and exits with a nonzero status if
+there are any. Use --quick to skip the largest trials.
+
+No Nexus or real c3d files are needed.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import os.path as op
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import psutil
+import ezc3d
+
+import emg_filters
+import cycle_norm
+from emg_c3d import HPF, LPF, BUTTER_ORDER, RMS_HPF, RMS_WIN, RESAMPLE_METHOD
+from emg_xlsx import StreamingWorkbook
+
+# synthetic trials: (number of channels, analog rate, duration in s)
+TRIALS = [
+    (8, 1000, 10),
+    (16, 1000, 60),
+    (16, 2000, 120),
+    (32, 2000, 300),
+    (32, 2000, 1200),
+]
+# trials longer than this are skipped in quick mode (s)
+QUICK_MAX_DURATION = 120
+FRAMERATE = 100
+# mean gait cycle duration (s)
+CYCLE_DURATION = 1.1
+STAGES = ['read', 'hpf', 'lpf', 'rms', 'resample', 'normalize', 'xlsx']
+# timing repeats
+NREPEATS = 3
+# default relative tolerance for regressions
+TOLERANCE = 0.25
+# timing differences below this are not considered regressions (s)
+MIN_TIME_DIFF = 0.01
+# RSS sampling interval for the native memory measurement (s)
+RSS_INTERVAL = 0.001
+
+# a minimal stand-in for gaitutils Gaitcycle; the normalizer only needs these
+SynthCycle = namedtuple('SynthCycle', ['start', 'end', 'context'])
+
+
+def _synth_emg(nchannels, nsamples, analograte, rng):
+    """EMG-like data: noise with a slowly varying amplitude and some offset"""
+    t = np.arange(nsamples) / analograte
+    freqs = rng.uniform(0.5, 2, (nchannels, 1))
+    ampl = 1e-4 * (1 + 0.8 * np.sin(2 * np.pi * freqs * t))
+    return ampl * rng.standard_normal((nchannels, nsamples)) + 1e-3
+
+
+def _synth_cycles(nframes, rng):
+    """Alternating L/R gait cycles of slightly varying length"""
+    cycles = list()
+    start = {'R': 0, 'L': int(CYCLE_DURATION * FRAMERATE / 2)}
+    ctxt = 'R'
+    while True:
+        dur = int(CYCLE_DURATION * FRAMERATE * rng.uniform(0.9, 1.1))
+        end = start[ctxt] + dur
+        if end > nframes:
+            break
+        cycles.append(SynthCycle(start[ctxt], end, ctxt))
+        start[ctxt] = end
+        ctxt = 'L' if ctxt == 'R' else 'R'
+    return cycles
+
+
+def _write_c3d(fname, data, analograte, nframes):
+    """Write EMG data into a c3d file as analog channels"""
+    c3d = ezc3d.c3d()
+    c3d['parameters']['POINT']['RATE']['value'] = [FRAMERATE]
+    c3d['parameters']['POINT']['LABELS']['value'] = ['Marker']
+    c3d['data']['points'] = np.zeros((4, 1, nframes))
+    c3d['parameters']['ANALOG']['RATE']['value'] = [analograte]
+    c3d['parameters']['ANALOG']['LABELS']['value'] = [
+        'Voltage.EMG%d' % k for k in range(1, data.shape[0] + 1)
+    ]
+    c3d['data']['analogs'] = data[np.newaxis, :, :]
+    c3d.write(fname)
+
+
+def _read_c3d(fname):
+    """Decode analog data from a c3d file into a (channels x samples) array"""
+    c3d = ezc3d.c3d(fname)
+    return np.ascontiguousarray(c3d['data']['analogs'][0])
+
+
+def _write_xlsx(fname, norm_data):
+    """Write individual cycles like rectify_emg_c3d does"""
+    wb = StreamingWorkbook()
+    wb.create_sheet('Trial')
+    wb.append([''] + ['frame %d' % k for k in range(cycle_norm.NPOINTS)])
+    for chname in sorted(norm_data):
+        for curve_ind, curve in enumerate(norm_data[chname], 1):
+            label = '%s, cycle %d' % (chname, curve_ind)
+            wb.append([label] + curve.tolist(), bold_cols=[0])
+    wb.save(fname)
+
+
+def _sample_peak_rss(fun, args, kwargs):
+    """Call fun and return the peak increase of the process RSS in bytes.
+
+    The RSS is sampled on a background thread every RSS_INTERVAL seconds.
+    """
+    proc = psutil.Process()
+    rss0 = peak = proc.memory_info().rss
+    done = threading.Event()
+
+    def _sample():
+        nonlocal peak
+        while not done.wait(RSS_INTERVAL):
+            peak = max(peak, proc.memory_info().rss)
+
+    sampler = threading.Thread(target=_sample)
+    sampler.start()
+    try:
+        res = fun(*args, **kwargs)
+    finally:
+        done.set()
+        sampler.join()
+    peak = max(peak, proc.memory_info().rss)
+    del res
+    return peak - rss0
+
+
+def _peak_rss(fun, *args, **kwargs):
+    """Return the peak increase of the process RSS for a call, in bytes.
+
+    The call is made in a freshly spawned process, since in this process, the
+    memory freed by the earlier runs would be reused without increasing the
+    RSS.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(1, mp_context=ctx) as executor:
+        return executor.submit(_sample_peak_rss, fun, args, kwargs).result()
+
+
+def _measure(fun, *args, native=False, **kwargs):
+    """Return (best time in seconds, peak memory in bytes, result).
+
+    Each stage is timed NREPEATS times without tracing and then run once more
+    under tracemalloc, since tracing slows down the allocations. If native,
+    the memory is measured by _peak_rss() instead, for stages that allocate
+    outside of Python (e.g. ezc3d).
+    """
+    times = list()
+    for _ in range(NREPEATS):
+        t0 = time.perf_counter()
+        res = fun(*args, **kwargs)
+        times.append(time.perf_counter() - t0)
+    if native:
+        return min(times), _peak_rss(fun, *args, **kwargs), res
+    del res
+    tracemalloc.start()
+    res = fun(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak, res
+
+
+def _bench_trial(nchannels, analograte, duration, tmpdir, rng):
+    """Run all stages for a synthetic trial; return dict of results per stage"""
+    nframes = duration * FRAMERATE
+    nsamples = nframes * (analograte // FRAMERATE)
+    fname = op.join(tmpdir, 'trial.c3d')
+    data = _synth_emg(nchannels, nsamples, analograte, rng)
+    _write_c3d(fname, data, analograte, nframes)
+    del data
+    cycles = _synth_cycles(nframes, rng)
+    chnames = ['EMG%d' % k for k in range(1, nchannels + 1)]
+    ctxts = ['R' if k <= nchannels // 2 else 'L' for k in range(1, nchannels + 1)]
+
+    def _hpf(data):
+        return emg_filters.highpass(data, analograte, HPF, BUTTER_ORDER)
+
+    def _lpf(data):
+        return emg_filters.lowpass(
+            emg_filters.rectify(data.copy()), analograte, LPF, BUTTER_ORDER
+        )
+
+    def _normalize(data):
+        normalizer = cycle_norm.CycleNormalizer(cycles, nframes)
+        tensor = normalizer.normalize(data)
+        mask = cycle_norm.context_mask([cyc.context for cyc in cycles], ctxts)
+        return cycle_norm.split_channels(tensor, mask, chnames)
+
+    stages = dict()
+    t, peak, data = _measure(_read_c3d, fname, native=True)
+    stages['read'] = (t, peak)
+    t, peak, data_hp = _measure(_hpf, data)
+    stages['hpf'] = (t, peak)
+    t, peak, lenv = _measure(_lpf, data_hp)
+    stages['lpf'] = (t, peak)
+    stages['rms'] = _measure(emg_filters.rms, data_hp, RMS_WIN)[:2]
+    del data, data_hp
+    t, peak, lenv_ds = _measure(
+        emg_filters.resample, lenv, nframes, method=RESAMPLE_METHOD
+    )
+    stages['resample'] = (t, peak)
+    del lenv
+    t, peak, norm_data = _measure(_normalize, lenv_ds)
+    stages['normalize'] = (t, peak)
+    xlsxfile = op.join(tmpdir, 'trial.xlsx')
+    stages['xlsx'] = _measure(_write_xlsx, xlsxfile, norm_data)[:2]
+    return {
+        'nchannels': nchannels,
+        'analograte': analograte,
+        'duration': duration,
+        'ncycles': len(cycles),
+        'stages': {
+            stage: {'time_s': t, 'peak_bytes': peak}
+            for stage, (t, peak) in stages.items()
+        },
+    }
+
+
+def run_benchmark(quick=False, seed=0):
+    """Run the benchmark and return a dict of results"""
+    rng = np.random.default_rng(seed)
+    trials = list()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for nchannels, analograte, duration in TRIALS:
+            if quick and duration > QUICK_MAX_DURATION:
+                continue
+            trials.append(_bench_trial(nchannels, analograte, duration, tmpdir, rng))
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'params': {
+            'HPF': HPF,
+            'LPF': LPF,
+            'BUTTER_ORDER': BUTTER_ORDER,
+            'RMS_HPF': RMS_HPF,
+            'RMS_WIN': RMS_WIN,
+            'RESAMPLE_METHOD': RESAMPLE_METHOD,
+            'NREPEATS': NREPEATS,
+        },
+        'trials': trials,
+    }
+
+
+def _trial_key(trial):
+    return trial['nchannels'], trial['analograte'], trial['duration']
+
+
+def compare_results(results, baseline, tolerance=TOLERANCE):
+    """Compare results against a baseline.
+
+    Returns a list of (trial key, stage, quantity, baseline value, new value)
+    for all stages that are worse than the baseline by more than the relative
+    tolerance (and by more than MIN_TIME_DIFF for the timings). Trials that
+    are missing from either one are ignored.
+    """
+    base_trials = {_trial_key(trial): trial for trial in baseline['trials']}
+    regressions = list()
+    for trial in results['trials']:
+        key = _trial_key(trial)
+        if key not in base_trials:
+            continue
+        base_stages = base_trials[key]['stages']
+        for stage, vals in trial['stages'].items():
+            if stage not in base_stages:
+                continue
+            for quantity in ['time_s', 'peak_bytes']:
+                old, new = base_stages[stage][quantity], vals[quantity]
+                if quantity == 'time_s' and new - old < MIN_TIME_DIFF:
+                    continue
+                if new > old * (1 + tolerance):
+                    regressions.append((key, stage, quantity, old, new))
+    return regressions
+
+
+def _print_results(results):
+    hdr = '%24s' % 'trial' + ''.join('%15s' % stage for stage in STAGES)
+    print('time (ms) / peak memory (MB)')
+    print(hdr)
+    print('-' * len(hdr))
+    for trial in results['trials']:
+        desc = '%dch %dHz %ds %dcyc' % (
+            trial['nchannels'],
+            trial['analograte'],
+            trial['duration'],
+            trial['ncycles'],
+        )
+        vals = [trial['stages'][stage] for stage in STAGES]
+        print(
+            '%24s' % desc
+            + ''.join(
+                '%15s' % ('%.0f / %.0f' % (1e3 * v['time_s'], v['peak_bytes'] / 1e6))
+                for v in vals
+            )
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '--quick', action='store_true', help='skip the largest trials'
+    )
+    parser.add_argument('--save', metavar='FILE', help='save results as JSON')
+    parser.add_argument(
+        '--compare', metavar='FILE', help='compare against a JSON baseline'
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=TOLERANCE,
+        help='relative tolerance for regressions',
+    )
+    args = parser.parse_args()
+
+    results = run_benchmark(quick=args.quick)
+    _print_results(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.tolerance)
+        for key, stage, quantity, old, new in regressions:
+            print(
+                'REGRESSION: %dch %dHz %ds, %s %s: %.4g -> %.4g'
+                % (key + (stage, quantity, old, new))
+            )
+        if regressions:
+            sys.exit(1)
+        print('no regressions against %s' % args.compare)
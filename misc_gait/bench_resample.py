@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+
+Benchmark the downsampling methods in emg_filters against the FFT path.
+
+Synthetic envelope-like signals are generated as sums of random low-frequency
+sinusoids plus a linear trend, so that the true value at each frame position is
+known exactly, and the signal is not periodic over the trial (which is the
+best case for FFT resampling). For each case, the latency (best of several
+runs) and the error w.r.t. the true frame values are reported, both over the
+whole trial and excluding the edges.
+
+No Nexus or c3d files are needed.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import time
+import numpy as np
+
+import emg_filters
+
+# number of EMG channels
+NCHANNELS = 16
+# trial durations (s)
+DURATIONS = [10, 60, 600]
+# (analog rate, frame rate) pairs; the last one has a non-integer ratio
+RATES = [(1000, 100), (2000, 100), (1000, 300)]
+# number of frames excluded at each edge for the interior error
+EDGE_FRAMES = 10
+# timing repeats
+NREPEATS = 3
+
+
+def _synthetic_envelope(nsamples, analograte, nchannels, rng):
+    """Return a function f(t) that evaluates a synthetic envelope at times t.
+
+    Each channel is a sum of sinusoids below 8 Hz plus a linear trend.
+    """
+    nfreqs = 5
+    freqs = rng.uniform(0.5, 8, size=(nchannels, nfreqs, 1))
+    phases = rng.uniform(0, 2 * np.pi, size=(nchannels, nfreqs, 1))
+    amps = rng.uniform(0.1, 1, size=(nchannels, nfreqs, 1))
+    trend = rng.uniform(-1, 1, size=(nchannels, 1))
+    dur = nsamples / analograte
+
+    def _fun(t):
+        waves = amps * np.sin(2 * np.pi * freqs * t + phases)
+        return waves.sum(axis=1) + trend * t / dur + 3
+
+    return _fun
+
+
+def _time_it(fun, *args, **kwargs):
+    """Return (best time in seconds, result) over NREPEATS runs"""
+    times = list()
+    for _ in range(NREPEATS):
+        t0 = time.perf_counter()
+        res = fun(*args, **kwargs)
+        times.append(time.perf_counter() - t0)
+    return min(times), res
+
+
+def run_benchmark(odd_length=False, seed=0):
+    """Run the benchmark and return a list of result dicts.
+
+    If odd_length is True, one extra sample is appended to each trial, which
+    makes the analog/frame ratio non-integer and the FFT length odd.
+    """
+    rng = np.random.default_rng(seed)
+    results = list()
+    for dur in DURATIONS:
+        for analograte, framerate in RATES:
+            nframes = dur * framerate
+            nsamples = dur * analograte + (1 if odd_length else 0)
+            fun = _synthetic_envelope(nsamples, analograte, NCHANNELS, rng)
+            data = fun(np.arange(nsamples) / analograte)
+            # true values at the frame positions
+            t_frames = np.arange(nframes) * nsamples / nframes / analograte
+            truth = fun(t_frames)
+            interior = slice(EDGE_FRAMES, -EDGE_FRAMES)
+            fft_res = None
+            for method in emg_filters.RESAMPLE_METHODS:
+                latency, res = _time_it(
+                    emg_filters.resample, data, nframes, method=method
+                )
+                if method == 'fft':
+                    fft_res = res
+                err = np.abs(res - truth)
+                results.append(
+                    {
+                        'duration': dur,
+                        'analograte': analograte,
+                        'framerate': framerate,
+                        'nsamples': nsamples,
+                        'method': method,
+                        'latency_ms': 1e3 * latency,
+                        'max_err': err.max(),
+                        'max_err_interior': err[:, interior].max(),
+                        'rms_diff_fft': np.sqrt(np.mean((res - fft_res) ** 2)),
+                    }
+                )
+    return results
+
+
+def _print_results(results):
+    hdr = '%6s %6s %5s %9s %10s %11s %10s %12s %12s' % (
+        'dur/s',
+        'arate',
+        'frate',
+        'nsamples',
+        'method',
+        'latency/ms',
+        'max err',
+        'interior err',
+        'RMS vs FFT',
+    )
+    print(hdr)
+    print('-' * len(hdr))
+    for res in results:
+        print(
+            '%6d %6d %5d %9d %10s %11.2f %10.2e %12.2e %12.2e'
+            % (
+                res['duration'],
+                res['analograte'],
+                res['framerate'],
+                res['nsamples'],
+                res['method'],
+                res['latency_ms'],
+                res['max_err'],
+                res['max_err_interior'],
+                res['rms_diff_fft'],
+            )
+        )
+
+
+if __name__ == '__main__':
+    print('*** Integer sample counts')
+    _print_results(run_benchmark())
+    print()
+    print('*** Odd sample counts')
+    _print_results(run_benchmark(odd_length=True))
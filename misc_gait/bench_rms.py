@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+
+Benchmark the sliding RMS kernel in emg_filters against the current path,
+i.e. calling gaitutils.numutils.rms() separately for each channel.
+
+For each window length and dtype, the latency (best of several runs) of both
+implementations and the max. relative difference of the results (w.r.t. the
+float64 result of the current path) are reported. The causal mode is timed
+too, for reference.
+
+No Nexus or c3d files are needed.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import time
+import numpy as np
+
+import gaitutils
+
+import emg_filters
+
+# synthetic data dimensions
+NCHANNELS = 16
+ANALOGRATE = 2000
+DURATION = 120  # s
+# RMS window lengths to test (samples)
+WINDOWS = [31, 101, 301, 1001, 3001]
+DTYPES = [np.float64, np.float32]
+# timing repeats
+NREPEATS = 3
+
+
+def _time_it(fun, *args, **kwargs):
+    """Return (best time in seconds, result) over NREPEATS runs"""
+    times = list()
+    for _ in range(NREPEATS):
+        t0 = time.perf_counter()
+        res = fun(*args, **kwargs)
+        times.append(time.perf_counter() - t0)
+    return min(times), res
+
+
+def _rms_per_channel(data, win):
+    """The current implementation: gaitutils rms, one channel at a time"""
+    return np.array([gaitutils.numutils.rms(chdata, win) for chdata in data])
+
+
+def run_benchmark(seed=0):
+    """Run the benchmark and return a list of result dicts"""
+    rng = np.random.default_rng(seed)
+    nsamples = DURATION * ANALOGRATE
+    # EMG-like data: noise with a slowly varying amplitude
+    t = np.arange(nsamples) / ANALOGRATE
+    ampl = 1 + 0.8 * np.sin(2 * np.pi * rng.uniform(0.5, 2, (NCHANNELS, 1)) * t)
+    data64 = ampl * rng.standard_normal((NCHANNELS, nsamples))
+    results = list()
+    for win in WINDOWS:
+        ref = _rms_per_channel(data64, win)
+        for dtype in DTYPES:
+            data = data64.astype(dtype)
+            t_old, _ = _time_it(_rms_per_channel, data, win)
+            t_new, res = _time_it(emg_filters.rms, data, win)
+            t_causal, _ = _time_it(emg_filters.rms, data, win, mode='causal')
+            results.append(
+                {
+                    'win': win,
+                    'dtype': np.dtype(dtype).name,
+                    'current_ms': 1e3 * t_old,
+                    'kernel_ms': 1e3 * t_new,
+                    'causal_ms': 1e3 * t_causal,
+                    'max_rel_diff': np.max(np.abs(res - ref) / ref),
+                }
+            )
+    return results
+
+
+def _print_results(results):
+    hdr = '%6s %8s %11s %10s %10s %13s' % (
+        'win',
+        'dtype',
+        'current/ms',
+        'kernel/ms',
+        'causal/ms',
+        'max rel diff',
+    )
+    print(hdr)
+    print('-' * len(hdr))
+    for res in results:
+        print(
+            '%6d %8s %11.1f %10.1f %10.1f %13.2e'
+            % (
+                res['win'],
+                res['dtype'],
+                res['current_ms'],
+                res['kernel_ms'],
+                res['causal_ms'],
+                res['max_rel_diff'],
+            )
+        )
+
+
+if __name__ == '__main__':
+    print('%d channels, %d s at %d Hz' % (NCHANNELS, DURATION, ANALOGRATE))
+    _print_results(run_benchmark())
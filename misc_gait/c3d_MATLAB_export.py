@@ -9,16 +9,24 @@ import os
 import numpy as np
 import scipy.io
 
+import bisect
 import logging
-import numpy as np
-import scipy
 import itertools
+import scipy.signal
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
-from gaitutils.stats import collect_trial_data
+from gaitutils import eclipse, models
+from gaitutils.trial import Trial
 from gaitutils.envutils import GaitDataError
 from gaitutils.config import cfg
 
+from mat73_writer import Mat73Writer
+from export_manifest import ExportManifest, file_signatures
+from trial_files import find_c3ds, find_enf
+from trial_catalog import TrialCatalog
+
 
 DATA_FLDR = 'Z:/Misc/0_Mika/CP-projekti/HP/H0188_AJ/2022_06_20_seur_AJ/'
 MODEL_VAR_NAMES = {'RAnkleAnglesX', 'LAnkleAnglesX',
@@ -72,61 +80,421 @@ VALID_ECLIPSE_TAGS = {'E2', 'E3', 'E4', 'T2', 'T3', 'T4'}
 # VALID_ECLIPSE_TAGS = {'T1', 'E1'}
 MODEL_OUT_FNAME = 'C:/Users/vicon123/model_exported.mat'
 EMG_OUT_FNAME = 'C:/Users/vicon123/emg_exported.mat'
+# output format: '7.3' to append the cycles of each trial to HDF5-based MAT
+# v7.3 files as the trials are read (any number of trials, readable with load()
+# in MATLAB >= 7.3), or '5' to write the files with scipy.io.savemat once all
+# trials have been read (the data must fit in memory)
+MAT_FORMAT = '7.3'
+# root directory of a cohort (e.g. patient folders with session subfolders)
+# for an incremental export of all trials under it (see export_cohort()); None
+# to export the trials in DATA_FLDR only
+COHORT_ROOT = None
+# trial catalog (see trial_catalog.py) used to preselect the trials under
+# COHORT_ROOT by Eclipse tag, without opening the other trials; None to check
+# all trials
+CATALOG_FNAME = None
+# manifest of the trials exported from COHORT_ROOT
+MANIFEST_FNAME = 'C:/Users/vicon123/export_manifest.json'
+# length of the resampled EMG cycles
+EMG_CYCLE_LEN = 1000
+# number of worker processes for reading the files; None for one per CPU core,
+# 1 to read the files serially in the main process
+MAX_WORKERS = None
 
 
 logger = logging.getLogger(__name__)
 
 
-def main():
-    model_res = defaultdict(lambda: np.zeros((101,0)))
-    emg_res = defaultdict(lambda: np.zeros((1000,0)))
-    model_delta_t = defaultdict(lambda: [])
-
-    fnames = os.listdir(DATA_FLDR)
-    for fname in fnames:
-        if fname[-4:] == '.c3d':
-            print('Reading file %s ...' % fname)
-            full_name = DATA_FLDR + '/' + fname
+class ChunkedAccumulator:
+    """Collect the cycle data of a variable from many trials.
+
+    append() only keeps a reference to the data of each trial (amortized O(1)),
+    and the data is concatenated once in result(). Growing the result matrix
+    with np.hstack instead copies all of the accumulated data for every trial,
+    which makes the total cost quadratic in the number of trials.
+
+    Parameters
+    ----------
+    npoints : int | None
+        Number of points per cycle, or None for scalar per-cycle values.
+    """
+
+    def __init__(self, npoints=None):
+        self.npoints = npoints
+        self.ncycles = 0
+        self._chunks = list()
+
+    def append(self, data):
+        """Add a (ncycles x npoints) array, or an array of per-cycle values"""
+        data = np.asarray(data)
+        self._chunks.append(data)
+        self.ncycles += len(data)
+
+    def result(self):
+        """Return the data as a (npoints x ncycles) array.
+
+        For scalar per-cycle values, a 1-D array is returned.
+        """
+        if not self._chunks:
+            return np.zeros(0) if self.npoints is None else np.zeros((self.npoints, 0))
+        return np.concatenate(self._chunks).T
+
+
+def _get_eclipse_tag(c3dfile):
+    """Return the Eclipse tag of a trial, or None.
+
+    Same as gaitutils Trial.eclipse_tag, but only the .enf file is read, so
+    the tag can be checked without reading the c3d file.
+    """
+    if (enfpath := find_enf(c3dfile)) is None:
+        return None
+    eclipse_data = defaultdict(lambda: '', eclipse.get_eclipse_keys(enfpath))
+    for tag in cfg.eclipse.tags:
+        if any(tag in eclipse_data[fld] for fld in cfg.eclipse.tag_keys):
+            return tag
+    return None
+
+
+def collect_selected_data(c3dfile, fp_cycles_only=True):
+    """Collect the exported variables of a trial.
+
+    This works like gaitutils collect_trial_data() for a single trial (with
+    analog_envelope=False), but only the model variables in MODEL_VAR_NAMES
+    and the EMG channels in EMG_VAR_NAMES are read and normalized, instead of
+    all variables of all models and all EMG channels. The Eclipse tag is
+    checked first, so trials with a tag not in VALID_ECLIPSE_TAGS are rejected
+    without reading the c3d file.
+
+    Returns a tuple of (data, cycles) in the format of collect_trial_data(),
+    or (None, None) if the trial has a wrong Eclipse tag.
+    """
+    if _get_eclipse_tag(c3dfile) not in VALID_ECLIPSE_TAGS:
+        return None, None
+    trial = Trial(c3dfile)
+    # models are read by gaitutils one model at a time, so only the models
+    # of the requested variables get read
+    var_models = {var_name: models.model_from_var(var_name) for var_name in MODEL_VAR_NAMES}
+    rows = {'model': defaultdict(list), 'emg': defaultdict(list)}
+    cycles = {'model': defaultdict(list), 'emg': defaultdict(list)}
+    for cycle in trial.cycles:
+        for var_name in sorted(MODEL_VAR_NAMES):
+            model = var_models[var_name]
+            # pick data only if var context matches cycle context
+            if model is None or var_name[0] != cycle.context:
+                continue
+            # don't collect kinetics if cycle is not on forceplate
+            if (model.is_kinetic_var(var_name) or fp_cycles_only) and not cycle.on_forceplate:
+                continue
+            _, var_data = trial.get_model_data(var_name, cycle=cycle)
+            if not np.all(np.isnan(var_data)):
+                rows['model'][var_name].append(var_data)
+                cycles['model'][var_name].append(cycle)
+        for ch in sorted(EMG_VAR_NAMES):
+            if not trial.emg.context_ok(ch, cycle.context):
+                continue
             try:
-                data, cycles = collect_trial_data(full_name, analog_envelope=False, force_collect_all_cycles=False, fp_cycles_only=True)
-
-                for var_name in MODEL_VAR_NAMES:
-                    try:
-                        if cycles['model'][var_name][0].trial.eclipse_tag in VALID_ECLIPSE_TAGS:
-                            # Append normalized trial data
-                            model_res[var_name] = np.hstack((model_res[var_name], data['model'][var_name].T))
-
-                            # Compute and append the new sample duration after normalization
-                            for cyc in cycles['model'][var_name]:
-                                delta_t = ((cyc.end - cyc.start) / cyc.trial.framerate) / data['model'][var_name].shape[1]
-                                model_delta_t[var_name].append(delta_t)
-
-                            print('\t ... added %i cycles for variable \'%s\' (eclipse label \'%s\')' % (data['model'][var_name].shape[0], var_name, cycles['model'][var_name][0].trial.eclipse_tag))
-                        else:
-                            print('\t ... no data imported for variable \'%s\' from file %s (wrong eclipse label)' % (var_name, fname))
-                    except:
-                        print('\t ... no data imported for variable \'%s\' from file %s' % (var_name, fname))
-
-                for var_name in EMG_VAR_NAMES:
-                    try:
-                        if cycles['emg'][var_name][0].trial.eclipse_tag in VALID_ECLIPSE_TAGS:
-                            emg_res[var_name] = np.hstack((emg_res[var_name], data['emg'][var_name].T))
-                            print('\t ... added %i cycles for variable \'%s\' (eclipse label \'%s\')' % (data['emg'][var_name].shape[0], var_name, cycles['emg'][var_name][0].trial.eclipse_tag))
-                        else:
-                            print('\t ... no data imported for variable \'%s\' from file %s (wrong eclipse label)' % (var_name, fname))
-                    except:
-                        print('\t ... no data imported for variable \'%s\' from file %s' % (var_name, fname))
-            except:
-                print('\t ... failed!')
-
-
-    # Compute the derivatives
+                _, ch_data = trial.get_emg_data(ch, cycle=cycle, envelope=False)
+            except (KeyError, GaitDataError):
+                logger.warning('no channel %s for %s' % (ch, trial))
+                continue
+            rows['emg'][ch].append(scipy.signal.resample(ch_data, EMG_CYCLE_LEN))
+            cycles['emg'][ch].append(cycle)
+    data = {var_type: {var_name: np.array(var_rows) for var_name, var_rows in var_type_rows.items()} for var_type, var_type_rows in rows.items()}
+    return data, cycles
+
+
+def _cycle_delta_t(cycles, npoints):
+    """Duration of a sample after normalization, for each cycle"""
+    durations = np.array([(cyc.end - cyc.start) / cyc.trial.framerate for cyc in cycles])
+    return durations / npoints
+
+
+def _empty_selection():
+    return {'model': dict(), 'model_delta_t': dict(), 'emg': dict(), 'messages': list()}
+
+
+def _select_trial_data(fname, data, cycles):
+    """Select the exported variables of a trial.
+
+    Only the variables in MODEL_VAR_NAMES and EMG_VAR_NAMES from cycles with a
+    valid Eclipse tag are kept. The gait cycles are reduced to the sample
+    durations needed for the derivatives, so that the result is made of plain
+    arrays only (the cycles reference the whole trial, which would be expensive
+    to send back from a worker process).
+
+    Returns a dict with the keys model, model_delta_t and emg (dicts of arrays
+    keyed by variable name) and messages (list of progress messages).
+    """
+    selected = _empty_selection()
+    for var_type, var_names in [('model', MODEL_VAR_NAMES), ('emg', EMG_VAR_NAMES)]:
+        for var_name in sorted(var_names):
+            var_cycles = cycles[var_type].get(var_name)
+            if not var_cycles:
+                selected['messages'].append('\t ... no data imported for variable \'%s\' from file %s (no cycles)' % (var_name, fname))
+                continue
+            eclipse_tag = var_cycles[0].trial.eclipse_tag
+            if eclipse_tag not in VALID_ECLIPSE_TAGS:
+                selected['messages'].append('\t ... no data imported for variable \'%s\' from file %s (wrong eclipse label)' % (var_name, fname))
+                continue
+            var_data = data[var_type][var_name]
+            selected[var_type][var_name] = var_data
+            if var_type == 'model':
+                # the new sample duration after normalization
+                selected['model_delta_t'][var_name] = _cycle_delta_t(var_cycles, var_data.shape[1])
+            selected['messages'].append('\t ... added %i cycles for variable \'%s\' (eclipse label \'%s\')' % (var_data.shape[0], var_name, eclipse_tag))
+    return selected
+
+
+def _cycle_derivative(var_data, delta_t):
+    """Time derivative of (ncycles x npoints) cycle data.
+
+    delta_t gives the sample duration of each cycle.
+    """
+    return np.diff(var_data, axis=1) / np.asarray(delta_t)[:, None]
+
+
+def _add_trial_data(model_res, emg_res, model_delta_t, selected):
+    """Add the selected variables of a trial to the accumulators"""
+    for var_name, var_data in selected['model'].items():
+        model_res[var_name].append(var_data)
+        model_delta_t[var_name].append(selected['model_delta_t'][var_name])
+    for var_name, var_data in selected['emg'].items():
+        emg_res[var_name].append(var_data)
+
+
+def _write_trial_data(model_writer, emg_writer, selected):
+    """Append the selected variables of a trial to the MAT v7.3 writers.
+
+    The derivatives are computed for the cycles of the trial as they are
+    appended, so the full matrices are never needed. Returns the cycle
+    indices of the trial as a dict with the keys model and emg, each a dict of
+    variable name -> [index of first cycle, number of cycles].
+    """
+    cycles = {'model': dict(), 'emg': dict()}
+    for var_name, var_data in selected['model'].items():
+        cycles['model'][var_name] = [model_writer.append(var_name, var_data), len(var_data)]
+        if var_name in MODEL_VAR_NAMES_TO_DIFF:
+            var_dt = _cycle_derivative(var_data, selected['model_delta_t'][var_name])
+            cycles['model'][var_name + '_dt'] = [model_writer.append(var_name + '_dt', var_dt), len(var_dt)]
+    for var_name, var_data in selected['emg'].items():
+        cycles['emg'][var_name] = [emg_writer.append(var_name, var_data), len(var_data)]
+    # keep the trials exported so far if the export is interrupted
+    model_writer.flush()
+    emg_writer.flush()
+    return cycles
+
+
+def _add_empty_derived(model_writer):
+    """Create the derived variables, which are always written even if empty"""
     for var_name in MODEL_VAR_NAMES_TO_DIFF:
-        model_res[var_name + '_dt'] = np.diff(model_res[var_name], axis=0) / np.array(model_delta_t[var_name])
+        model_writer.append(var_name, np.zeros((0, 101)))
+        model_writer.append(var_name + '_dt', np.zeros((0, 100)))
+
+
+def _collect_file(full_name):
+    """Collect and select the data of a c3d file.
+
+    This runs in the worker processes. Returns a tuple of (selected, error),
+    where selected is the output of _select_trial_data() and error is None, or
+    selected is None and error describes why the file could not be read.
+    """
+    fname = os.path.basename(full_name)
+    try:
+        data, cycles = collect_selected_data(full_name, fp_cycles_only=True)
+        if data is None:
+            selected = _empty_selection()
+            selected['messages'].append('\t ... no data imported from file %s (wrong eclipse label)' % fname)
+            return selected, None
+        return _select_trial_data(fname, data, cycles), None
+    except Exception as e:
+        # report the error to the parent instead of aborting the whole export
+        return None, '%s: %s' % (type(e).__name__, e)
+
+
+def _collect_files(full_names, max_workers):
+    """Collect the files, yielding (full_name, selected, error) in file order"""
+    if max_workers == 1:
+        for full_name in full_names:
+            yield (full_name,) + _collect_file(full_name)
+        return
+    with ProcessPoolExecutor(max_workers) as executor:
+        # map() returns the results in the order of the input files
+        for full_name, result in zip(full_names, executor.map(_collect_file, full_names)):
+            yield (full_name,) + result
+
+
+def _finalize(model_res, emg_res, model_delta_t):
+    """Concatenate the accumulated data and compute the derivatives.
+
+    Returns the model and EMG output dicts.
+    """
+    model_out = {var_name: acc.result() for var_name, acc in model_res.items()}
+    emg_out = {var_name: acc.result() for var_name, acc in emg_res.items()}
+    for var_name in MODEL_VAR_NAMES_TO_DIFF:
+        model_out[var_name] = model_res[var_name].result()
+        model_out[var_name + '_dt'] = _cycle_derivative(model_out[var_name].T, model_delta_t[var_name].result()).T
+    return model_out, emg_out
+
+
+def _export_files(full_names):
+    """Collect the files, yielding (full_name, selected) for each file read"""
+    failed = list()
+    for full_name, selected, error in _collect_files(full_names, MAX_WORKERS):
+        print('Reading file %s ...' % os.path.basename(full_name))
+        if error is not None:
+            print('\t ... failed! (%s)' % error)
+            failed.append(full_name)
+            continue
+        for message in selected['messages']:
+            print(message)
+        yield full_name, selected
+
+    if failed:
+        print('Could not read %d of %d files:' % (len(failed), len(full_names)))
+        for full_name in failed:
+            print('\t%s' % full_name)
+
+
+def _export_params():
+    """The parameters that affect the exported data, for the manifest"""
+    return {
+        'model_vars': sorted(MODEL_VAR_NAMES),
+        'diff_vars': sorted(MODEL_VAR_NAMES_TO_DIFF),
+        'emg_vars': sorted(EMG_VAR_NAMES),
+        'eclipse_tags': sorted(VALID_ECLIPSE_TAGS),
+        'emg_cycle_len': EMG_CYCLE_LEN,
+    }
+
+
+def _trial_files(c3dfile):
+    """The files of a trial that the export depends on"""
+    enfpath = find_enf(c3dfile)
+    return {'c3d': str(c3dfile), 'enf': None if enfpath is None else str(enfpath)}
+
+
+def _commit(writers, manifest):
+    """Record the current numbers of cycles and save the manifest"""
+    manifest.state['ncycles'] = {var_type: {var_name: writer.ncycles(var_name) for var_name in writer.names()} for var_type, writer in writers.items()}
+    manifest.save()
+
+
+def _rollback(writers, manifest):
+    """Delete cycles that were written after the last save of the manifest.
+
+    These are left over from an interrupted export. Returns False if the
+    outputs have fewer cycles than recorded (e.g. they were replaced), in
+    which case they cannot be used.
+    """
+    recorded = manifest.state.get('ncycles', dict())
+    for var_type, writer in writers.items():
+        var_ncycles = recorded.get(var_type, dict())
+        if any(var_name not in writer or writer.ncycles(var_name) < n for var_name, n in var_ncycles.items()):
+            return False
+        for var_name in writer.names():
+            if var_name not in var_ncycles:
+                writer.delete(var_name)
+            else:
+                writer.truncate(var_name, var_ncycles[var_name])
+    return True
+
+
+def _remove_trials(writers, manifest, keys):
+    """Delete the cycles of trials from the outputs and the manifest.
+
+    The cycles of each variable are deleted in a single pass over the output.
+    """
+    entries = [manifest.trials.pop(key) for key in keys]
+    for var_type, writer in writers.items():
+        deleted = defaultdict(list)
+        for entry in entries:
+            for var_name, (start, ncycles) in entry['cycles'][var_type].items():
+                deleted[var_name].append((start, ncycles))
+        for var_name, ranges in deleted.items():
+            writer.delete_ranges(var_name, ranges)
+            # the cycles of the following trials move back by the number of
+            # cycles deleted before them
+            ranges.sort()
+            starts = [start for start, _ in ranges]
+            ndeleted = list(itertools.accumulate(ncycles for _, ncycles in ranges))
+            for other in manifest.trials.values():
+                other_cycles = other['cycles'][var_type].get(var_name)
+                if other_cycles is None:
+                    continue
+                if k := bisect.bisect_left(starts, other_cycles[0]):
+                    other_cycles[0] -= ndeleted[k - 1]
+
+
+def export_cohort(root, model_fname=MODEL_OUT_FNAME, emg_fname=EMG_OUT_FNAME, manifest_fname=MANIFEST_FNAME):
+    """Incrementally export all c3d files under a cohort root directory.
+
+    root is searched recursively, so it can contain e.g. patient folders with
+    session subfolders. The manifest records the exported trials (the mtime,
+    size and hash of the c3d and .enf files, and the cycle indices of the
+    trial in each output variable). On each run, only new and changed trials
+    are read. The cycles of changed and removed trials are deleted from the
+    outputs, and the cycles of new and changed trials are appended to them.
+    Note that the cycles are thus in the order the trials were exported in.
+
+    The outputs are MAT v7.3 files. If the export parameters change (e.g.
+    MODEL_VAR_NAMES), or the outputs do not match the manifest, everything is
+    exported again.
+    """
+    manifest = ExportManifest(manifest_fname, _export_params())
+    mode = 'w' if manifest.is_new else 'a'
+    with Mat73Writer(model_fname, mode) as model_writer, Mat73Writer(emg_fname, mode) as emg_writer:
+        writers = {'model': model_writer, 'emg': emg_writer}
+        if not _rollback(writers, manifest):
+            print('Output files do not match the manifest, exporting all trials')
+            manifest.trials, manifest.state = dict(), dict()
+            for writer in writers.values():
+                for var_name in writer.names():
+                    writer.delete(var_name)
+
+        if CATALOG_FNAME is not None:
+            with TrialCatalog(CATALOG_FNAME) as catalog:
+                catalog.refresh(root)
+                c3dfiles = catalog.query(root, tags=VALID_ECLIPSE_TAGS, tag_keys=cfg.eclipse.tag_keys)
+        else:
+            c3dfiles = find_c3ds(root)
+        keys = {c3dfile: Path(c3dfile).relative_to(root).as_posix() for c3dfile in c3dfiles}
+        status = {c3dfile: manifest.check(keys[c3dfile], _trial_files(c3dfile)) for c3dfile in c3dfiles}
+        todo = [c3dfile for c3dfile in c3dfiles if status[c3dfile] != 'unchanged']
+        removed = set(manifest.trials) - set(keys.values())
+        _remove_trials(writers, manifest, sorted(removed) + [keys[c3dfile] for c3dfile in todo if status[c3dfile] == 'changed'])
+        _commit(writers, manifest)
+        nstatus = {st: list(status.values()).count(st) for st in ['new', 'changed', 'unchanged']}
+        print('%d new, %d changed, %d removed and %d unchanged trials' % (nstatus['new'], nstatus['changed'], len(removed), nstatus['unchanged']))
+
+        for full_name, selected in _export_files(todo):
+            cycles = _write_trial_data(model_writer, emg_writer, selected)
+            manifest.trials[keys[full_name]] = {'files': file_signatures(_trial_files(full_name)), 'cycles': cycles}
+            _commit(writers, manifest)
+        _add_empty_derived(model_writer)
+        _commit(writers, manifest)
+
+
+def main():
+    if COHORT_ROOT is not None:
+        export_cohort(COHORT_ROOT)
+        return
+
+    full_names = [DATA_FLDR + '/' + fname for fname in sorted(os.listdir(DATA_FLDR)) if fname[-4:] == '.c3d']
 
-    scipy.io.savemat(MODEL_OUT_FNAME, model_res)
-    scipy.io.savemat(EMG_OUT_FNAME, emg_res)
+    if MAT_FORMAT == '7.3':
+        with Mat73Writer(MODEL_OUT_FNAME, 'w') as model_writer, Mat73Writer(EMG_OUT_FNAME, 'w') as emg_writer:
+            for full_name, selected in _export_files(full_names):
+                _write_trial_data(model_writer, emg_writer, selected)
+            _add_empty_derived(model_writer)
+    else:
+        model_res = defaultdict(lambda: ChunkedAccumulator(101))
+        emg_res = defaultdict(lambda: ChunkedAccumulator(EMG_CYCLE_LEN))
+        model_delta_t = defaultdict(ChunkedAccumulator)
+        for full_name, selected in _export_files(full_names):
+            _add_trial_data(model_res, emg_res, model_delta_t, selected)
+        model_out, emg_out = _finalize(model_res, emg_res, model_delta_t)
+        scipy.io.savemat(MODEL_OUT_FNAME, model_out)
+        scipy.io.savemat(EMG_OUT_FNAME, emg_out)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
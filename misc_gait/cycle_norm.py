@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+
+Vectorized normalization of frame-based data to gait cycles.
+
+Gaitcycle.normalize() interpolates each variable separately. Here, the linear
+interpolation for each cycle is instead written as a sparse (101 x frames)
+operator, built once per cycle. The operators for all cycles of a trial are
+stacked, so that a whole (channels x frames) block is normalized to a
+(cycles x channels x 101) tensor with a single sparse matrix product. The
+results are identical to Gaitcycle.normalize().
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import numpy as np
+import scipy.sparse
+
+from gaitutils.envutils import GaitDataError
+
+# number of points in the normalized cycle (0..100%)
+NPOINTS = 101
+
+
+def _interp_operator(start, end, nframes, npoints=NPOINTS):
+    """Sparse (npoints x nframes) operator that normalizes data to a cycle.
+
+    Equivalent to np.interp(tn, t, data[start:end]), with t and tn as in
+    Gaitcycle.normalize().
+    """
+    ncyc = end - start
+    tn = np.linspace(0, 100, npoints)
+    rows = np.arange(npoints)
+    if ncyc == 1:
+        # np.interp returns the single data point everywhere
+        return scipy.sparse.csr_matrix(
+            (np.ones(npoints), (rows, np.full(npoints, start))),
+            shape=(npoints, nframes),
+        )
+    t = np.linspace(0, 100, ncyc)
+    idx = np.clip(np.searchsorted(t, tn, side='right') - 1, 0, ncyc - 2)
+    w1 = (tn - t[idx]) / (t[idx + 1] - t[idx])
+    w0 = 1 - w1
+    return scipy.sparse.csr_matrix(
+        (
+            np.concatenate([w0, w1]),
+            (np.concatenate([rows, rows]), start + np.concatenate([idx, idx + 1])),
+        ),
+        shape=(npoints, nframes),
+    )
+
+
+class CycleNormalizer:
+    """Normalizes data blocks to a fixed set of gait cycles.
+
+    Parameters
+    ----------
+    cycles : list
+        The gait cycles (Gaitcycle instances, or anything with start and end
+        attributes).
+    nframes : int
+        Number of frames in the data.
+    npoints : int
+        Number of points in the normalized cycles.
+    """
+
+    def __init__(self, cycles, nframes, npoints=NPOINTS):
+        self.cycles = list(cycles)
+        self.nframes = nframes
+        self.npoints = npoints
+        for cyc in self.cycles:
+            if cyc.end > nframes:
+                raise GaitDataError('Cycle frame numbers exceed the available data')
+        if self.cycles:
+            self.operator = scipy.sparse.vstack(
+                [
+                    _interp_operator(cyc.start, cyc.end, nframes, npoints)
+                    for cyc in self.cycles
+                ],
+                format='csr',
+            )
+        else:
+            self.operator = scipy.sparse.csr_matrix((0, nframes))
+
+    def normalize(self, data):
+        """Normalize a (channels x frames) block.
+
+        Returns a (cycles x channels x npoints) tensor.
+        """
+        data = np.atleast_2d(data)
+        if data.shape[1] != self.nframes:
+            raise ValueError('Data length does not match the number of frames')
+        res = self.operator @ data.T  # (cycles * npoints) x channels
+        res = res.reshape(len(self.cycles), self.npoints, data.shape[0])
+        return res.transpose(0, 2, 1)
+
+
+def context_mask(cycle_ctxts, ch_ctxts):
+    """Boolean (cycles x channels) mask of matching cycle and channel contexts"""
+    cycle_ctxts = np.array(list(cycle_ctxts), dtype=str)
+    ch_ctxts = np.array(list(ch_ctxts), dtype=str)
+    return cycle_ctxts[:, None] == ch_ctxts[None, :]
+
+
+def mean_std(tensor, mask):
+    """Mean and stddev over cycles of a (cycles x channels x npoints) tensor.
+
+    Only the cycles where mask (cycles x channels) is True are included for
+    each channel. Returns two (channels x npoints) arrays; channels without
+    any cycles get NaNs.
+    """
+    m = mask[:, :, None]
+    n = m.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(m, tensor, 0).sum(axis=0) / n
+        var = np.where(m, (tensor - mean) ** 2, 0).sum(axis=0) / n
+    return mean, np.sqrt(var)
+
+
+def split_channels(tensor, mask, chnames):
+    """Split a normalized tensor into a dict of (ncycles x npoints) arrays.
+
+    Each channel gets the cycles where mask (cycles x channels) is True.
+    """
+    return {
+        chname: tensor[mask[:, k], k, :] for k, chname in enumerate(chnames)
+    }
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+
+Per-trial EMG envelope processing for c3d files.
+
+The functions here compute the envelopes for a single c3d file and normalize
+them to the gait cycles. They live in a module of their own (instead of the
+rectify_emg_c3d script), so that they can be imported by the worker processes
+of the batch mode.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import functools
+import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from gaitutils.envutils import GaitDataError
+from gaitutils import cfg, trial, read_data
+
+import emg_filters
+import emg_cache
+import cycle_norm
+
+logger = logging.getLogger(__name__)
+
+# linear envelope parameters
+HPF = 5  # high pass frequency
+LPF = 10  # envelope low pass frequency
+BUTTER_ORDER = 4  # filter order
+# RMS envelope parameters
+RMS_HPF = 20  # high pass frequency
+RMS_WIN = 31  # RMS window length (samples)
+# method for downsampling to frame rate, see emg_filters.resample(); 'fft' gives
+# the same results as earlier exports, the other methods are faster but differ
+# slightly, most at the trial edges (see bench_resample.py)
+RESAMPLE_METHOD = 'fft'
+# compute the envelopes in blocks of this many frames, to bound the memory used
+# by the filter intermediates (see emg_filters.iter_linear_envelope()); None to
+# process whole trials at once. The raw EMG data is still read whole. Needs a
+# RESAMPLE_METHOD other than 'fft'.
+STREAM_BLOCK_FRAMES = None
+
+
+def _configure():
+    """Set the gaitutils config used for the EMG exports.
+
+    This is also used as the initializer for the worker processes, since they
+    do not inherit config changes made in the parent process.
+    """
+    cfg.autoproc.nexus_forceplate_devnames = []  # read all forceplates
+    # be more tolerant about toeoffs
+    cfg.trial.no_toeoff = 'reject'
+    cfg.trial.multiple_toeoffs = 'reject'
+
+
+def strip_voltage_prefix(emgdata):
+    """Strip Voltage. prefix that Nexus inserts"""
+    return {
+        (chname[8:] if chname.find('Voltage') == 0 else chname): data
+        for chname, data in emgdata.items()
+    }
+
+
+def _assemble_blocks(blocks, nchannels, nframes):
+    """Collect streamed (first frame, data) envelope blocks into an array"""
+    out = np.empty((nchannels, nframes))
+    for f0, block in blocks:
+        out[:, f0 : f0 + block.shape[1]] = block
+    return out
+
+
+def _compute_rms_envelope_c3d(c3dfile):
+    """Compute RMS-based envelope"""
+    # read EMG data
+    emgdata = read_data.get_emg_data(c3dfile)['data']
+    meta = read_data.get_metadata(c3dfile)
+    emgrate = meta['analograte']
+    nframes = meta['length']
+
+    # stack all channels into a single (channels x samples) array
+    chnames, data = emg_filters.stack_channels(strip_voltage_prefix(emgdata))
+    del emgdata  # keep only the stacked copy of the data
+
+    if STREAM_BLOCK_FRAMES is not None:
+        # apply hpf and RMS and downsample, block by block
+        blocks = emg_filters.iter_rms_envelope(
+            data,
+            emgrate,
+            RMS_HPF,
+            BUTTER_ORDER,
+            RMS_WIN,
+            nframes,
+            method=RESAMPLE_METHOD,
+            block_frames=STREAM_BLOCK_FRAMES,
+        )
+        emg_rms_ds = _assemble_blocks(blocks, len(chnames), nframes)
+    else:
+        # apply hpf and RMS
+        emg_rms = emg_filters.rms_envelope(
+            data, emgrate, RMS_HPF, BUTTER_ORDER, RMS_WIN
+        )
+        # downsample
+        emg_rms_ds = emg_filters.resample(emg_rms, nframes, method=RESAMPLE_METHOD)
+
+    return emg_filters.unstack_channels(chnames, emg_rms_ds, suffix='_RMS')
+
+
+def _compute_emg_envelope_c3d(c3dfile):
+    """Compute EMG linear envelope for a c3d file"""
+    # read EMG data
+    emgdata = read_data.get_emg_data(c3dfile)['data']
+    meta = read_data.get_metadata(c3dfile)
+    emgrate = meta['analograte']
+    nframes = meta['length']
+
+    # stack all channels into a single (channels x samples) array
+    chnames, data = emg_filters.stack_channels(strip_voltage_prefix(emgdata))
+    del emgdata  # keep only the stacked copy of the data
+
+    if STREAM_BLOCK_FRAMES is not None:
+        # apply hpf, rectify, apply lpf and downsample, block by block
+        blocks = emg_filters.iter_linear_envelope(
+            data,
+            emgrate,
+            HPF,
+            LPF,
+            BUTTER_ORDER,
+            nframes,
+            method=RESAMPLE_METHOD,
+            block_frames=STREAM_BLOCK_FRAMES,
+        )
+        emg_linearenvelope_ds = _assemble_blocks(blocks, len(chnames), nframes)
+    else:
+        # apply hpf, rectify and apply lpf
+        emg_linearenvelope = emg_filters.linear_envelope(
+            data, emgrate, HPF, LPF, BUTTER_ORDER
+        )
+        # downsample
+        emg_linearenvelope_ds = emg_filters.resample(
+            emg_linearenvelope, nframes, method=RESAMPLE_METHOD
+        )
+
+    return emg_filters.unstack_channels(
+        chnames, emg_linearenvelope_ds, suffix='_LinearEnvelope'
+    )
+
+
+# emg1-6 oikea, paitsi Vilma emg1-6 vasen
+# Noraxon-specific mappings from ch index to context. These are module level
+# functions (instead of lambdas) so that they can be pickled.
+def idx_mapper(idx):
+    return 'R' if idx <= 6 else 'L'
+
+
+def idx_mapper_reverse(idx):
+    return 'L' if idx <= 6 else 'R'
+
+
+def _get_idx_mapper(c3dfile):
+    """Return the channel index mapper for a c3d file"""
+    # for Vilma, we have a different channel mapping
+    return idx_mapper_reverse if 'VILMA' in c3dfile.upper() else idx_mapper
+
+
+def _channel_context(chname, idx_mapper):
+    """Try to figure out channel context.
+
+    idx_mapper must be a dict that maps channel index to context.
+    """
+    if chname[0] in 'LR':  # Myon naming
+        return chname[0]
+    elif chname[:3] == 'EMG':  # Noraxon naming
+        dot_pos = chname.find('.')
+        idx = chname[3:dot_pos]  # channel index
+        try:
+            return idx_mapper(int(idx))
+        except ValueError:
+            raise ValueError('cannot parse channel name %s' % chname)
+    else:  # unrecognized channel
+        return None
+
+
+def _result_params(c3dfile, envelope_fun):
+    """Parameters that determine the result of _process_c3d (for caching).
+
+    Besides the envelope parameters, the normalized result depends on the
+    channel mapping and on the config items that decide which cycles are
+    accepted.
+    """
+    return {
+        'envelope_fun': envelope_fun.__name__,
+        'idx_mapper': _get_idx_mapper(c3dfile).__name__,
+        'no_toeoff': cfg.trial.no_toeoff,
+        'multiple_toeoffs': cfg.trial.multiple_toeoffs,
+        'HPF': HPF,
+        'LPF': LPF,
+        'BUTTER_ORDER': BUTTER_ORDER,
+        'RMS_HPF': RMS_HPF,
+        'RMS_WIN': RMS_WIN,
+        'RESAMPLE_METHOD': RESAMPLE_METHOD,
+        'STREAM_BLOCK_FRAMES': STREAM_BLOCK_FRAMES,
+    }
+
+
+def _pack_result(lenv, res):
+    """Pack envelope and per-trial result into (arrays, meta) for caching"""
+    chnames, envelope = emg_filters.stack_channels(lenv)
+    arrays = {
+        'envelope': envelope,
+        'norm_tensor': res['norm_tensor'],
+        'mask': res['mask'],
+    }
+    meta = {
+        'chnames': chnames,
+        'ncycles': res['ncycles'],
+        'ctxts': res['ctxts'],
+    }
+    return arrays, meta
+
+
+def _unpack_result(c3dfile, arrays, meta):
+    """Inverse of _pack_result; returns the per-trial result"""
+    return {
+        'c3dfile': c3dfile,
+        'ncycles': meta['ncycles'],
+        'ctxts': meta['ctxts'],
+        'norm_tensor': arrays['norm_tensor'],
+        'mask': arrays['mask'],
+    }
+
+
+def _normalize_trial(c3dfile, lenv):
+    """Normalize envelopes to the gait cycles of a c3d file.
+
+    lenv is a dict of envelope data for each channel. Returns a dict with the
+    following keys:
+
+    c3dfile : the c3d filename
+    ncycles : dict of number of cycles for each context
+    ctxts : dict of context for each valid channel
+    norm_tensor : (cycles x channels x 101) array of data normalized to all
+        cycles of the trial; the channels are in the order of ctxts
+    mask : (cycles x channels) boolean array, True where the cycle context
+        matches the channel context
+
+    Use cycle_norm.split_channels() to get the matching cycles for each
+    channel, and cycle_norm.mean_std() to average them.
+    """
+    tr = trial.Trial(c3dfile)
+    this_cycles = tr.get_cycles('all')
+    # count L/R cycles
+    ncycles = {
+        ctxt: len([c for c in this_cycles if c.context == ctxt]) for ctxt in 'LR'
+    }
+    _idx_mapper = _get_idx_mapper(c3dfile)
+    ctxts = {chname: _channel_context(chname, _idx_mapper) for chname in lenv}
+    ctxts = {chname: ctxt for chname, ctxt in ctxts.items() if ctxt is not None}
+    chnames, data = emg_filters.stack_channels({ch: lenv[ch] for ch in ctxts})
+    if not chnames:
+        data = np.empty((0, tr.length))
+    normalizer = cycle_norm.CycleNormalizer(this_cycles, data.shape[1])
+    return {
+        'c3dfile': c3dfile,
+        'ncycles': ncycles,
+        'ctxts': ctxts,
+        'norm_tensor': normalizer.normalize(data),
+        'mask': cycle_norm.context_mask(
+            [cyc.context for cyc in this_cycles], ctxts.values()
+        ),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _get_cache(cachedir):
+    """Return the EnvelopeCache instance for cachedir (one per process)"""
+    return emg_cache.EnvelopeCache(cachedir)
+
+
+def _process_c3d(c3dfile, envelope_fun, cachedir=None):
+    """Compute envelopes for a c3d file and normalize them to gait cycles.
+
+    envelope_fun is the function used to compute the envelopes, e.g.
+    _compute_emg_envelope_c3d. If cachedir is given, the results are cached
+    there (see emg_cache). Returns the per-trial result from _normalize_trial,
+    or None if the EMG cannot be read.
+    """
+    if cachedir is not None:
+        cache = _get_cache(cachedir)
+        key = cache.key(c3dfile, _result_params(c3dfile, envelope_fun))
+        if (cached := cache.get(key)) is not None:
+            return _unpack_result(c3dfile, *cached)
+    try:
+        lenv = envelope_fun(c3dfile)
+    except GaitDataError:
+        logger.warning('cannot read EMG from %s, skipping' % c3dfile)
+        return None
+    res = _normalize_trial(c3dfile, lenv)
+    if cachedir is not None:
+        cache.put(key, *_pack_result(lenv, res))
+    return res
+
+
+def process_c3ds(c3dfiles, envelope_fun, max_workers=None, cachedir=None):
+    """Process c3d files, optionally in parallel.
+
+    Each file is processed by _process_c3d in a pool of max_workers processes
+    (None for one per CPU core). If max_workers == 1, the files are processed
+    serially in the current process. If cachedir is given, results are cached
+    on disk. Returns a list of the per-trial results in the order of c3dfiles;
+    files whose EMG could not be read are omitted.
+    """
+    fun = functools.partial(
+        _process_c3d, envelope_fun=envelope_fun, cachedir=cachedir
+    )
+    if max_workers == 1:
+        _configure()
+        results = list(map(fun, c3dfiles))
+    else:
+        with ProcessPoolExecutor(max_workers, initializer=_configure) as executor:
+            # map() returns the results in the order of the input files
+            results = list(executor.map(fun, c3dfiles))
+    return [res for res in results if res is not None]
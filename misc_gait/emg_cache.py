@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+
+Persistent content-addressed cache for computed EMG envelopes.
+
+Each cache entry is a directory named by a hash of the c3d file content and
+the processing parameters. It holds the arrays as .npy files (which are loaded
+memory-mapped) and a meta.json file for everything else. Since the key
+changes whenever the file or the parameters change, stale entries are never
+returned; they simply stop being used and are eventually evicted.
+
+The total size of the cache is bounded. When it is exceeded, the least recently
+used entries are deleted. The size is kept as a running total, so the cache
+directory is scanned only when the limit is exceeded. Recency is tracked by
+the modification time of the entry's meta.json, which is touched on every
+cache hit.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+from pathlib import Path
+
+from trial_files import file_hash
+
+logger = logging.getLogger(__name__)
+
+# default maximum cache size in bytes
+MAX_CACHE_BYTES = 2 * 1024**3
+# bump this to invalidate all existing entries, e.g. if the entry layout changes
+CACHE_VERSION = 2
+
+
+def _dir_size(path):
+    """Total size of files in a directory (non-recursive)"""
+    return sum(p.stat().st_size for p in path.iterdir() if p.is_file())
+
+
+class EnvelopeCache:
+    """On-disk LRU cache of EMG envelope results.
+
+    Parameters
+    ----------
+    cachedir : str | Path
+        The cache directory. Will be created if needed.
+    max_bytes : int
+        Maximum total size of the cache in bytes.
+    """
+
+    def __init__(self, cachedir, max_bytes=MAX_CACHE_BYTES):
+        self.cachedir = Path(cachedir)
+        self.max_bytes = max_bytes
+        self.cachedir.mkdir(parents=True, exist_ok=True)
+        # running total size of the entries; None until the first scan
+        self._size = None
+
+    def key(self, fname, params):
+        """Compute the cache key for a data file and a dict of parameters"""
+        h = hashlib.sha1()
+        h.update(file_hash(fname).encode())
+        params = dict(params, _cache_version=CACHE_VERSION)
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """Return cached (arrays, meta) for key, or None if not cached.
+
+        arrays is a dict of memory-mapped (read-only) arrays and meta is the
+        dict that was stored with them.
+        """
+        entry = self.cachedir / key
+        metafile = entry / 'meta.json'
+        try:
+            with open(metafile, 'r') as f:
+                meta = json.load(f)
+            arrays = {
+                name: np.load(entry / f'{name}.npy', mmap_mode='r')
+                for name in meta['_arrays']
+            }
+            os.utime(metafile)  # mark as recently used
+        except (OSError, ValueError, KeyError):
+            if entry.is_dir():
+                # a broken entry (e.g. after an interrupted eviction); remove
+                # it, so that put() can store the recomputed result
+                logger.warning(f'removing broken cache entry {key}')
+                shutil.rmtree(entry, ignore_errors=True)
+            return None
+        logger.debug(f'cache hit for {key}')
+        return arrays, meta['meta']
+
+    def put(self, key, arrays, meta):
+        """Store a dict of arrays and a JSON-serializable meta dict under key"""
+        entry = self.cachedir / key
+        if entry.is_dir():
+            return
+        # write into a temporary directory and rename it into place, so that
+        # concurrent processes never see partially written entries
+        tmpdir = self.cachedir / f'{key}.tmp{os.getpid()}'
+        tmpdir.mkdir(exist_ok=True)
+        for name, data in arrays.items():
+            np.save(tmpdir / f'{name}.npy', np.asarray(data))
+        with open(tmpdir / 'meta.json', 'w') as f:
+            json.dump({'_arrays': list(arrays), 'meta': meta}, f)
+        try:
+            tmpdir.rename(entry)
+        except OSError:  # another process got there first
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        # the cache dir is scanned only when the running size exceeds the
+        # limit (or on the first put); entries written by other processes are
+        # not counted until then
+        if self._size is not None:
+            self._size += _dir_size(entry)
+        if self._size is None or self._size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        """Delete least recently used entries until the cache fits max_bytes"""
+        entries = list()
+        for entry in self.cachedir.iterdir():
+            if '.tmp' in entry.name:  # entry still being written
+                continue
+            metafile = entry / 'meta.json'
+            try:
+                entries.append(
+                    (metafile.stat().st_mtime, _dir_size(entry), entry)
+                )
+            except OSError:  # temporary dir, or deleted by another process
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logger.debug(f'evicting cache entry {entry.name}')
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+        self._size = total
+
+    def clear(self):
+        """Delete all cache entries"""
+        for entry in self.cachedir.iterdir():
+            shutil.rmtree(entry, ignore_errors=True)
+        self._size = 0
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+
+Columnar (Parquet) export of cycle-normalized EMG data.
+
+Each row is one gait cycle of one channel, with the columns session, trial,
+channel, context, cycle (1-based index among the channel's cycles) and the
+101 normalized samples ('frame 0' ... 'frame 100', as in the XLSX output).
+
+Rows are buffered per (channel, context) and written as compressed row groups
+that each hold a single channel and context. Parquet stores min/max statistics
+for every row group, so reading a single channel or context with
+read_cycles() skips the other row groups without decoding them. Since the file
+is written in row groups, exports of whole cohorts never need to fit in memory.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import os.path as op
+from collections import defaultdict
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import cycle_norm
+
+SAMPLE_COLUMNS = ['frame %d' % k for k in range(cycle_norm.NPOINTS)]
+SCHEMA = pa.schema(
+    [
+        ('session', pa.string()),
+        ('trial', pa.string()),
+        ('channel', pa.string()),
+        ('context', pa.string()),
+        ('cycle', pa.int32()),
+    ]
+    + [(col, pa.float64()) for col in SAMPLE_COLUMNS]
+)
+# number of buffered rows per (channel, context) before a row group is written
+ROW_GROUP_ROWS = 10000
+
+
+class CycleWriter:
+    """Write per-trial results (see emg_c3d) into a Parquet file.
+
+    Can be used as a context manager, otherwise close() must be called to
+    finish the file.
+
+    Parameters
+    ----------
+    filename : str
+        The output file.
+    row_group_rows : int
+        Rows buffered for each (channel, context) before writing a row group.
+    compression : str
+        Parquet compression codec.
+    """
+
+    def __init__(self, filename, row_group_rows=ROW_GROUP_ROWS, compression='zstd'):
+        self._writer = pq.ParquetWriter(filename, SCHEMA, compression=compression)
+        self.row_group_rows = row_group_rows
+        # (channel, context) -> list of (session, trial, cycles x 101 array)
+        self._buffers = defaultdict(list)
+        self._nrows = defaultdict(int)
+
+    def write_trial(self, res):
+        """Add the normalized cycles of a per-trial result"""
+        c3dfile = res['c3dfile']
+        session = op.split(op.dirname(c3dfile))[-1]
+        trialname = op.splitext(op.split(c3dfile)[-1])[0]
+        ctxts = res['ctxts']
+        norm_data = cycle_norm.split_channels(res['norm_tensor'], res['mask'], ctxts)
+        for chname, data in norm_data.items():
+            key = (chname, ctxts[chname])
+            self._buffers[key].append((session, trialname, np.asarray(data)))
+            self._nrows[key] += len(data)
+            if self._nrows[key] >= self.row_group_rows:
+                self._flush(key)
+
+    def _flush(self, key):
+        """Write the buffered rows for a (channel, context) as a row group"""
+        chunks = self._buffers.pop(key, [])
+        nrows = self._nrows.pop(key, 0)
+        if not nrows:
+            return
+        chname, ctxt = key
+        data = np.concatenate([chunk[2] for chunk in chunks])
+        columns = {
+            'session': [chunk[0] for chunk in chunks for _ in chunk[2]],
+            'trial': [chunk[1] for chunk in chunks for _ in chunk[2]],
+            'channel': [chname] * nrows,
+            'context': [ctxt] * nrows,
+            'cycle': np.concatenate(
+                [np.arange(1, len(chunk[2]) + 1) for chunk in chunks]
+            ).astype(np.int32),
+        }
+        columns.update({col: data[:, k] for k, col in enumerate(SAMPLE_COLUMNS)})
+        table = pa.Table.from_pydict(columns, schema=SCHEMA)
+        self._writer.write_table(table, row_group_size=nrows)
+
+    def close(self):
+        for key in sorted(self._buffers):
+            self._flush(key)
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_cycles(filename, channel=None, context=None, trial=None, columns=None):
+    """Read normalized cycles from a Parquet file into a pandas DataFrame.
+
+    channel, context and trial select the rows; row groups that do not match
+    are skipped without decoding. columns selects the columns to read (None
+    for all).
+    """
+    filters = [
+        (col, '=', val)
+        for col, val in [('channel', channel), ('context', context), ('trial', trial)]
+        if val is not None
+    ]
+    table = pq.read_table(filename, columns=columns, filters=filters or None)
+    return table.to_pandas()
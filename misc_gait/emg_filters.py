@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+
+Multichannel filter bank for EMG envelope computation.
+
+All channels of a trial are stacked into a single (channels x samples) array,
+and each processing stage (HPF, rectification, LPF, RMS, downsampling) is run
+once along the samples axis. Filters are designed as second-order sections and
+cached per (analog rate, cutoff, order), so repeated calls for trials with the
+same analog rate do not redesign them.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import functools
+from fractions import Fraction
+import numpy as np
+import scipy.signal
+
+# available downsampling methods, see resample()
+RESAMPLE_METHODS = ('fft', 'polyphase', 'decimate', 'blockavg')
+# max. denominator for the rational approximation of the polyphase ratio
+MAX_POLY_DENOM = 1000
+# default block length (in frames) for the streaming mode
+BLOCK_FRAMES = 2000
+# relative level at which filter impulse responses are considered to have
+# decayed; determines the block overlap in the streaming mode
+STREAM_TOL = 1e-10
+
+
+@functools.lru_cache(maxsize=None)
+def _butter_sos(rate, cutoff, order, btype):
+    """Design a Butterworth filter as second-order sections (cached)"""
+    return scipy.signal.butter(
+        order, cutoff * 2 / rate, btype, analog=False, output='sos'
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _filter_margin(rate, cutoff, order, btype):
+    """Number of samples for the impulse response of a filter to decay.
+
+    Returns the length after which the impulse response stays below
+    STREAM_TOL times its peak value.
+    """
+    sos = _butter_sos(rate, cutoff, order, btype)
+    impulse = np.zeros(int(np.ceil(100 * rate / cutoff)))
+    impulse[0] = 1
+    h = np.abs(scipy.signal.sosfilt(sos, impulse))
+    return int(np.nonzero(h > STREAM_TOL * h.max())[0][-1]) + 1
+
+
+def stack_channels(emgdata):
+    """Stack a dict of channel data into a (channels x samples) array.
+
+    Returns a tuple of (chnames, data), where the rows of data are in the order
+    of chnames.
+    """
+    chnames = list(emgdata)
+    if not chnames:
+        return chnames, np.empty((0, 0))
+    return chnames, np.vstack([emgdata[chname] for chname in chnames])
+
+
+def unstack_channels(chnames, data, suffix=''):
+    """Split a (channels x samples) array back into a dict of channels.
+
+    suffix is appended to each channel name.
+    """
+    return {chname + suffix: chdata for chname, chdata in zip(chnames, data)}
+
+
+def highpass(data, rate, cutoff, order, axis=-1):
+    """Zero-phase Butterworth highpass filter along axis"""
+    sos = _butter_sos(rate, cutoff, order, 'high')
+    return scipy.signal.sosfiltfilt(sos, data, axis=axis)
+
+
+def lowpass(data, rate, cutoff, order, axis=-1):
+    """Zero-phase Butterworth lowpass filter along axis"""
+    sos = _butter_sos(rate, cutoff, order, 'low')
+    return scipy.signal.sosfiltfilt(sos, data, axis=axis)
+
+
+def rectify(data):
+    """Full-wave rectification. Operates in place and returns data."""
+    return np.abs(data, out=data)
+
+
+def rms(data, win, axis=-1, mode='centered'):
+    """Sliding window RMS along axis.
+
+    Uses a running sum of squares, so the cost does not depend on the window
+    length. The sums are accumulated in float64 even for float32 data, to avoid
+    drift over long recordings; the result has the dtype of the (floating
+    point) input.
+
+    Parameters
+    ----------
+    data : ndarray
+        The data.
+    win : int
+        Window length in samples. Must be odd for centered windows.
+    axis : int
+        The axis to compute along.
+    mode : str
+        'centered' : the window is centered on each sample. The ends, where
+            the full window does not fit, are padded with the edge values.
+            This matches gaitutils.numutils.rms().
+        'causal' : the window ends at each sample. At the start, the window
+            covers all the preceding samples.
+
+    Returns
+    -------
+    ndarray
+        The RMS data, of the same shape as data.
+    """
+    data = np.asarray(data)
+    nsamples = data.shape[axis]
+    if not 1 <= win <= nsamples:
+        raise ValueError('Need 1 <= RMS window length <= data length')
+    if mode not in ('centered', 'causal'):
+        raise ValueError(f'Invalid RMS mode: {mode}')
+    if mode == 'centered' and win % 2 != 1:
+        raise ValueError('Need RMS window of odd length')
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+    data = np.moveaxis(data, axis, -1)
+    # running sum of squares, with a leading zero
+    csum = np.empty(data.shape[:-1] + (nsamples + 1,))
+    csum[..., 0] = 0
+    np.square(data, out=csum[..., 1:])
+    np.cumsum(csum[..., 1:], axis=-1, out=csum[..., 1:])
+    # RMS over full windows; clip the small negative values that may result
+    # from rounding
+    rms_ = csum[..., win:] - csum[..., :-win]
+    np.maximum(rms_, 0, out=rms_)
+    rms_ /= win
+    np.sqrt(rms_, out=rms_)
+    out = np.empty(data.shape, dtype=dtype)
+    if mode == 'centered':
+        padw = (win - 1) // 2
+        out[..., padw : nsamples - padw] = rms_
+        out[..., :padw] = rms_[..., :1]
+        out[..., nsamples - padw :] = rms_[..., -1:]
+    else:
+        # partial windows at the start
+        out[..., win - 1 :] = rms_
+        msq_start = np.maximum(csum[..., 1:win], 0) / np.arange(1, win)
+        out[..., : win - 1] = np.sqrt(msq_start)
+    return np.moveaxis(out, -1, axis)
+
+
+def _axis_shape(data, axis):
+    """Shape for broadcasting a 1-D array along axis of data"""
+    shape = [1] * data.ndim
+    shape[axis] = -1
+    return shape
+
+
+def _fix_length(data, nframes, axis):
+    """Crop or edge-pad data to nframes samples along axis"""
+    n = data.shape[axis]
+    if n > nframes:
+        return data.take(np.arange(nframes), axis=axis)
+    elif n < nframes:
+        padarg = [(0, 0)] * data.ndim
+        padarg[axis] = (0, nframes - n)
+        return np.pad(data, padarg, mode='edge')
+    return data
+
+
+def _interp_at(data, pos, axis):
+    """Linearly interpolate data at fractional sample positions along axis"""
+    nsamples = data.shape[axis]
+    i0 = np.minimum(np.floor(pos).astype(int), nsamples - 1)
+    i1 = np.minimum(i0 + 1, nsamples - 1)
+    frac = (pos - i0).reshape(_axis_shape(data, axis))
+    d0 = data.take(i0, axis=axis)
+    d1 = data.take(i1, axis=axis)
+    return d0 + (d1 - d0) * frac
+
+
+def _resample_polyphase(data, nframes, axis):
+    """Polyphase rational resampling.
+
+    If the ratio cannot be represented exactly by a fraction with a small
+    denominator, the data is resampled by the nearest such fraction, and the
+    result is then interpolated at the exact frame positions.
+    """
+    nsamples = data.shape[axis]
+    ratio_exact = Fraction(nframes, nsamples)
+    ratio = ratio_exact.limit_denominator(MAX_POLY_DENOM)
+    up, down = ratio.numerator, ratio.denominator
+    data_rs = scipy.signal.resample_poly(data, up, down, axis=axis, padtype='line')
+    if ratio == ratio_exact:
+        return _fix_length(data_rs, nframes, axis)
+    pos = np.arange(nframes) * nsamples / nframes * up / down
+    return _interp_at(data_rs, pos, axis)
+
+
+def _resample_decimate(data, nframes, axis):
+    """Pick samples at the frame positions, interpolating linearly.
+
+    For an integer ratio, this is plain decimation. There is no anti-aliasing
+    filter, so the data must already be lowpass filtered (e.g. linear envelope).
+    """
+    pos = np.arange(nframes) * data.shape[axis] / nframes
+    return _interp_at(data, pos, axis)
+
+
+def _resample_blockavg(data, nframes, axis):
+    """Average the samples in a block around each frame position.
+
+    Blocks are centered on the frame positions, so that the result is aligned
+    with the other methods. Non-integer ratios give blocks of varying length.
+    """
+    nsamples = data.shape[axis]
+    if nsamples < nframes:
+        raise ValueError('Block averaging cannot upsample')
+    ratio = nsamples / nframes
+    edges = np.floor((np.arange(nframes + 1) - 0.5) * ratio + 0.5).astype(int)
+    edges = np.clip(edges, 0, nsamples)
+    # reduceat sums the last block up to the end of data, so crop first
+    sl = [slice(None)] * data.ndim
+    sl[axis] = slice(0, edges[-1])
+    sums = np.add.reduceat(data[tuple(sl)], edges[:-1], axis=axis)
+    return sums / np.diff(edges).reshape(_axis_shape(data, axis))
+
+
+def resample(data, nframes, axis=-1, method='fft'):
+    """Resample data to nframes samples along axis.
+
+    Parameters
+    ----------
+    data : ndarray
+        The data.
+    nframes : int
+        Number of samples in the output.
+    axis : int
+        The axis to resample along.
+    method : str
+        One of RESAMPLE_METHODS:
+        'fft' : FFT-based resampling (scipy.signal.resample).
+        'polyphase' : polyphase rational resampling (scipy.signal.resample_poly).
+        'decimate' : pick samples at the frame positions. Only valid for data
+            that is already lowpass filtered.
+        'blockavg' : average samples over a block around each frame.
+
+    Returns
+    -------
+    ndarray
+        The resampled data.
+    """
+    if method == 'fft':
+        return scipy.signal.resample(data, nframes, axis=axis)
+    elif method == 'polyphase':
+        return _resample_polyphase(data, nframes, axis)
+    elif method == 'decimate':
+        return _resample_decimate(data, nframes, axis)
+    elif method == 'blockavg':
+        return _resample_blockavg(data, nframes, axis)
+    else:
+        raise ValueError(f'Invalid resampling method: {method}')
+
+
+def linear_envelope(data, rate, hpf, lpf, order, axis=-1):
+    """Compute the (non-downsampled) linear envelope.
+
+    The stages are: HPF, full-wave rectification and LPF.
+    """
+    data = highpass(data, rate, hpf, order, axis=axis)
+    data = rectify(data)
+    return lowpass(data, rate, lpf, order, axis=axis)
+
+
+def rms_envelope(data, rate, hpf, order, win, axis=-1, mode='centered'):
+    """Compute the (non-downsampled) RMS envelope.
+
+    The stages are: HPF and sliding window RMS.
+    """
+    data = highpass(data, rate, hpf, order, axis=axis)
+    return rms(data, win, axis=axis, mode=mode)
+
+
+def _poly_ratio(nsamples, nframes):
+    """Return (up, down) for polyphase resampling nsamples -> nframes"""
+    ratio = Fraction(nframes, nsamples).limit_denominator(MAX_POLY_DENOM)
+    return ratio.numerator, ratio.denominator
+
+
+def _iter_blocks(data, nframes, process, margin, method, block_frames):
+    """Process data in blocks and yield the downsampled result block by block.
+
+    Each block of block_frames output frames is computed from the
+    corresponding analog samples, extended by margin samples on both sides,
+    so that the zero-phase filters see enough data around the block. The
+    extended data is passed through process() and downsampled, and the
+    frames belonging to the block are yielded as (first frame, data) tuples.
+
+    At the trial edges, resample_poly() extends the data by a line through
+    the first and last samples of the whole trial. For the polyphase method,
+    these samples are computed up front and the edge blocks are extended
+    explicitly by the same line, so that the edges match the whole-trial
+    computation.
+    """
+    if method not in RESAMPLE_METHODS or method == 'fft':
+        raise ValueError(f'Invalid resampling method for streaming: {method}')
+    nsamples = data.shape[-1]
+    ratio = nsamples / nframes
+    up, down = _poly_ratio(nsamples, nframes)
+    if method == 'polyphase':
+        # half length of the resample_poly FIR filter, in input samples
+        poly_margin = int(np.ceil(10 * max(up, down) / up))
+        margin += poly_margin
+        # edge extension; its length is a multiple of down, to keep the
+        # output samples aligned
+        npad = int(np.ceil(poly_margin / down)) * down
+        first = process(np.asarray(data[..., : margin + 1], dtype=float))[..., :1]
+        last = process(np.asarray(data[..., -margin - 1 :], dtype=float))[..., -1:]
+        slope = (last - first) / max(nsamples - 1, 1)
+    for f0 in range(0, nframes, block_frames):
+        f1 = min(f0 + block_frames, nframes)
+        # extended sample range; start on a multiple of down, so that the
+        # polyphase output samples coincide with those of the whole trial
+        e0 = max(0, (int(np.floor(f0 * ratio)) - margin) // down * down)
+        e1 = min(nsamples, int(np.ceil(f1 * ratio)) + margin + 1)
+        block = process(np.asarray(data[..., e0:e1], dtype=float))
+        # frame positions relative to the extended block
+        pos = np.arange(f0, f1) * ratio - e0
+        if method == 'decimate':
+            yield f0, _interp_at(block, pos, -1)
+        elif method == 'polyphase':
+            pre = npad if e0 == 0 else 0
+            post = npad if e1 == nsamples else 0
+            block = np.concatenate(
+                [
+                    first + slope * np.arange(-pre, 0),
+                    block,
+                    last + slope * np.arange(1, post + 1),
+                ],
+                axis=-1,
+            )
+            block_rs = scipy.signal.resample_poly(
+                block, up, down, axis=-1, padtype='line'
+            )
+            yield f0, _interp_at(block_rs, (pos + pre) * up / down, -1)
+        elif method == 'blockavg':
+            edges = np.floor((np.arange(f0, f1 + 1) - 0.5) * ratio + 0.5).astype(int)
+            edges = np.clip(edges, 0, nsamples) - e0
+            sums = np.add.reduceat(block[..., : edges[-1]], edges[:-1], axis=-1)
+            yield f0, sums / np.diff(edges)
+
+
+def iter_linear_envelope(
+    data, rate, hpf, lpf, order, nframes, method='polyphase', block_frames=BLOCK_FRAMES
+):
+    """Streaming version of linear_envelope() followed by resample().
+
+    data is a (channels x samples) array; it may also be a np.memmap, in which
+    case only the samples needed for the current block are read. Yields
+    (first frame, block) tuples of downsampled envelope data, so that the
+    memory used by the filter intermediates depends on block_frames and not on
+    the length of the data. The 'fft' resampling method is not supported.
+
+    The blocks overlap by the length of the filter impulse responses, so the
+    result matches that of the whole-trial computation to within the filter
+    decay tolerance (STREAM_TOL), also at the trial edges. The zero-phase
+    filters cannot carry their state from one block to the next, since the
+    backward pass runs from the end of the data, so the overlap is used
+    instead.
+    """
+    margin = _filter_margin(rate, hpf, order, 'high')
+    margin += _filter_margin(rate, lpf, order, 'low')
+    process = functools.partial(
+        linear_envelope, rate=rate, hpf=hpf, lpf=lpf, order=order
+    )
+    yield from _iter_blocks(data, nframes, process, margin, method, block_frames)
+
+
+def iter_rms_envelope(
+    data, rate, hpf, order, win, nframes, method='polyphase', block_frames=BLOCK_FRAMES
+):
+    """Streaming version of rms_envelope() followed by resample().
+
+    See iter_linear_envelope() for details.
+    """
+    margin = _filter_margin(rate, hpf, order, 'high') + win // 2
+    process = functools.partial(rms_envelope, rate=rate, hpf=hpf, order=order, win=win)
+    yield from _iter_blocks(data, nframes, process, margin, method, block_frames)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+
+Streaming XLSX output for the EMG workbooks.
+
+Uses the write-only (streaming) mode of openpyxl. Rows are appended whole, all
+bold cells share a single font, and column widths are tracked as rows are
+appended. Since openpyxl writes the column widths before the rows, the rows of
+the current sheet are buffered until the next sheet is started (or the
+workbook is saved); only one sheet is held in memory at a time.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+
+# shared font for all bold cells
+BOLD = Font(bold=True)
+
+
+class _SheetBuffer:
+    """Rows and column widths for a sheet that has not been written yet"""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.rows = list()
+        self.widths = dict()
+
+    def append(self, row, bold_cols=()):
+        row = list(row)
+        for col, value in enumerate(row, 1):
+            # same rule as the old _auto_adjust(): size by str() of nonempty values
+            if value:
+                self.widths[col] = max(self.widths.get(col, 0), len(str(value)))
+        self.rows.append((row, frozenset(bold_cols)))
+
+    def flush(self):
+        """Write the buffered rows into the write-only sheet"""
+        for col, width in self.widths.items():
+            self.ws.column_dimensions[get_column_letter(col)].width = width
+        for row, bold_cols in self.rows:
+            if bold_cols:
+                row = [
+                    self._bold_cell(value) if k in bold_cols else value
+                    for k, value in enumerate(row)
+                ]
+            self.ws.append(row)
+        self.rows = list()
+
+    def _bold_cell(self, value):
+        cell = WriteOnlyCell(self.ws, value=value)
+        cell.font = BOLD
+        return cell
+
+
+class StreamingWorkbook:
+    """Write-only workbook that is written one sheet at a time.
+
+    Example:
+
+        wb = StreamingWorkbook()
+        wb.create_sheet('trial 1')
+        wb.append(['Trial name:', 'trial 1.c3d'], bold_cols=[0])
+        wb.save('out.xlsx')
+    """
+
+    def __init__(self):
+        self.wb = openpyxl.Workbook(write_only=True)
+        self._sheet = None
+
+    def create_sheet(self, title):
+        """Start a new sheet. Subsequent rows are appended into it."""
+        self._flush()
+        self._sheet = _SheetBuffer(self.wb.create_sheet(title=title))
+
+    def append(self, row, bold_cols=()):
+        """Append a row into the current sheet.
+
+        bold_cols gives the (0-based) indices of the cells to write in bold.
+        Use an empty row to skip a row.
+        """
+        if self._sheet is None:
+            raise RuntimeError('No sheet created yet')
+        self._sheet.append(row, bold_cols=bold_cols)
+
+    def _flush(self):
+        if self._sheet is not None:
+            self._sheet.flush()
+
+    def save(self, filename):
+        self._flush()
+        self._sheet = None
+        self.wb.save(filename)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+
+Index of the Eclipse (.enf) metadata of a session.
+
+Each eclipse.get_eclipse_keys() call parses the whole .enf file, and so does
+each sessionutils.get_c3ds() call that filters by trial type or tags. Scripts
+that look at the same trials several times (e.g. first by type, then by gait
+direction) thus parse the same files over and over. EnfIndex parses each .enf
+file of a session once into a table of records, which can then be queried:
+
+    index = EnfIndex(sessiondir)
+    for rec in index.query(trial_type='dynamic', direction='E'):
+        index.set_keys(rec.enffile, {'NOTES': 'E1'})
+    index.write()
+
+Key updates are collected by set_keys() and written by write(), with a single
+write per .enf file.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import logging
+from collections import namedtuple, defaultdict
+
+from gaitutils import eclipse, sessionutils
+
+logger = logging.getLogger(__name__)
+
+# gait directions, as the letters used in the autoprocessing descriptions
+DIRECTIONS = 'ET'
+# Eclipse keys stored in the records, and the corresponding record fields
+KEY_FIELDS = {'TYPE': 'trial_type', 'DESCRIPTION': 'description', 'NOTES': 'notes'}
+
+EnfRecord = namedtuple(
+    'EnfRecord',
+    [
+        'enffile',
+        'c3dfile',
+        'trial_type',
+        'description',
+        'notes',
+        'direction',
+        'fp_info',
+    ],
+)
+
+
+def gait_direction(description):
+    """Quick and dirty gait direction from the description, after autoprocessing.
+
+    XXX: fragile, relies on certain description string.
+    """
+    for dir in DIRECTIONS:
+        if dir in description:
+            return dir
+    return None
+
+
+class EnfIndex:
+    """Eclipse metadata of the trials of a session.
+
+    The records (EnfRecord instances) are in the records dict, keyed by .enf
+    file. The fp_info field has the Eclipse forceplate keys (e.g. {'FP1':
+    'Left'}).
+
+    Parameters
+    ----------
+    sessiondir : str | Path
+        The session directory.
+    """
+
+    def __init__(self, sessiondir):
+        self.sessiondir = sessiondir
+        self.records = dict()
+        for enffile in sessionutils.get_enfs(sessiondir):
+            keys = eclipse.get_eclipse_keys(enffile)
+            self.records[enffile] = EnfRecord(
+                enffile=enffile,
+                c3dfile=sessionutils.enf_to_trialfile(enffile, 'c3d'),
+                trial_type=keys['TYPE'],
+                description=keys['DESCRIPTION'],
+                notes=keys['NOTES'],
+                direction=gait_direction(keys['DESCRIPTION']),
+                fp_info=eclipse._eclipse_forceplate_keys(keys),
+            )
+        self._updates = defaultdict(dict)
+
+    def query(self, trial_type=None, direction=None, check_if_exists=True):
+        """Return the records for the given trial type and gait direction.
+
+        As in sessionutils, the trial type matches if it is contained in the
+        TYPE key (case insensitive). If check_if_exists, only trials whose c3d
+        files exist are returned. The records are in .enf file order.
+        """
+        return [
+            rec
+            for rec in self.records.values()
+            if (trial_type is None or trial_type.upper() in rec.trial_type.upper())
+            and (direction is None or rec.direction == direction)
+            and (not check_if_exists or rec.c3dfile.is_file())
+        ]
+
+    def set_keys(self, enffile, keys):
+        """Set Eclipse keys for a trial.
+
+        The record is updated immediately, but the .enf file only by write().
+        Existing keys are overwritten.
+        """
+        self._updates[enffile].update(keys)
+        fields = {KEY_FIELDS[k]: val for k, val in keys.items() if k in KEY_FIELDS}
+        if 'description' in fields:
+            fields['direction'] = gait_direction(fields['description'])
+        self.records[enffile] = self.records[enffile]._replace(**fields)
+
+    def write(self):
+        """Write the key updates into the .enf files"""
+        for enffile, keys in self._updates.items():
+            logger.debug(f'updating {enffile}: {keys}')
+            eclipse.set_eclipse_keys(enffile, keys, update_existing=True)
+        self._updates.clear()
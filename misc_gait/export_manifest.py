@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+
+Manifest of the trials included in an incremental export.
+
+The manifest is a JSON file that records, for each exported trial, the
+modification time, size and SHA1 hash of its files, together with whatever
+the exporter needs to know about the trial's contribution to the output
+(e.g. where its cycles are stored). On the next run, a trial is considered
+unchanged if the modification times and sizes of its files match. Only if
+they do not are the files hashed, so that e.g. files that were merely copied
+(new mtime, same content) are not exported again.
+
+The manifest also stores the export parameters. If they change, the
+manifest is discarded and everything is exported again.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import os
+import json
+import logging
+from pathlib import Path
+
+from trial_files import file_hash
+
+logger = logging.getLogger(__name__)
+
+# bump this to invalidate existing manifests, e.g. if the entry layout changes
+MANIFEST_VERSION = 1
+
+
+def _file_stat(fname):
+    """Return the (mtime, size) signature of a file, or None if it is missing"""
+    if fname is None or not os.path.isfile(fname):
+        return None
+    st = os.stat(fname)
+    return {'mtime': st.st_mtime, 'size': st.st_size}
+
+
+def file_signatures(files):
+    """Return the signatures (mtime, size and hash) of a trial's files.
+
+    files is a dict of file role (e.g. 'c3d') -> filename or None. Missing
+    files have a signature of None.
+    """
+    sigs = dict()
+    for role, fname in files.items():
+        sigs[role] = _file_stat(fname)
+        if sigs[role] is not None:
+            sigs[role]['sha1'] = file_hash(fname)
+    return sigs
+
+
+def _stat_only(sig):
+    return None if sig is None else {k: sig[k] for k in ('mtime', 'size')}
+
+
+def _hash(sig):
+    return None if sig is None else sig['sha1']
+
+
+class ExportManifest:
+    """Manifest of exported trials.
+
+    The trial entries are in the trials dict, keyed by trial (e.g. the path
+    of the c3d file relative to the export root). Each entry is a dict with
+    the key 'files' for the file signatures, and any other (JSON
+    serializable) keys the exporter wants to store. Other exporter state can
+    be kept in the state dict.
+
+    Parameters
+    ----------
+    fname : str | Path
+        The manifest file. It is created by save() if it does not exist.
+    params : dict
+        The export parameters (JSON serializable). If they do not match the
+        ones in an existing manifest, the manifest is started from scratch.
+    """
+
+    def __init__(self, fname, params=None):
+        self.fname = Path(fname)
+        self.params = params or dict()
+        self.trials = dict()
+        self.state = dict()
+        # whether the manifest was started from scratch
+        self.is_new = True
+        if not self.fname.is_file():
+            return
+        with open(self.fname, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != MANIFEST_VERSION or data.get('params') != self.params:
+            logger.warning(
+                f'export parameters changed, ignoring existing manifest {self.fname}'
+            )
+            return
+        self.trials = data['trials']
+        self.state = data['state']
+        self.is_new = False
+
+    def check(self, key, files):
+        """Check whether a trial is new, changed or unchanged.
+
+        files is a dict of file role -> filename, as for file_signatures().
+        Returns one of 'new', 'changed' or 'unchanged'. If the files of an
+        unchanged trial were touched but have the same content, their recorded
+        signatures are updated.
+        """
+        if (entry := self.trials.get(key)) is None:
+            return 'new'
+        recorded = entry['files']
+        if set(recorded) != set(files):
+            return 'changed'
+        stats = {role: _file_stat(fname) for role, fname in files.items()}
+        if all(stats[role] == _stat_only(recorded[role]) for role in files):
+            return 'unchanged'
+        sigs = file_signatures(files)
+        if all(_hash(sigs[role]) == _hash(recorded[role]) for role in files):
+            entry['files'] = sigs
+            return 'unchanged'
+        return 'changed'
+
+    def save(self):
+        """Write the manifest.
+
+        The manifest is first written into a temporary file, which then
+        replaces the old one, so an interrupted save leaves the old manifest
+        intact.
+        """
+        data = {
+            'version': MANIFEST_VERSION,
+            'params': self.params,
+            'trials': self.trials,
+            'state': self.state,
+        }
+        tmpname = self.fname.with_name(self.fname.name + '.tmp')
+        with open(tmpname, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmpname, self.fname)
@@ -24,15 +24,29 @@ from gaitutils import (
     nexus,
     cfg,
     autoprocess,
-    trial,
     videos,
     GaitDataError,
 )
 from gaitutils.report import web, pdf
 from ulstools.num import check_hetu
 
+import trial_prefetch
+import enf_index
+import trial_events
+import video_convert
+import verified_copy
+import offline_autoproc
+
 # how many trials to tag per context
 MAX_TAGS_PER_CONTEXT = 3
+# autoprocess from existing (reconstructed) c3d files in parallel, without
+# Nexus; see offline_autoproc.py
+OFFLINE_AUTOPROC = False
+# number of worker processes for offline autoprocessing (None for one per CPU
+# core). Use more than 1 only when running the cells in a console: this file
+# has no __main__ guard, so when it is run as a script, the worker processes
+# (spawned on Windows) would run it again, including the Nexus calls
+OFFLINE_AUTOPROC_WORKERS = 1
 # root dir for copy destination
 DEST_ROOT = Path(r'Y:\Userdata_Vicon_Server')
 # diag-specific subdirs
@@ -48,43 +62,25 @@ DIAGS_DIRS = {
 #logging.basicConfig(level=logging.DEBUG)
 
 
-def _count_fp_contacts(trial):
-    """Return n of valid forceplate contacts"""
-    return len(trial.fp_events['L_strikes']) + len(trial.fp_events['R_strikes'])
-
-
-def _gait_direction(enffile):
-    """Quick and dirty gait direction from enffile, after autoprocessing.
-
-    XXX: fragile, relies on certain description string.
-    """
-    keys = gaitutils.eclipse.get_eclipse_keys(enffile, 'Description')
-    thedesc = keys['DESCRIPTION']
-    for dir in 'ET':
-        if dir in thedesc:
-            return dir
-    return None
+def _count_fp_contacts(trial_ev):
+    """Return n of valid forceplate contacts (trial_ev is a TrialEvents view)"""
+    return sum(trial_ev.fp_contacts.values())
 
 
 def _autotag(sessiondir):
     """Automatically tag trials in a session dir"""
-    c3dfiles = gaitutils.sessionutils.get_c3ds(sessiondir, trial_type='dynamic')
-    trials = [trial.Trial(c3dfile) for c3dfile in c3dfiles]
-    enffiles = [tr.enfpath for tr in trials]
-
-    for direction in 'ET':
-        enfs_thisdir = [
-            (k, enffile)
-            for (k, enffile) in enumerate(enffiles)
-            if _gait_direction(enffile) == direction
+    index = enf_index.EnfIndex(sessiondir)
+    for direction in enf_index.DIRECTIONS:
+        records = index.query(trial_type='dynamic', direction=direction)
+        n_contacts = [
+            _count_fp_contacts(trial_events.get_trial_events(rec.c3dfile, rec.fp_info))
+            for rec in records
         ]
-        n_contacts = [_count_fp_contacts(trials[k]) for k, _ in enfs_thisdir]
         best_inds = np.argsort(-np.array(n_contacts))
-        bestfiles = [enfs_thisdir[k][1] for k in best_inds]
-        for k, enffile in enumerate(bestfiles[:MAX_TAGS_PER_CONTEXT], 1):
-            gaitutils.eclipse.set_eclipse_keys(
-                enffile, {'NOTES': direction + str(k)}, update_existing=True
-            )
+        for k, ind in enumerate(best_inds[:MAX_TAGS_PER_CONTEXT], 1):
+            index.set_keys(records[ind].enffile, {'NOTES': direction + str(k)})
+    # write all tags at once
+    index.write()
 
 
 def _get_patient_dir():
@@ -109,7 +105,11 @@ def _is_sessiondir(dir):
 def _run_postprocessing(c3dfiles):
     """Helper function that will be run in a separate thread"""
     nexus._close_trial()
-    for c3dfile in c3dfiles:
+    # read the files of the next trials on a background thread, so that they
+    # are in the OS file cache when Nexus opens them
+    for c3dfile, _ in trial_prefetch.prefetch(
+        c3dfiles, trial_prefetch.warm_trial_files
+    ):
         nexus._open_trial(c3dfile)
         nexus._run_pipelines(cfg.autoproc.postproc_pipelines)
 
@@ -168,9 +168,14 @@ else:
 
 # %%
 # 2: autoproc all
-for p in session_dirs:
-    enffiles = sessionutils.get_enfs(p)
-    autoprocess._do_autoproc(enffiles, pipelines_in_proc=False)
+if OFFLINE_AUTOPROC:
+    offline_autoproc.autoproc_sessions(
+        session_dirs, max_workers=OFFLINE_AUTOPROC_WORKERS
+    )
+else:
+    for p in session_dirs:
+        enffiles = sessionutils.get_enfs(p)
+        autoprocess._do_autoproc(enffiles, pipelines_in_proc=False)
 print('*** autoproc complete')
 
 
@@ -246,6 +251,18 @@ for d in session_dirs:
 # %%
 
 # 7: generate reports
+
+# convert the videos of all sessions in a single queue
+vidfiles = list()
+for sessiondir in session_dirs:
+    if not (
+        vids := videos._collect_session_videos(sessiondir, tags=cfg.eclipse.tags)
+    ):
+        raise RuntimeError(f'Cannot find any video files for session {sessiondir}')
+    vidfiles.extend(vids)
+if failed := video_convert.convert_videos(vidfiles):
+    print(f'WARNING: could not convert {len(failed)} video files')
+
 for sessiondir in session_dirs:
 
     info = {
@@ -254,28 +271,6 @@ for sessiondir in session_dirs:
         'session_description': session_desc[sessiondir],
     }
     sessionutils.save_info(sessiondir, info)
-    if not (
-        vidfiles := videos._collect_session_videos(sessiondir, tags=cfg.eclipse.tags)
-    ):
-        raise RuntimeError(f'Cannot find any video files for session {sessiondir}')
-
-    if not videos.convert_videos(vidfiles, check_only=True):
-        # need to convert
-        if not (procs := videos.convert_videos(vidfiles=vidfiles)):
-            raise RuntimeError('video converter processes could not be started')
-
-        # wait in a sleep loop until all converter processes have finished
-        completed = False
-        _n_complete = -1
-        while not completed:
-            n_complete = len([p for p in procs if p.poll() is not None])
-            prog_txt = f'Converting videos: {n_complete} of {len(procs)} files done'
-            if _n_complete != n_complete:
-                print(prog_txt)
-                _n_complete = n_complete
-            time.sleep(1)
-            completed = n_complete == len(procs)
-
     web.dash_report(sessions=[sessiondir], info=info, recreate_plots=True)
     pdf.create_report(sessiondir, info, write_extracted=True, write_timedist=True)
 
@@ -292,11 +287,11 @@ copy_done = False
 for sessiondir in session_dirs:
     destdir = destdir_patient / sessiondir.name
     print(f'copying {sessiondir} -> {destdir}...')
-    shutil.copytree(sessiondir, destdir)
-    assert destdir.is_dir()
+    # files are verified after copying; if interrupted, rerun to resume
+    n_copied, n_skipped = verified_copy.copy_tree(sessiondir, destdir)
+    print(f'{n_copied} files copied and verified, {n_skipped} already up to date')
 copy_done = True
 
-# FIXME: should assert that copy really worked?
 print('*** Finished copying')
 
 
@@ -312,25 +307,13 @@ if copy_done and ALLOW_DELETE:
 
 REDO_ALL = True  # force conversion even if target files exist
 
+vidfiles = list()
 for sessiondir in session_dirs:
-    vidfiles = videos._collect_session_videos(sessiondir, tags=cfg.eclipse.tags)
-    if not vidfiles:
+    vids = videos._collect_session_videos(sessiondir, tags=cfg.eclipse.tags)
+    if not vids:
         raise RuntimeError(f'Cannot find any video files for session {sessiondir}')
-
-    if REDO_ALL or not videos.convert_videos(vidfiles, check_only=True):
-        procs = videos.convert_videos(vidfiles=vidfiles)
-        if not procs:
-            raise RuntimeError('Video converter processes could not be started')
-        # wait in sleep loop until all converter processes have finished
-        completed = False
-        _n_complete = -1
-        while not completed:
-            n_complete = len([p for p in procs if p.poll() is not None])
-            prog_txt = f'Converting videos: {n_complete} of {len(procs)} files done'
-            if _n_complete != n_complete:
-                print(prog_txt)
-                _n_complete = n_complete
-            time.sleep(1)
-            completed = n_complete == len(procs)
+    vidfiles.extend(vids)
+if failed := video_convert.convert_videos(vidfiles, force=REDO_ALL):
+    print(f'WARNING: could not convert {len(failed)} video files')
 
 print('*** Finished video conversion')
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+
+Incremental writer for MAT v7.3 files.
+
+MAT v7.3 files are HDF5 files with a 512-byte MATLAB header in the HDF5 user
+block, and a MATLAB_class attribute on each variable. MATLAB stores arrays in
+column-major order, so a (npoints x ncycles) MATLAB matrix is an HDF5 dataset
+of shape (ncycles, npoints). Adding gait cycles to a variable thus means
+adding rows to its dataset, which is done by resizing it along the first axis.
+
+The datasets are chunked and compressed, so cycles can be appended trial by
+trial without keeping the data in memory, and the file can be reopened later
+to append more cycles. Cycles can also be deleted, e.g. to replace the
+cycles of a trial. The files can be read with load() in MATLAB, or with
+read() here.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import time
+import platform
+import logging
+import numpy as np
+import h5py
+
+logger = logging.getLogger(__name__)
+
+# size of the HDF5 user block reserved for the MATLAB header
+HEADER_SIZE = 512
+# number of cycles per HDF5 chunk
+CHUNK_CYCLES = 64
+COMPRESSION = 'gzip'
+COMPRESSION_LEVEL = 4
+
+
+def _write_header(fname):
+    """Write the MATLAB header into the user block of a closed HDF5 file"""
+    text = 'MATLAB 7.3 MAT-file, Platform: %s, Created on: %s HDF5 schema 1.00 .' % (
+        platform.system(),
+        time.strftime('%a %b %d %H:%M:%S %Y'),
+    )
+    # the text is padded with spaces up to 116 bytes; then follow the subsystem
+    # data offset (unused), the version (0x0200) and the endianness indicator
+    header = text.ljust(116).encode('ascii')
+    header += bytes(8) + b'\x00\x02IM'
+    with open(fname, 'r+b') as f:
+        f.write(header)
+
+
+class Mat73Writer:
+    """Append gait cycles to the variables of a MAT v7.3 file.
+
+    Can be used as a context manager, or call close() when done.
+
+    Parameters
+    ----------
+    fname : str
+        The filename.
+    mode : str
+        'w' to create a new file (an existing file is overwritten), or 'a' to
+        append to an existing file (it is created if it does not exist).
+    """
+
+    def __init__(self, fname, mode='a'):
+        self.fname = fname
+        if mode == 'a':
+            try:
+                self._file = h5py.File(fname, 'r+')
+            except FileNotFoundError:
+                mode = 'w'
+            else:
+                if self._file.userblock_size < HEADER_SIZE:
+                    self._file.close()
+                    raise ValueError('%s is not a MAT v7.3 file' % fname)
+        if mode == 'w':
+            h5py.File(fname, 'w', userblock_size=HEADER_SIZE).close()
+            _write_header(fname)
+            self._file = h5py.File(fname, 'r+')
+        elif mode != 'a':
+            raise ValueError('invalid mode %s' % mode)
+
+    def __contains__(self, var_name):
+        return var_name in self._file
+
+    def names(self):
+        """Return the variable names in the file"""
+        return list(self._file.keys())
+
+    def ncycles(self, var_name):
+        """Return the number of cycles stored for a variable"""
+        dset = self._file[var_name]
+        return 0 if 'MATLAB_empty' in dset.attrs else dset.shape[0]
+
+    def _create(self, var_name, npoints):
+        if var_name in self._file:
+            # an empty variable (see close())
+            del self._file[var_name]
+        dset = self._file.create_dataset(
+            var_name,
+            shape=(0, npoints),
+            maxshape=(None, npoints),
+            dtype=np.float64,
+            chunks=(CHUNK_CYCLES, npoints),
+            compression=COMPRESSION,
+            compression_opts=COMPRESSION_LEVEL,
+        )
+        dset.attrs['MATLAB_class'] = np.bytes_('double')
+        return dset
+
+    def append(self, var_name, data):
+        """Append cycles to a variable.
+
+        data is a (ncycles x npoints) array, as returned by collect_trial_data;
+        the variable is created if needed. In MATLAB, the variable will be a
+        (npoints x ncycles) matrix. Returns the index of the first appended
+        cycle.
+        """
+        data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+        if var_name in self._file and 'MATLAB_empty' not in self._file[var_name].attrs:
+            dset = self._file[var_name]
+            if dset.shape[1] != data.shape[1]:
+                raise ValueError(
+                    '%s has %d points per cycle, got %d'
+                    % (var_name, dset.shape[1], data.shape[1])
+                )
+        else:
+            dset = self._create(var_name, data.shape[1])
+        n0 = dset.shape[0]
+        dset.resize(n0 + data.shape[0], axis=0)
+        dset[n0:] = data
+        return n0
+
+    def delete_cycles(self, var_name, start, ncycles):
+        """Delete ncycles cycles of a variable, starting from index start.
+
+        The indices of all cycles after the deleted ones decrease by ncycles.
+        """
+        self.delete_ranges(var_name, [(start, ncycles)])
+
+    def delete_ranges(self, var_name, ranges):
+        """Delete several ranges of cycles of a variable.
+
+        ranges is an iterable of non-overlapping (start, ncycles) tuples. The
+        remaining cycles are moved back chunk by chunk in a single pass, so
+        each cycle is moved at most once.
+        """
+        ranges = sorted((start, ncycles) for start, ncycles in ranges if ncycles > 0)
+        if not ranges:
+            return
+        dset = self._file[var_name]
+        n = self.ncycles(var_name)
+        # the ranges of cycles to keep after the first deleted one
+        keep = list()
+        end = max(ranges[0][0], 0)
+        for start, ncycles in ranges:
+            if start < end or start + ncycles > n:
+                raise ValueError(
+                    'cannot delete cycles %d-%d of %d' % (start, start + ncycles, n)
+                )
+            keep.append((end, start))
+            end = start + ncycles
+        keep.append((end, n))
+        dest = ranges[0][0]
+        for k0, k1 in keep:
+            for k in range(k0, k1, CHUNK_CYCLES):
+                block = dset[k : min(k + CHUNK_CYCLES, k1)]
+                dset[dest : dest + len(block)] = block
+                dest += len(block)
+        dset.resize(dest, axis=0)
+
+    def truncate(self, var_name, ncycles):
+        """Keep only the first ncycles cycles of a variable"""
+        if ncycles < self.ncycles(var_name):
+            self._file[var_name].resize(ncycles, axis=0)
+
+    def delete(self, var_name):
+        """Delete a variable"""
+        del self._file[var_name]
+
+    def read(self, var_name):
+        """Return a variable as a (npoints x ncycles) array"""
+        dset = self._file[var_name]
+        if 'MATLAB_empty' in dset.attrs:
+            return np.zeros(tuple(dset[...].astype(int)))
+        return dset[...].T
+
+    def flush(self):
+        """Write buffered data to disk"""
+        self._file.flush()
+
+    def close(self):
+        """Close the file.
+
+        MATLAB does not read zero-size datasets, so variables without cycles
+        are stored as MATLAB empty arrays (their dimensions, with the
+        MATLAB_empty attribute set).
+        """
+        for var_name, dset in list(self._file.items()):
+            if dset.shape[0] == 0 and 'MATLAB_empty' not in dset.attrs:
+                npoints = dset.shape[1]
+                del self._file[var_name]
+                dims = np.array([npoints, 0], dtype=np.uint64)
+                dset = self._file.create_dataset(var_name, data=dims)
+                dset.attrs['MATLAB_class'] = np.bytes_('double')
+                dset.attrs['MATLAB_empty'] = np.uint8(1)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
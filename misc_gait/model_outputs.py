@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+
+In-process store for Nexus model outputs.
+
+Every Nexus API call is a round trip to the Nexus process, so reading back a
+model output that was just computed is much slower than keeping the array
+around. ModelOutputStore keeps the model outputs of the current trial in
+memory: set() stores an array locally and get() returns it without touching
+Nexus. Outputs that have not been set are read from Nexus once and then kept.
+The new or changed outputs are written into Nexus with a single flush() per
+trial.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ModelOutputStore:
+    """Model outputs of a subject in the currently open Nexus trial.
+
+    Parameters
+    ----------
+    vicon : ViconNexus
+        The Nexus SDK object.
+    subject : str
+        The subject name.
+    """
+
+    def __init__(self, vicon, subject):
+        self.vicon = vicon
+        self.subject = subject
+        self._data = dict()
+        # frames where the outputs exist (None for all frames)
+        self._exists = dict()
+        # outputs waiting to be written: name -> (group, components, types)
+        self._dirty = dict()
+
+    def set(
+        self,
+        name,
+        data,
+        group='EMG',
+        components=('EMG',),
+        types=('Electric Potential',),
+        exists=None,
+    ):
+        """Store a model output. It is written into Nexus on flush().
+
+        group, components and types are used to create the model output in
+        Nexus, if it does not exist yet. exists is a boolean array that marks
+        the frames where the data is valid; by default, all frames are.
+        """
+        self._data[name] = np.asarray(data)
+        self._exists[name] = None if exists is None else np.asarray(exists, bool)
+        self._dirty[name] = (group, list(components), list(types))
+
+    def get(self, name):
+        """Return a model output, or None if it does not exist.
+
+        Outputs that have not been set are read from Nexus on first access.
+        """
+        if name not in self._data:
+            nums, _ = self.vicon.GetModelOutput(self.subject, name)
+            if not nums:
+                logger.info('cannot read model variable %s' % name)
+                return None
+            self._data[name] = np.squeeze(np.array(nums))
+        return self._data[name]
+
+    def names(self):
+        """Names of the outputs held in the store"""
+        return list(self._data)
+
+    def flush(self):
+        """Write all new or changed outputs into Nexus"""
+        if not self._dirty:
+            return
+        existing_outputs = set(self.vicon.GetModelOutputNames(self.subject))
+        for name, (group, components, types) in self._dirty.items():
+            if name not in existing_outputs:
+                logger.debug('creating model output %s' % name)
+                self.vicon.CreateModelOutput(
+                    self.subject, name, group, components, types
+                )
+            data = self._data[name]
+            exists = self._exists.get(name)
+            if exists is None:
+                exists = [True] * data.shape[-1]
+            else:
+                exists = exists.tolist()
+            logger.debug('writing data for %s' % name)
+            self.vicon.SetModelOutput(self.subject, name, [data], exists)
+        self._dirty.clear()
+
+    def clear(self):
+        """Drop all outputs, e.g. when another trial is opened.
+
+        Unflushed outputs are lost.
+        """
+        self._data.clear()
+        self._exists.clear()
+        self._dirty.clear()
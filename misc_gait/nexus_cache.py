@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+
+Session-scoped cache for Nexus metadata.
+
+Reading device tables, subject names and model output names from Nexus takes
+an SDK round trip per call, and gaitutils repeats these calls for every trial
+(e.g. nexus._get_metadata() and nexus._get_emg_data() call GetDeviceDetails for
+every device). Within a session, the answers do not change as long as the
+device and subject configuration stays the same.
+
+NexusMetadataCache wraps the metadata methods of a ViconNexus object, so that
+each distinct call is made only once. The methods are wrapped on the instance
+itself, so gaitutils (which uses the same global SDK object) benefits as well.
+Whenever a trial is opened, the device IDs, the device details (which include
+the device rates and outputs), the frame rate and the subject names are
+fetched again and compared with the cached ones; only if they differ (i.e.
+the trial has a different configuration) is the cache invalidated.
+
+Model outputs are stored with the trial data, and the labeled markers may
+differ between trials, so the lists of model output and marker names are
+cached for the current trial only. Outputs created with
+CreateModelOutput are added to the cached list, so it stays valid without
+fetching it again.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# SDK calls whose results only depend on the session configuration
+CACHED_CALLS = [
+    'GetDeviceIDs',
+    'GetDeviceDetails',
+    'GetDeviceOutputDetails',
+    'GetDeviceOutputIDFromName',
+    'GetDeviceChannelIDFromName',
+    'GetSubjectNames',
+    'GetSubjectParamNames',
+    'GetFrameRate',
+]
+# SDK calls whose results depend on the trial
+TRIAL_CALLS = ['GetModelOutputNames', 'GetMarkerNames']
+# calls that identify the configuration; checked whenever a trial is opened,
+# together with GetDeviceDetails for each device
+CONFIG_CALLS = ['GetDeviceIDs', 'GetFrameRate', 'GetSubjectNames']
+
+
+class NexusMetadataCache:
+    """Cache the metadata calls of a ViconNexus object.
+
+    Can be used as a context manager, or call stop() to remove the wrappers.
+
+    Parameters
+    ----------
+    vicon : ViconNexus
+        The SDK object. Its methods are wrapped in place.
+    """
+
+    def __init__(self, vicon):
+        self.vicon = vicon
+        self.hits = 0
+        self.misses = 0
+        self._cache = dict()
+        # name -> (original method, whether it was an instance attribute)
+        self._originals = dict()
+        for name in CACHED_CALLS + TRIAL_CALLS:
+            self._wrap(name, self._cached_call(name))
+        self._wrap('OpenTrial', self._open_trial)
+        self._wrap('CreateModelOutput', self._create_model_output)
+
+    def _wrap(self, name, wrapper):
+        self._originals[name] = (getattr(self.vicon, name), name in vars(self.vicon))
+        setattr(self.vicon, name, wrapper)
+
+    def _call(self, name, *args):
+        """Call the original (uncached) method"""
+        return self._originals[name][0](*args)
+
+    def _cached_call(self, name):
+        def wrapper(*args):
+            key = (name, args)
+            if key in self._cache:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._cache[key] = self._call(name, *args)
+            return self._cache[key]
+
+        wrapper.__name__ = name
+        return wrapper
+
+    def _open_trial(self, *args):
+        """Open a trial and invalidate the cache if the configuration changed"""
+        result = self._call('OpenTrial', *args)
+        config = self._config()
+        if any(self._cache.get(key, val) != val for key, val in config.items()):
+            logger.debug('trial configuration changed, invalidating metadata cache')
+            self.invalidate()
+        else:
+            for key in [key for key in self._cache if key[0] in TRIAL_CALLS]:
+                del self._cache[key]
+        self._cache.update(config)
+        return result
+
+    def _config(self):
+        """Fetch the results that identify the configuration, keyed as in the cache"""
+        config = {(name, ()): self._call(name) for name in CONFIG_CALLS}
+        for devid in config[('GetDeviceIDs', ())]:
+            details = self._call('GetDeviceDetails', devid)
+            config[('GetDeviceDetails', (devid,))] = details
+        return config
+
+    def _create_model_output(self, subject, name, *args):
+        """Create a model output and add it to the cached output names"""
+        result = self._call('CreateModelOutput', subject, name, *args)
+        key = ('GetModelOutputNames', (subject,))
+        if key in self._cache and name not in self._cache[key]:
+            self._cache[key] = list(self._cache[key]) + [name]
+        return result
+
+    def invalidate(self):
+        """Drop all cached results"""
+        self._cache.clear()
+
+    def stop(self):
+        """Restore the original methods"""
+        for name, (method, is_instance_attr) in self._originals.items():
+            if is_instance_attr:  # e.g. wrapped by nexus_offline.NexusRecorder
+                setattr(self.vicon, name, method)
+            else:
+                delattr(self.vicon, name)
+        self._originals = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
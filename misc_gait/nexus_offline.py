@@ -0,0 +1,643 @@
+# -*- coding: utf-8 -*-
+"""
+
+Offline stand-in for the Vicon Nexus SDK (ViconNexus object).
+
+The Nexus-bound scripts (rectify_emg.py, derive_marker.py,
+flip_toeoff_context.py, cenni_emg.py, rigid_body_extrapolate.py) get their data
+through gaitutils.nexus, which talks to a running Nexus. This module provides:
+
+ViconNexus : implements the subset of the SDK calls that the scripts and
+    gaitutils.nexus use, backed by c3d files (read and written with ezc3d).
+    OpenTrial() loads a c3d file, Set* calls modify the data in memory and
+    SaveTrial() writes the c3d file back.
+
+NexusRecorder : wraps the methods of a real ViconNexus object and records all
+    calls and their results, so that a live session can be replayed later with
+    ViconNexus.from_recording().
+
+patch_gaitutils() : context manager that makes gaitutils.nexus use a given SDK
+    object without checking for a running Nexus process.
+
+The module can also be used to run a script offline, e.g.
+
+python nexus_offline.py derive_marker.py --trial C:\\data\\session\\trial01.c3d
+python nexus_offline.py rectify_emg.py --replay session.pkl
+python nexus_offline.py rectify_emg.py --record session.pkl  (needs Nexus)
+
+Each instance counts its SDK calls in the calls attribute, which is useful for
+profiling the number of Nexus round trips of a script.
+
+Limitations: device channels are derived from the c3d analog channels,
+assuming Nexus-style labels ('Output.Channel') and descriptions ('Device -
+Output'). Forceplate geometry is not provided (GetDeviceDetails returns None
+for the forceplate info) and pipelines cannot be run.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import os
+import sys
+import runpy
+import pickle
+import hashlib
+import logging
+import argparse
+import contextlib
+import functools
+from pathlib import Path
+from collections import Counter, defaultdict
+import numpy as np
+import ezc3d
+
+from gaitutils import nexus
+from gaitutils.envutils import GaitDataError
+
+logger = logging.getLogger(__name__)
+
+# what GetServerInfo() returns: server name, major and minor version
+SERVER_INFO = ('Nexus', 2, 12)
+# POINT parameters that list model outputs (instead of markers)
+MODEL_OUTPUT_GROUPS = ['ANGLES', 'FORCES', 'MOMENTS', 'POWERS', 'SCALARS']
+# c3d units -> Nexus units
+UNITS = {'V': 'volt', 'mV': 'millivolt', 'N': 'newton', 'Nmm': 'newton millimeter'}
+# output names of forceplate devices
+FORCEPLATE_OUTPUTS = ['Force', 'Moment', 'CoP']
+# defaults of the per-event EVENT parameters for new events; the icon ids are
+# those used by Nexus
+EVENT_DEFAULTS = {'DESCRIPTIONS': '', 'SUBJECTS': '', 'ICON_IDS': 0, 'GENERIC_FLAGS': 0}
+EVENT_ICON_IDS = {'Foot Strike': 1, 'Foot Off': 2}
+# suffix for the temporary file written by SaveTrial() (before the extension,
+# since ezc3d requires a .c3d extension)
+TMP_SUFFIX = '.tmp'
+# SDK calls that only change the state; when replaying, unrecorded calls of
+# these are ignored (if no c3d trial is open)
+WRITE_PREFIXES = ('Set', 'Create', 'Clear', 'Save', 'Close', 'Open', 'Run')
+
+
+def _arg_key(arg):
+    """Hashable key for an SDK call argument"""
+    if isinstance(arg, (np.ndarray, list, tuple)) and len(arg) > 8:
+        return hashlib.sha1(np.asarray(arg).tobytes()).hexdigest()
+    elif isinstance(arg, (np.ndarray, list, tuple, set)):
+        return tuple(_arg_key(a) for a in arg)
+    return arg
+
+
+def _call_key(name, args):
+    """Key for matching recorded SDK calls"""
+    return name, tuple(_arg_key(arg) for arg in args)
+
+
+def _sdk_call(method):
+    """Decorator for the SDK methods: count the call and replay if recorded"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        name = method.__name__
+        self.calls[name] += 1
+        if self._replay is not None:
+            results = self._replay.get(_call_key(name, args))
+            if results:
+                # consume the recorded results in order, reuse the last one
+                return results.pop(0) if len(results) > 1 else results[0]
+            if self._trial is None:
+                if name.startswith(WRITE_PREFIXES):
+                    logger.debug(f'ignoring unrecorded call {name}')
+                    return None
+                raise GaitDataError(f'call not found in recording: {name}{args}')
+        return method(self, *args)
+
+    return wrapper
+
+
+class _C3DTrial:
+    """The data of a trial, read from a c3d file"""
+
+    def __init__(self, trialpath):
+        self.trialpath = Path(trialpath).with_suffix('')
+        self.c3d = ezc3d.c3d(str(self.trialpath.with_suffix('.c3d')))
+        params = self.c3d['parameters']
+        self.framerate = float(params['POINT']['RATE']['value'][0])
+        self.first_frame = self.c3d['header']['points']['first_frame']
+        self.nframes = self.c3d['data']['points'].shape[2]
+        try:
+            self.subject = params['SUBJECTS']['NAMES']['value'][0]
+        except KeyError:
+            self.subject = None
+        self.subject_params = {
+            name: float(np.squeeze(par['value']))
+            for name, par in params.get('PROCESSING', {}).items()
+            if name != '__METADATA__' and np.size(par['value']) == 1
+        }
+        # points: markers and model outputs, as (3 x nframes) arrays
+        labels = params['POINT']['LABELS']['value']
+        # keep the original labels for writing
+        self.labels = {self._strip_subject(lbl): lbl for lbl in labels}
+        self.points = dict(
+            zip(self.labels, self.c3d['data']['points'][:3].transpose(1, 0, 2))
+        )
+        # residuals and camera masks, kept for writing
+        meta_points = self.c3d['data']['meta_points']
+        self.residuals = dict(zip(self.labels, meta_points['residuals'][0]))
+        self.camera_masks = dict(
+            zip(self.labels, meta_points['camera_masks'].transpose(1, 0, 2))
+        )
+        self.model_outputs = {
+            self._strip_subject(lbl)
+            for group in MODEL_OUTPUT_GROUPS
+            if group in params['POINT']
+            for lbl in params['POINT'][group]['value']
+        }
+        self.events = self._read_events(params)
+        self.analogs = self.c3d['data']['analogs'][0]
+        self.analograte = float(params['ANALOG']['RATE']['value'][0])
+        self.devices = self._read_devices(params['ANALOG'])
+        self.modified = False
+
+    def _strip_subject(self, label):
+        """Strip the subject prefix that Nexus inserts for multiple subjects"""
+        return label.split(':', 1)[-1]
+
+    def _read_events(self, params):
+        """Return events as a list of (context, label, Nexus frame) tuples"""
+        if 'EVENT' not in params or not params['EVENT']['USED']['value'][0]:
+            return list()
+        ev = params['EVENT']
+        minutes, seconds = ev['TIMES']['value']
+        # Nexus frames are 1-based from the start of the trial data
+        frames = np.round((60 * minutes + seconds) * self.framerate).astype(int)
+        frames = frames - self.first_frame + 1
+        contexts, labels = ev['CONTEXTS']['value'], ev['LABELS']['value']
+        return list(zip(contexts, labels, frames.tolist()))
+
+    def _read_devices(self, analog):
+        """Group the analog channels into devices and outputs.
+
+        Returns a list of (name, type, outputs) tuples, where outputs is a list
+        of (name, unit, channel names, channel indices) tuples.
+        """
+        labels = analog['LABELS']['value']
+        descs = analog['DESCRIPTIONS']['value'] if 'DESCRIPTIONS' in analog else []
+        units = analog['UNITS']['value'] if 'UNITS' in analog else []
+        outputs = defaultdict(lambda: defaultdict(list))
+        for ind, label in enumerate(labels):
+            desc = descs[ind] if ind < len(descs) else ''
+            devname = desc.split(' - ')[0].strip() or 'Analog'
+            outname, _, chname = label.rpartition('.')
+            unit = units[ind] if ind < len(units) else ''
+            outputs[devname][(outname or 'Voltage', UNITS.get(unit, unit))].append(
+                (chname, ind)
+            )
+        devices = list()
+        for devname, devoutputs in outputs.items():
+            is_fp = any(outname in FORCEPLATE_OUTPUTS for outname, _ in devoutputs)
+            devices.append(
+                (
+                    devname,
+                    'ForcePlate' if is_fp else 'Other',
+                    [
+                        (outname, unit, [ch[0] for ch in chs], [ch[1] for ch in chs])
+                        for (outname, unit), chs in devoutputs.items()
+                    ],
+                )
+            )
+        return devices
+
+    def _point_params(self, names):
+        """Return POINT parameters for the given point names.
+
+        Returns a dict of LABELS, DESCRIPTIONS and (if there are new model
+        outputs) SCALARS. Existing points keep their labels and descriptions,
+        and new model outputs are appended to the SCALARS list.
+        """
+        point = self.c3d['parameters']['POINT']
+        old_labels = list(point['LABELS']['value'])
+        old_descs = dict.fromkeys(old_labels, '')
+        if 'DESCRIPTIONS' in point:
+            old_descs.update(zip(old_labels, point['DESCRIPTIONS']['value']))
+        labels = [self.labels.setdefault(name, name) for name in names]
+        params = {
+            'LABELS': labels,
+            'DESCRIPTIONS': [old_descs.get(label, '') for label in labels],
+        }
+        listed = {
+            self._strip_subject(lbl)
+            for group in MODEL_OUTPUT_GROUPS
+            if group in point
+            for lbl in point[group]['value']
+        }
+        if new_outputs := sorted(self.model_outputs - listed):
+            scalars = list(point['SCALARS']['value']) if 'SCALARS' in point else []
+            params['SCALARS'] = scalars + [self.labels[name] for name in new_outputs]
+        return params
+
+    def _event_params(self):
+        """Return the EVENT parameters for the current events.
+
+        The other per-event parameters (e.g. SUBJECTS, ICON_IDS) are resized
+        together with the events; events that were read from the file keep
+        their values, and new events get defaults.
+        """
+        params = self.c3d['parameters']
+        old_events = self._read_events(params)
+        group = params.get('EVENT', {})
+        # per-event parameters of the file
+        per_event = {
+            name: np.ravel(par['value']).tolist()
+            for name, par in group.items()
+            if name not in ('__METADATA__', 'USED', 'CONTEXTS', 'LABELS', 'TIMES')
+            and np.ndim(par['value']) == 1
+            and len(par['value']) == len(old_events)
+        }
+        old_inds = defaultdict(list)
+        for ind, ev in enumerate(old_events):
+            old_inds[ev].append(ind)
+        defaults = dict(EVENT_DEFAULTS, SUBJECTS=self.subject or '')
+        values = {name: list() for name in set(per_event) | set(defaults)}
+        for ev in self.events:
+            ind = old_inds[ev].pop(0) if old_inds[ev] else None
+            for name, vals in values.items():
+                if ind is not None and name in per_event:
+                    vals.append(per_event[name][ind])
+                elif name == 'ICON_IDS':
+                    vals.append(EVENT_ICON_IDS.get(ev[1], defaults[name]))
+                else:
+                    vals.append(defaults.get(name, ''))
+        times = (
+            np.array([frame for _, _, frame in self.events]) + self.first_frame - 1
+        ) / self.framerate
+        values.update(
+            {
+                'USED': len(self.events),
+                'CONTEXTS': [ev[0] for ev in self.events],
+                'LABELS': [ev[1] for ev in self.events],
+                'TIMES': np.array([times // 60, times % 60]),
+            }
+        )
+        return values
+
+    def save(self):
+        """Write points and events back into the c3d file.
+
+        The other data of the file (e.g. analog data, parameters, and the
+        residuals and camera masks of the existing points) is kept. Frames
+        with missing (NaN) data get a residual of -1, so that they are read as
+        gaps. The file is first written into a temporary file, which then
+        replaces the original.
+        """
+        c3d = self.c3d
+        names = list(self.points)
+        points = np.ones((4, len(names), self.nframes))
+        points[:3] = np.array([self.points[name] for name in names]).transpose(1, 0, 2)
+        valid = ~np.any(np.isnan(points[:3]), axis=0)
+        residuals = np.array(
+            [self.residuals.get(name, np.zeros(self.nframes)) for name in names]
+        )
+        # gap filled frames need a valid residual
+        residuals[valid & (residuals < 0)] = 0
+        residuals[~valid] = -1
+        nmasks = c3d['data']['meta_points']['camera_masks'].shape[0]
+        camera_masks = np.array(
+            [
+                self.camera_masks.get(name, np.zeros((nmasks, self.nframes), bool))
+                for name in names
+            ]
+        ).transpose(1, 0, 2)
+        c3d['data']['points'] = points
+        c3d['data']['meta_points']['residuals'] = residuals[np.newaxis]
+        c3d['data']['meta_points']['camera_masks'] = camera_masks
+        for name, value in self._point_params(names).items():
+            c3d.add_parameter('POINT', name, value)
+        c3d.add_parameter('POINT', 'USED', len(names))
+        for name, value in self._event_params().items():
+            c3d.add_parameter('EVENT', name, value)
+        c3dfile = self.trialpath.with_suffix('.c3d')
+        tmpfile = c3dfile.with_name(c3dfile.stem + TMP_SUFFIX + c3dfile.suffix)
+        try:
+            c3d.write(str(tmpfile))
+            os.replace(tmpfile, c3dfile)
+        finally:
+            if tmpfile.exists():
+                tmpfile.unlink()
+        self.modified = False
+
+
+class ViconNexus:
+    """Offline stand-in for the ViconNexus SDK object, backed by c3d files.
+
+    The class name must be ViconNexus, since gaitutils identifies SDK objects by
+    the class name.
+
+    Parameters
+    ----------
+    trialpath : str | Path | None
+        A c3d file to open initially (with or without the extension).
+    subject : str | None
+        The subject name to use if the c3d file does not define one.
+    """
+
+    def __init__(self, trialpath=None, subject='Subject'):
+        self.calls = Counter()
+        self.default_subject = subject
+        self._trial = None
+        self._replay = None
+        if trialpath is not None:
+            self.OpenTrial(str(Path(trialpath).with_suffix('')), 0)
+
+    @classmethod
+    def from_recording(cls, fname, trialpath=None, subject='Subject'):
+        """Create an instance that replays calls recorded by NexusRecorder.
+
+        Calls that are not in the recording are answered from the open c3d
+        trial, if any.
+        """
+        instance = cls(trialpath, subject)
+        with open(fname, 'rb') as f:
+            recorded = pickle.load(f)
+        instance._replay = defaultdict(list)
+        for name, key, result in recorded:
+            instance._replay[(name, key)].append(result)
+        return instance
+
+    def __getattr__(self, name):
+        # recorded SDK calls that are not implemented by this class
+        if name[:1].isupper() and self.__dict__.get('_replay') is not None:
+
+            def _not_implemented(self, *args):
+                raise GaitDataError(f'call not found in recording: {name}{args}')
+
+            _not_implemented.__name__ = name
+            return _sdk_call(_not_implemented).__get__(self)
+        raise AttributeError(name)
+
+    @property
+    def trial(self):
+        if self._trial is None:
+            raise GaitDataError('No trial loaded')
+        return self._trial
+
+    def _subject(self):
+        return self.trial.subject or self.default_subject
+
+    def _device(self, devid):
+        try:
+            return self.trial.devices[devid - 1]
+        except IndexError:
+            raise GaitDataError(f'Invalid device id {devid}')
+
+    # trials and subjects
+
+    @_sdk_call
+    def GetServerInfo(self):
+        return SERVER_INFO
+
+    @_sdk_call
+    def OpenTrial(self, trialpath, timeout):
+        if self._trial is not None and self._trial.modified:
+            logger.warning('discarding unsaved changes to %s' % self._trial.trialpath)
+        logger.debug(f'opening {trialpath}')
+        self._trial = _C3DTrial(trialpath)
+
+    @_sdk_call
+    def CloseTrial(self, timeout):
+        self._trial = None
+
+    @_sdk_call
+    def SaveTrial(self, timeout):
+        self.trial.save()
+
+    @_sdk_call
+    def GetTrialName(self):
+        trialpath = self.trial.trialpath
+        return str(trialpath.parent) + os.sep, trialpath.name
+
+    @_sdk_call
+    def GetSubjectNames(self):
+        return [self._subject()]
+
+    @_sdk_call
+    def GetSubjectParamNames(self, subject):
+        return list(self.trial.subject_params)
+
+    @_sdk_call
+    def GetSubjectParam(self, subject, param):
+        value = self.trial.subject_params.get(param)
+        return (value, True) if value is not None else (0.0, False)
+
+    @_sdk_call
+    def GetFrameCount(self):
+        return self.trial.nframes
+
+    @_sdk_call
+    def GetFrameRate(self):
+        return self.trial.framerate
+
+    @_sdk_call
+    def RunPipeline(self, pipeline, location, timeout):
+        logger.warning(f'cannot run pipeline {pipeline} offline, skipping')
+
+    # markers and model outputs
+
+    @_sdk_call
+    def GetMarkerNames(self, subject):
+        return [p for p in self.trial.points if p not in self.trial.model_outputs]
+
+    @_sdk_call
+    def HasTrajectory(self, subject, marker):
+        data = self.trial.points.get(marker)
+        return data is not None and not np.all(np.isnan(data))
+
+    @_sdk_call
+    def GetTrajectory(self, subject, marker):
+        data = self.trial.points.get(marker)
+        if data is None or marker in self.trial.model_outputs:
+            return [], [], [], []
+        exists = ~np.any(np.isnan(data), axis=0)
+        x, y, z = np.where(exists, data, 0).tolist()
+        return x, y, z, exists.tolist()
+
+    @_sdk_call
+    def SetTrajectory(self, subject, marker, x, y, z, exists):
+        data = np.array([x, y, z], dtype=float)
+        data[:, ~np.asarray(exists, dtype=bool)] = np.nan
+        self.trial.points[marker] = data
+        self.trial.modified = True
+
+    @_sdk_call
+    def GetModelOutputNames(self, subject):
+        return sorted(self.trial.model_outputs)
+
+    @_sdk_call
+    def CreateModelOutput(self, subject, name, group, components, types):
+        self.trial.model_outputs.add(name)
+        self.trial.points.setdefault(name, np.full((3, self.trial.nframes), np.nan))
+        self.trial.modified = True
+
+    @_sdk_call
+    def GetModelOutput(self, subject, name):
+        if name not in self.trial.model_outputs:
+            return [], []
+        data = self.trial.points[name]
+        exists = ~np.any(np.isnan(data), axis=0)
+        return np.where(exists, data, 0).tolist(), exists.tolist()
+
+    @_sdk_call
+    def SetModelOutput(self, subject, name, data, exists):
+        if name not in self.trial.model_outputs:
+            raise GaitDataError(f'Model output {name} has not been created')
+        data = np.array(data, dtype=float).reshape(-1, self.trial.nframes)[:3]
+        out = np.zeros((3, self.trial.nframes))
+        out[: data.shape[0]] = data
+        out[:, ~np.asarray(exists, dtype=bool)] = np.nan
+        self.trial.points[name] = out
+        self.trial.modified = True
+
+    # events
+
+    @_sdk_call
+    def GetEvents(self, subject, context, event_type):
+        frames = [
+            frame
+            for ctxt, label, frame in self.trial.events
+            if ctxt == context and label == event_type
+        ]
+        return frames, [0.0] * len(frames)
+
+    @_sdk_call
+    def CreateAnEvent(self, subject, context, event_type, frame, offset):
+        self.trial.events.append((context, event_type, int(frame)))
+        self.trial.modified = True
+
+    @_sdk_call
+    def ClearAllEvents(self):
+        self.trial.events = list()
+        self.trial.modified = True
+
+    # devices
+
+    @_sdk_call
+    def GetDeviceIDs(self):
+        return list(range(1, len(self.trial.devices) + 1))
+
+    @_sdk_call
+    def GetDeviceDetails(self, devid):
+        name, type_, outputs = self._device(devid)
+        outputids = list(range(1, len(outputs) + 1))
+        return name, type_, self.trial.analograte, outputids, None, None
+
+    @_sdk_call
+    def GetDeviceOutputIDFromName(self, devid, outputname):
+        outnames = [output[0] for output in self._device(devid)[2]]
+        return outnames.index(outputname) + 1
+
+    @_sdk_call
+    def GetDeviceOutputDetails(self, devid, outputid):
+        outname, unit, chnames, _ = self._device(devid)[2][outputid - 1]
+        chids = list(range(1, len(chnames) + 1))
+        return outname, 'Analog', unit, True, chnames, chids
+
+    @_sdk_call
+    def GetDeviceChannelIDFromName(self, devid, outputid, chname):
+        return self._device(devid)[2][outputid - 1][2].index(chname) + 1
+
+    @_sdk_call
+    def GetDeviceChannel(self, devid, outputid, chid):
+        inds = self._device(devid)[2][outputid - 1][3]
+        data = self.trial.analogs[inds[chid - 1]]
+        return data.tolist(), [True] * len(data), self.trial.analograte
+
+
+class NexusRecorder:
+    """Record the SDK calls made on a (real) ViconNexus object.
+
+    The public methods of the object are wrapped, so that gaitutils keeps
+    recognizing it as a ViconNexus instance. Use as a context manager, or call
+    stop() to remove the wrappers. Save the recording with save().
+    """
+
+    def __init__(self, vicon):
+        self.vicon = vicon
+        self.recorded = list()
+        self._wrapped = list()
+        for name in dir(vicon):
+            method = getattr(vicon, name)
+            if name[:1].isupper() and callable(method):
+                setattr(vicon, name, self._wrap(name, method))
+                self._wrapped.append(name)
+
+    def _wrap(self, name, method):
+        @functools.wraps(method)
+        def wrapper(*args):
+            result = method(*args)
+            self.recorded.append((name, _call_key(name, args)[1], result))
+            return result
+
+        return wrapper
+
+    def stop(self):
+        """Restore the original methods"""
+        for name in self._wrapped:
+            delattr(self.vicon, name)
+        self._wrapped = list()
+
+    def save(self, fname):
+        """Save the recorded calls for ViconNexus.from_recording()"""
+        with open(fname, 'wb') as f:
+            pickle.dump(self.recorded, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+@contextlib.contextmanager
+def patch_gaitutils(vicon):
+    """Make gaitutils.nexus use the given SDK object.
+
+    Within the context, nexus.viconnexus() returns vicon and the check for a
+    running Nexus process is skipped.
+    """
+    saved = nexus.vicon_, nexus._nexus_pid
+    nexus.vicon_ = vicon
+    nexus._nexus_pid = os.getpid
+    try:
+        yield vicon
+    finally:
+        nexus.vicon_, nexus._nexus_pid = saved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run a Nexus-bound script offline, or record its Nexus calls.'
+    )
+    parser.add_argument('script', help='the script to run')
+    parser.add_argument('--trial', help='c3d file to open initially')
+    parser.add_argument('--replay', metavar='FILE', help='replay recorded calls')
+    parser.add_argument(
+        '--record', metavar='FILE', help='record calls to a live Nexus into FILE'
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sys.argv = [args.script]
+    if args.record:
+        with NexusRecorder(nexus.viconnexus()) as recorder:
+            try:
+                runpy.run_path(args.script, run_name='__main__')
+            finally:
+                recorder.save(args.record)
+        print('recorded %d calls into %s' % (len(recorder.recorded), args.record))
+    else:
+        if args.replay:
+            vicon = ViconNexus.from_recording(args.replay, args.trial)
+        else:
+            vicon = ViconNexus(args.trial)
+        with patch_gaitutils(vicon):
+            runpy.run_path(args.script, run_name='__main__')
+        print('SDK calls: %d' % sum(vicon.calls.values()))
+        for name, count in vicon.calls.most_common():
+            print('%8d %s' % (count, name))
@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+"""
+
+Offline autoprocessing of c3d files, without Nexus.
+
+gaitutils.autoprocess processes the trials of a session one at a time in a
+running Nexus. This module does the same checks and event marking directly on
+the c3d files, so the trials of all sessions of a patient can be processed in
+parallel:
+
+-skip trials according to their Eclipse type and description/notes
+-check trial length, gaps and the Plug-in Gait marker set; swap flipped
+ HEE/TOE markers
+-detect forceplate contacts, gait direction and velocity
+-mark gait events from foot marker velocities and adjust them according to
+ the forceplate events. This is the algorithm of
+ gaitutils.utils.automark_events(), with the per-event loops replaced by
+ array operations
+-write the events into the c3d files, and the descriptions and forceplate info
+ into the Eclipse (.enf) files
+
+The c3d files must already exist, i.e. the trials must have been
+reconstructed, labeled and filtered. Nexus pipelines (e.g. the model
+pipelines) cannot be run offline, and the trials are not cropped.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import logging
+import numpy as np
+from scipy import signal
+from concurrent.futures import ProcessPoolExecutor
+
+from gaitutils import cfg, eclipse, events, models, read_data, sessionutils, utils
+from gaitutils.envutils import GaitDataError
+from gaitutils.events import GaitEvent, GaitEvents
+from gaitutils.numutils import falling_zerocross, rising_zerocross
+
+from nexus_offline import _C3DTrial
+
+logger = logging.getLogger(__name__)
+
+# number of worker processes; None for one per CPU core, 1 for serial processing
+MAX_WORKERS = None
+# whether to write the marked events into the c3d files
+WRITE_EVENTS = True
+# automark parameters, as in gaitutils.utils.automark_events()
+# reasonable limit for peak foot velocity (m/s)
+MAX_PEAK_VELOCITY = 12
+# reasonable limits for velocity on slope (m/s)
+MAX_SLOPE_VELOCITY = 6
+MIN_SLOPE_VELOCITY = 0
+# minimum swing velocity (relative to max velocity)
+MIN_SWING_VELOCITY = 0.5
+# median prefilter width
+PREFILTER_MEDIAN_WIDTH = 3
+# c3d event contexts and labels, as written by Nexus
+C3D_CONTEXTS = {'R': 'Right', 'L': 'Left'}
+C3D_LABELS = {'strike': 'Foot Strike', 'toeoff': 'Foot Off'}
+
+
+def _fail_desc(reason):
+    """Eclipse description for a failed trial"""
+    return (
+        cfg.autoproc.enf_descriptions[reason]
+        if reason in cfg.autoproc.enf_descriptions
+        else reason
+    )
+
+
+def _context_desc(fpev):
+    """Eclipse description string for the forceplate events"""
+    n_right = len(fpev.get_events(context='R', event_type='strike', forceplate=True))
+    n_left = len(fpev.get_events(context='L', event_type='strike', forceplate=True))
+    s = ''
+    if n_right:
+        s += f'{n_right}R'
+    if n_right and n_left:
+        s += '/'
+    if n_left:
+        s += f'{n_left}L'
+    return s or cfg.autoproc.enf_descriptions['context_none']
+
+
+def _range_to_roi(subj_pos, gait_dim, mov_range):
+    """Determine the ROI (in frames) from the movement range"""
+    subj_pos1 = subj_pos[:, gait_dim]
+    # non-gap frames inside the movement range
+    dist_ok = np.flatnonzero(
+        (subj_pos1 >= mov_range[0]) & (subj_pos1 <= mov_range[1]) & (subj_pos1 != 0)
+    )
+    if dist_ok.size == 0:
+        raise GaitDataError('no frames inside given range')
+    return dist_ok[0], dist_ok[-1]
+
+
+def _median_velocity(mkrdata, framerate):
+    """Median walking speed (m/s), as utils._trial_median_velocity()"""
+    try:
+        vel_3 = utils.avg_markerdata(
+            mkrdata, cfg.autoproc.track_markers, avg_velocity=True
+        )
+    except GaitDataError:
+        return np.nan
+    vel = np.linalg.norm(vel_3, axis=1)
+    return np.median(vel[vel != 0]) * framerate / 1000.0
+
+
+def _vel_threshold(vel_thresholds, key, default):
+    """Forceplate based velocity threshold, if available and enabled"""
+    vel = vel_thresholds[key]
+    if cfg.autoproc.use_fp_vel_thresholds and np.any(vel):
+        return vel[0]
+    return default
+
+
+def _crossings(footctrv, threshold, rising, max_slope_velocity):
+    """Frames where the velocity crosses the threshold, with slope checks"""
+    x = footctrv - threshold
+    cross = rising_zerocross(x) if rising else falling_zerocross(x)
+    # exclude edges of data vector
+    cross = cross[(cross > 0) & (cross < len(footctrv) - 1)]
+    before, after = footctrv[cross - 1], footctrv[cross + 1]
+    slope_ok = (
+        (before < max_slope_velocity)
+        & (before > MIN_SLOPE_VELOCITY)
+        & (after < max_slope_velocity)
+        & (after > MIN_SLOPE_VELOCITY)
+    )
+    return cross[slope_ok]
+
+
+def _swing_strikes(footctrv, strikes, swing_velocity):
+    """Keep the strikes that are preceded by a foot swing.
+
+    automark_events() deletes a strike if the velocity does not reach the swing
+    velocity between the previous kept strike and this one. A strike is only
+    deleted if there was no swing before it either, so this is the same as
+    checking for a swing between consecutive strikes. The check is done for
+    all strikes at once, using the cumulative count of swing frames.
+    """
+    n_swing = np.concatenate([[0], np.cumsum(footctrv >= swing_velocity)])
+    # number of swing frames in [strikes[k-1], strikes[k])
+    swings = n_swing[strikes[1:]] - n_swing[strikes[:-1]]
+    return strikes[np.concatenate([[True], swings > 0])]
+
+
+def _last_toeoffs(toeoffs, strikes):
+    """Keep only the last of multiple toeoffs between consecutive strikes"""
+    # index of the first strike at or after each toeoff
+    next_strike = np.searchsorted(strikes, toeoffs)
+    between = (
+        (next_strike > 0)
+        & (next_strike < len(strikes))
+        & (toeoffs != strikes[np.minimum(next_strike, len(strikes) - 1)])
+    )
+    # toeoffs are sorted, so the ones in the same cycle are consecutive
+    drop = np.zeros(len(toeoffs), dtype=bool)
+    drop[:-1] = between[:-1] & between[1:] & (next_strike[:-1] == next_strike[1:])
+    return toeoffs[~drop]
+
+
+def automark_events(mkrdata, framerate, vel_thresholds, roi=None):
+    """Mark foot strikes and toeoffs based on foot velocity.
+
+    The same as gaitutils.utils.automark_events() for marker data that has
+    already been read. events_range is taken from the config. Returns a
+    GaitEvents instance.
+    """
+    # marker data is in mm, velocity limits are converted into mm/frame
+    vel_conv = 1000 / framerate
+    max_peak_velocity = MAX_PEAK_VELOCITY * vel_conv
+    max_slope_velocity = MAX_SLOPE_VELOCITY * vel_conv
+    events_range = cfg.autoproc.events_range
+    if events_range:
+        mdata = utils.avg_markerdata(mkrdata, cfg.autoproc.track_markers, roi=roi)
+        fwd_dim = utils._principal_movement_direction(mdata)
+
+    evs = GaitEvents()
+    for context, markers, pos_marker in [
+        ('R', cfg.autoproc.right_foot_markers, 'RANK'),
+        ('L', cfg.autoproc.left_foot_markers, 'LANK'),
+    ]:
+        footctrv_ = utils.avg_markerdata(
+            mkrdata, markers, roi=roi, fail_on_gaps=False, avg_velocity=True
+        )
+        footctrv = signal.medfilt(
+            np.linalg.norm(footctrv_, axis=1), PREFILTER_MEDIAN_WIDTH
+        )
+        maxv = utils._get_foot_swing_velocity(
+            footctrv, max_peak_velocity, MIN_SWING_VELOCITY
+        )
+        threshold_fall = _vel_threshold(
+            vel_thresholds,
+            f'{context}_strike',
+            maxv * cfg.autoproc.strike_vel_threshold,
+        )
+        threshold_rise = _vel_threshold(
+            vel_thresholds,
+            f'{context}_toeoff',
+            maxv * cfg.autoproc.toeoff_vel_threshold,
+        )
+        logger.debug(
+            f'context {context}: thresholds {threshold_fall:.2f}/{threshold_rise:.2f}'
+        )
+
+        strikes = _crossings(footctrv, threshold_fall, False, max_slope_velocity)
+        if len(strikes) == 0:
+            raise GaitDataError('No valid foot strikes detected')
+        strikes = _swing_strikes(footctrv, strikes, maxv * MIN_SWING_VELOCITY)
+        toeoffs = _crossings(footctrv, threshold_rise, True, max_slope_velocity)
+        if len(toeoffs) == 0:
+            raise GaitDataError('Could not detect any toe-off events')
+        toeoffs = _last_toeoffs(toeoffs, strikes)
+
+        # select strikes where the foot is inside the events range
+        if events_range:
+            strike_pos = mkrdata[pos_marker][strikes, fwd_dim]
+            # exactly zero position indicates a gap
+            dist_ok = (
+                (strike_pos > events_range[0])
+                & (strike_pos < events_range[1])
+                & (strike_pos != 0)
+            )
+            strikes = strikes[dist_ok]
+        if roi is not None:
+            strikes = strikes[(roi[0] <= strikes + 1) & (strikes + 1 <= roi[1])]
+            toeoffs = toeoffs[(roi[0] <= toeoffs + 1) & (toeoffs + 1 <= roi[1])]
+        if len(strikes) == 0:
+            raise GaitDataError('No valid foot strikes detected')
+        # delete toeoffs that are not between strike events
+        toeoffs = toeoffs[(toeoffs > strikes.min()) & (toeoffs < strikes.max())]
+        logger.debug(f'context {context}: strikes {strikes}, toeoffs {toeoffs}')
+
+        for fr in strikes:
+            evs.append(GaitEvent(int(fr), 'strike', context))
+        for fr in toeoffs:
+            evs.append(GaitEvent(int(fr), 'toeoff', context))
+    return evs
+
+
+def _trajectory_names(meta):
+    """Return the names of the marker trajectories of a trial.
+
+    meta is the trial metadata from read_data.get_metadata(). Its markers are
+    all the points of the c3d file, so the outputs of the gaitutils models are
+    excluded.
+    """
+    model_outputs = {var for model in models.models_all for var in model.read_vars}
+    return [name for name in meta['markers'] if name not in model_outputs]
+
+
+def _write_c3d(c3dfile, evs, swaps):
+    """Write the events (if not None) and marker swaps into a c3d file.
+
+    The rest of the file is kept as is (see nexus_offline._C3DTrial.save()).
+    """
+    tr = _C3DTrial(c3dfile)
+    for m1, m2 in swaps:
+        for data in tr.points, tr.residuals, tr.camera_masks:
+            data[m1], data[m2] = data[m2], data[m1]
+    if evs is not None:
+        # Nexus frames are 1-based
+        tr.events = [
+            (C3D_CONTEXTS[ev.context], C3D_LABELS[ev.event_type], ev.frame + 1)
+            for ev in evs.get_events()
+        ]
+    tr.save()
+
+
+def _preprocess_trial(c3dfile, meta, edata, swaps):
+    """Check the trial and detect the forceplate contacts.
+
+    Returns a trial_info dict as in autoprocess._do_autoproc(). Flipped
+    markers are swapped in the marker data and appended to swaps.
+    """
+    trial_info = {'recon_ok': False}
+
+    def _fail(reason):
+        trial_info['description'] = desc = _fail_desc(reason)
+        logger.info(f'{c3dfile.name}: preprocessing failed: {desc}')
+        return trial_info
+
+    # check trial length
+    if meta['length'] - 1 < cfg.autoproc.min_trial_duration:
+        return _fail('short')
+
+    # check for valid marker data
+    allmarkers = _trajectory_names(meta)
+    try:
+        mkrdata = read_data.get_marker_data(c3dfile, allmarkers, ignore_missing=True)
+    except GaitDataError:
+        return _fail('label_failure')
+    # fail on any gaps in trial (off by default)
+    if cfg.autoproc.fail_on_gaps:
+        for marker in set(mkrdata) - set(cfg.autoproc.ignore_markers):
+            if utils.marker_gaps(mkrdata[marker]).size > 0:
+                return _fail('gaps')
+    # check for valid Plug-in Gait set
+    if cfg.autoproc.check_marker_set and not utils.is_plugingait_set(mkrdata):
+        logger.info(f'{c3dfile.name}: marker set does not correspond to Plug-in Gait')
+        return _fail('label_failure')
+    # check for flipped markers
+    for m1, m2 in list(utils._check_markers_flipped(mkrdata)):
+        logger.info(f'{c3dfile.name}: swapping trajectories for {m1} and {m2}')
+        mkrdata[m1], mkrdata[m2] = mkrdata[m2], mkrdata[m1]
+        swaps.append((m1, m2))
+
+    # get subject position by tracking markers
+    try:
+        subj_pos = utils.avg_markerdata(mkrdata, cfg.autoproc.track_markers)
+    except GaitDataError:
+        return _fail('label_failure')
+    gait_dim = utils._principal_movement_direction(subj_pos)
+    # our roi (in frames) according to events_range (which is in lab coords)
+    try:
+        roi = _range_to_roi(subj_pos, gait_dim, cfg.autoproc.events_range)
+    except GaitDataError:
+        return _fail('no_frames_in_range')
+
+    # check forceplate data
+    fp_info = (
+        eclipse._eclipse_forceplate_keys(edata)
+        if cfg.autoproc.use_eclipse_fp_info
+        else None
+    )
+    try:
+        fpev, n_plates = utils.detect_forceplate_events(
+            c3dfile, mkrdata, eclipse_fp_info=fp_info, roi=roi, return_nplates=True
+        )
+        foot_vel = utils._get_foot_contact_vel(mkrdata, fpev, medians=True, roi=roi)
+    except GaitDataError:
+        logger.warning(f'{c3dfile.name}: forceplate checks failed, possibly gaps')
+        return _fail('gaps')
+
+    desc = _context_desc(fpev) + ','
+    # +1/-1 for forward/backward (coord increase / decrease)
+    subj_pos_ = subj_pos[np.any(subj_pos, axis=1)]  # ignore gaps
+    gait_dir = np.median(np.diff(subj_pos_, axis=0), axis=0)[gait_dim]
+    if (
+        'dir_forward' in cfg.autoproc.enf_descriptions
+        and 'dir_backward' in cfg.autoproc.enf_descriptions
+    ):
+        dir_str = 'dir_forward' if gait_dir > 0 else 'dir_backward'
+        desc += f'{cfg.autoproc.enf_descriptions[dir_str]},'
+    median_vel = _median_velocity(mkrdata, meta['framerate'])
+    desc += f'{median_vel:.2f} m/s'
+
+    trial_info.update(
+        {
+            'recon_ok': True,
+            'description': desc,
+            'mkrdata': mkrdata,
+            'roi': roi,
+            'fpev': fpev,
+            'n_plates': n_plates,
+            'foot_vel': foot_vel,
+        }
+    )
+    return trial_info
+
+
+def _autoproc_trial(enffile):
+    """Autoprocess a trial.
+
+    The c3d file is updated here, but not the .enf file. Returns a dict with
+    the Eclipse description, the detected forceplate info (None if the trial
+    failed before the forceplate checks) and the number of marked events (None
+    if events were not marked).
+    """
+    c3dfile = sessionutils.enf_to_trialfile(enffile, 'c3d')
+    res = {'description': 'skipped', 'fp_info': None, 'n_events': None}
+    if not c3dfile.is_file():
+        logger.warning(f'{c3dfile} does not exist, skipping')
+        return res
+    try:
+        meta = read_data.get_metadata(c3dfile)
+    except (GaitDataError, RuntimeError):
+        # may indicate broken or video-only trial
+        logger.warning(f'cannot read metadata from {c3dfile}, skipping')
+        return res
+
+    # check whether to skip trial
+    edata = eclipse.get_eclipse_keys(enffile, return_empty=True)
+    if edata['TYPE'] in cfg.autoproc.type_skip:
+        logger.debug(f'{c3dfile.name}: skipping based on type: {edata["TYPE"]}')
+        return res
+    skip = [s.upper() for s in cfg.autoproc.eclipse_skip]
+    if any(
+        s in edata['DESCRIPTION'].upper() or s in edata['NOTES'].upper() for s in skip
+    ):
+        logger.debug(f'{c3dfile.name}: skipping based on description/notes')
+        return res
+
+    swaps = list()
+    trial_info = _preprocess_trial(c3dfile, meta, edata, swaps)
+    evs = None
+    if trial_info['recon_ok']:
+        res['fp_info'], _ = events.get_forceplate_info(
+            trial_info['fpev'], trial_info['n_plates']
+        )
+        try:
+            evs = automark_events(
+                trial_info['mkrdata'],
+                meta['framerate'],
+                trial_info['foot_vel'],
+                roi=trial_info['roi'],
+            )
+            # adjust the marker-based events according to forceplate data
+            evs.merge_forceplate_events(trial_info['fpev'], adjust_frames=True)
+            res['description'] = '%s,%s' % (
+                cfg.autoproc.enf_descriptions['ok'],
+                trial_info['description'],
+            )
+        except GaitDataError:
+            logger.debug(f'{c3dfile.name}: automark failed')
+            # the previous events are cleared anyway, as in Nexus
+            evs = GaitEvents()
+            res['description'] = '%s,%s' % (
+                trial_info['description'],
+                cfg.autoproc.enf_descriptions['automark_failure'],
+            )
+        res['n_events'] = len(evs.get_events())
+    else:
+        res['description'] = trial_info['description']
+
+    if WRITE_EVENTS and (evs is not None or swaps):
+        _write_c3d(c3dfile, evs, swaps)
+    return res
+
+
+def _enf_keys(res):
+    """The Eclipse keys to write for a trial result"""
+    keys = dict()
+    if res['fp_info'] is not None:
+        # note that Eclipse fp data affects e.g. Plug-in Gait functioning
+        if cfg.autoproc.write_eclipse_fp_info == 'write':
+            keys.update(res['fp_info'])
+        elif cfg.autoproc.write_eclipse_fp_info == 'reset':
+            keys.update({k: 'Auto' for k in res['fp_info']})
+    if cfg.autoproc.eclipse_write_key:
+        keys[cfg.autoproc.eclipse_write_key] = res['description']
+    return keys
+
+
+def _process_trials(enffiles, max_workers):
+    """Autoprocess the trials, yielding (enffile, result) in the order of enffiles"""
+    if max_workers == 1:
+        for enffile in enffiles:
+            yield enffile, _autoproc_trial(enffile)
+        return
+    with ProcessPoolExecutor(max_workers) as executor:
+        # map() returns the results in the order of the input files
+        yield from zip(enffiles, executor.map(_autoproc_trial, enffiles))
+
+
+def autoproc_sessions(session_dirs, max_workers=MAX_WORKERS):
+    """Autoprocess all trials of the given sessions.
+
+    The trials of all sessions are processed in a pool of max_workers
+    processes (None for one per CPU core, 1 for serial processing). The
+    Eclipse keys of each trial (description and forceplate info) are written
+    by the parent process in a single update. Returns a dict of enffile ->
+    description.
+    """
+    enffiles = [
+        enffile
+        for sessiondir in session_dirs
+        for enffile in sessionutils.get_enfs(sessiondir)
+    ]
+    logger.info(f'autoprocessing {len(enffiles)} trials')
+    descriptions = dict()
+    for k, (enffile, res) in enumerate(_process_trials(enffiles, max_workers), 1):
+        logger.info(f'{k}/{len(enffiles)} {enffile.name}: {res["description"]}')
+        descriptions[enffile] = res['description']
+        if not (keys := _enf_keys(res)):
+            continue
+        try:
+            eclipse.set_eclipse_keys(enffile, keys, update_existing=True)
+        except IOError:
+            logger.warning(f'failed to update Eclipse keys in {enffile}')
+    return descriptions
@@ -20,29 +20,67 @@ import openpyxl
 from openpyxl.styles import Font
 import matplotlib.pyplot as plt
 
-from gaitutils import nexus, sessionutils, cfg, trial
+from gaitutils import nexus, sessionutils, cfg
+from gaitutils.envutils import GaitDataError
+
+import emg_filters
+import cycle_norm
+import model_outputs
+import nexus_cache
+import trial_prefetch
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
-def _compute_emg_envelope():
+def _trial_frames(meta, nexus_meta):
+    """Frames of the open Nexus trial that are covered by the data, as a slice.
+
+    meta is the metadata of the data (e.g. from the c3d file) and nexus_meta
+    that of the Nexus trial. A trial cropped by autoprocessing only has the
+    ROI frames in its c3d file, starting at frame meta['offset'], while Nexus
+    still has all of its frames.
+    """
+    start = meta['offset'] - nexus_meta['offset']
+    stop = start + meta['length']
+    if start < 0 or stop > nexus_meta['length']:
+        raise GaitDataError(
+            'frames %d-%d are outside the Nexus trial (%d frames)'
+            % (start, stop, nexus_meta['length'])
+        )
+    return slice(start, stop)
+
+
+def _compute_emg_envelope(store=None, emgdata=None, meta=None):
     """Compute EMG linear envelope and rectified signal for currently open Nexus trial.
 
-    Write as model outputs.
+    The results are put into store (a model_outputs.ModelOutputStore), to be
+    written into Nexus by store.flush(). If store is None, they are written
+    into Nexus as model outputs right away. Returns the output names and the
+    Nexus trial frames covered by the outputs (a slice, see _trial_frames).
+
+    emgdata and meta can be given if they have already been read (e.g. from
+    the c3d file of the trial, see trial_prefetch.load_trial_c3d); otherwise
+    they are read from Nexus. If the c3d data covers only part of the Nexus
+    trial, the outputs are marked as missing in the other frames.
     """
 
     # define parameters
     HPF = 5  # high pass frequency
     LPF = 10  # low pass frequency
     BUTTER_ORDER = 4  # filter order
+    RESAMPLE_METHOD = 'fft'  # see emg_filters.resample()
 
     # read EMG data
     vicon = nexus.viconnexus()
-    emgdata = nexus._get_emg_data(vicon)['data']
-    meta = nexus._get_metadata(vicon)
+    if emgdata is None:
+        emgdata = nexus._get_emg_data(vicon)['data']
+    nexus_meta = nexus._get_metadata(vicon)
+    if meta is None:
+        meta = nexus_meta
+    frames = _trial_frames(meta, nexus_meta)
     emgrate = meta['analograte']
-    subject = meta['name']
+    subject = meta['subject_name']
     nframes = meta['length']
 
     # apply hpf
@@ -68,55 +106,33 @@ def _compute_emg_envelope():
 
     # downsample
     emg_rectified_ds = {
-        chname + '_Rectified': scipy.signal.resample(chdata, nframes)
+        chname + '_Rectified': emg_filters.resample(
+            chdata, nframes, method=RESAMPLE_METHOD
+        )
         for chname, chdata in emg_rectified.items()
     }
     emg_linearenvelope_ds = {
-        chname + '_LinearEnvelope': scipy.signal.resample(chdata, nframes)
+        chname + '_LinearEnvelope': emg_filters.resample(
+            chdata, nframes, method=RESAMPLE_METHOD
+        )
         for chname, chdata in emg_rectified_lpf.items()
     }
 
-    # create the new model outputs in Nexus
-    existing_outputs = vicon.GetModelOutputNames(subject)
-    new_outputs = emg_rectified_ds.keys() + emg_linearenvelope_ds.keys()
-    for output in set(new_outputs) - set(existing_outputs):
-        logger.debug('creating model output %s' % output)
-        vicon.CreateModelOutput(
-            subject,
-            output,
-            'EMG',
-            {'EMG', 'EMG', 'EMG'},
-            {'Electric Potential', 'Electric Potential', 'Electric Potential'},
-        )
-
-    # write the processed EMG as model outputs
-    exists = [True] * nframes
-
-    for chname, chdata in emg_rectified_ds.items():
-        logger.debug('writing data for %s' % chname)
-        vicon.SetModelOutput(subject, chname, [chdata], exists)
-
-    for chname, chdata in emg_linearenvelope_ds.items():
-        logger.debug('writing data for %s' % chname)
-        vicon.SetModelOutput(
-            subject,
-            chname,
-            [chdata],
-            exists,
-        )
-
-    return new_outputs
+    # store the processed EMG as model outputs, at the frames of the Nexus trial
+    flush = store is None
+    if store is None:
+        store = model_outputs.ModelOutputStore(vicon, subject)
+    exists = np.zeros(nexus_meta['length'], dtype=bool)
+    exists[frames] = True
+    for emg_ds in [emg_rectified_ds, emg_linearenvelope_ds]:
+        for chname, chdata in emg_ds.items():
+            data = np.zeros(nexus_meta['length'])
+            data[frames] = chdata
+            store.set(chname, data, exists=exists)
+    if flush:
+        store.flush()
 
-
-def _get_model_output(vicon, subj, var):
-    """Read a single model output from Nexus"""
-    nums, _ = vicon.GetModelOutput(subj, var)
-    if nums:
-        data = np.squeeze(np.array(nums))
-    else:
-        logger.info('cannot read model variable %s, returning nans' % var)
-        data = None
-    return data
+    return list(emg_rectified_ds) + list(emg_linearenvelope_ds), frames
 
 
 def _bold_cell(ws, **cell_params):
@@ -129,13 +145,12 @@ def _bold_cell(ws, **cell_params):
 def _guess_emg_devname(vicon):
     """Try to guess the EMG device name"""
     devnames = ['Myon EMG', 'Noraxon Ultium']  # the candidates
+    # read the device names once, instead of once per candidate
+    nexus_devnames = [
+        vicon.GetDeviceDetails(id_)[0].lower() for id_ in vicon.GetDeviceIDs()
+    ]
     for devname in devnames:
-        ids = [
-            id_
-            for id_ in vicon.GetDeviceIDs()
-            if vicon.GetDeviceDetails(id_)[0].lower() == devname.lower()
-        ]
-        if ids:
+        if devname.lower() in nexus_devnames:
             return devname
 
 
@@ -144,6 +159,9 @@ if __name__ == '__main__':
     # loop through session c3d files, compute envelopes and save into c3ds and xlsx
     cfg.autoproc.nexus_forceplate_devnames = []  # read all forceplates
     vicon = nexus.viconnexus()
+    # cache device, subject and model output metadata for the whole session;
+    # this also applies to the calls made by gaitutils
+    metadata_cache = nexus_cache.NexusMetadataCache(vicon)
     subj = nexus.get_subjectnames()
     emg_devname = _guess_emg_devname(vicon)
     if emg_devname is None:
@@ -155,30 +173,42 @@ if __name__ == '__main__':
     norm_data = dict()
     fname_xls = op.join(sp, op.split(sp)[-1] + '.xlsx')
     wb = openpyxl.Workbook()
-    for n, c3dfile in enumerate(c3ds[:2]):
+    # the c3d files (EMG, metadata and cycles) are decoded on a background
+    # thread, while the previous trial is processed and written into Nexus
+    trials = trial_prefetch.prefetch(c3ds[:2], trial_prefetch.load_trial_c3d)
+    for n, (c3dfile, trialdata) in enumerate(trials):
         ncycles = dict()
         logger.debug('opening %s' % c3dfile)
         nexus._open_trial(c3dfile)
-        # compute the envelopes into Nexus model vars; names are returned
-        modelvars = _compute_emg_envelope()
-        tr = trial.nexus_trial()
+        # compute the envelopes into the store and write them into Nexus in
+        # one go; the names are returned
+        store = model_outputs.ModelOutputStore(vicon, subj)
+        try:
+            modelvars, frames = _compute_emg_envelope(
+                store, emgdata=trialdata['emg'], meta=trialdata['meta']
+            )
+        except GaitDataError as e:
+            logger.warning('skipping %s: %s' % (c3dfile, e))
+            continue
+        store.flush()
+        tr = trialdata['trial']
+        avg_data = dict()
+        std_data = dict()
         for ctxt in 'LR':
             this_cycles = tr.get_cycles({ctxt: 'all'})
             if ctxt not in ncycles:
                 ncycles[ctxt] = len(this_cycles)
             this_vars = [var for var in modelvars if var[0] == ctxt]
-            for var in this_vars:
-                norm_data[var] = list()
-                for cyc in this_cycles:
-                    this_data = _get_model_output(vicon, subj, var)
-                    this_data_norm = cyc.normalize(this_data)[1]
-                    norm_data[var].append(this_data_norm)
-                norm_data[var] = np.array(norm_data[var])
-        avg_data = dict()
-        std_data = dict()
-        for var in modelvars:
-            avg_data[var] = norm_data[var].mean(axis=0)
-            std_data[var] = norm_data[var].std(axis=0)
+            if not this_vars:
+                continue
+            # normalize all variables to all cycles at once; the data is read
+            # from the store, not from Nexus. The cycles are in c3d frames.
+            data = np.array([store.get(var)[frames] for var in this_vars])
+            normalizer = cycle_norm.CycleNormalizer(this_cycles, data.shape[1])
+            norm_data = normalizer.normalize(data)  # cycles x vars x 101
+            for k, var in enumerate(this_vars):
+                avg_data[var] = norm_data[:, k, :].mean(axis=0)
+                std_data[var] = norm_data[:, k, :].std(axis=0)
         ws = wb.active if n == 0 else wb.create_sheet()
         ws.title = op.splitext(op.split(c3dfile)[-1])[0]
         # write some metadata
@@ -9,442 +9,170 @@ Rectify EMG from c3d files. Average and write into XLSX.
 
 # %% init
 
-import enum
 import os.path as op
-import numpy as np
-import scipy
 import logging
-import openpyxl
-from openpyxl.styles import Font
-import matplotlib.pyplot as plt
-from collections import defaultdict
-import gaitutils
 
-from gaitutils.envutils import GaitDataError
-from gaitutils.numutils import _isint
-from gaitutils import c3d, nexus, sessionutils, cfg, trial, read_data
+from emg_c3d import (
+    _configure,
+    _compute_emg_envelope_c3d,
+    _compute_rms_envelope_c3d,
+    process_c3ds,
+)
+from trial_files import find_c3ds
+from emg_xlsx import StreamingWorkbook
+from emg_columnar import CycleWriter
+import cycle_norm
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
-def _bold_cell(ws, **cell_params):
-    """Write a bold-styled cell into worksheet ws"""
-    boldfont = Font(bold=True)
-    _cell = ws.cell(**cell_params)
-    _cell.font = boldfont
-
-
-def _compute_rms_envelope_c3d(c3dfile):
-    """Compute RMS-based envelope"""
-    # define parameters
-    HPF = 20  # high pass frequency
-    BUTTER_ORDER = 4  # filter order
-    RMS_WIN = 31
-
-    # read EMG data
-    emgdata = read_data.get_emg_data(c3dfile)['data']
-    meta = read_data.get_metadata(c3dfile)
-    emgrate = meta['analograte']
-    nframes = meta['length']
-
-    # strip Voltage. prefix that Nexus inserts
-    emgdata = {
-        (chname[8:] if chname.find('Voltage') == 0 else chname): data
-        for chname, data in emgdata.items()
-    }
-
-    # apply hpf
-    b_HPF, a_HPF = scipy.signal.butter(
-        BUTTER_ORDER, HPF * 2 / emgrate, 'high', analog=False
-    )
-
-    emg_hpf = {
-        chname: scipy.signal.filtfilt(b_HPF, a_HPF, chdata)
-        for chname, chdata in emgdata.items()
-    }
-
-    # RMS
-    emg_rms = {chname: gaitutils.numutils.rms(chdata, RMS_WIN) for chname, chdata in emg_hpf.items()}
-
-    # downsample
-    emg_rms_ds = {
-        chname + '_RMS': scipy.signal.resample(chdata, nframes)
-        for chname, chdata in emg_rms.items()
-    }
-
-    return emg_rms_ds
-
-
-def _compute_emg_envelope_c3d(c3dfile):
-    """Compute EMG linear envelope and rectified signal for a c3d file"""
-
-    # define parameters
-    HPF = 5  # high pass frequency
-    LPF = 10  # envelope low pass frequency
-    BUTTER_ORDER = 4  # filter order
-
-    # read EMG data
-    emgdata = read_data.get_emg_data(c3dfile)['data']
-    meta = read_data.get_metadata(c3dfile)
-    emgrate = meta['analograte']
-    nframes = meta['length']
-
-    # strip Voltage. prefix that Nexus inserts
-    emgdata = {
-        (chname[8:] if chname.find('Voltage') == 0 else chname): data
-        for chname, data in emgdata.items()
-    }
-
-    # apply hpf
-    b_HPF, a_HPF = scipy.signal.butter(
-        BUTTER_ORDER, HPF * 2 / emgrate, 'high', analog=False
-    )
-    emg_hpf = {
-        chname: scipy.signal.filtfilt(b_HPF, a_HPF, chdata)
-        for chname, chdata in emgdata.items()
-    }
-
-    # rectify
-    emg_rectified = {chname: np.abs(chdata) for chname, chdata in emg_hpf.items()}
-
-    # apply lpf
-    b_LPF, a_LPF = scipy.signal.butter(
-        BUTTER_ORDER, LPF * 2 / emgrate, 'low', analog=False
-    )
-    emg_rectified_lpf = {
-        chname: scipy.signal.filtfilt(b_LPF, a_LPF, chdata)
-        for chname, chdata in emg_rectified.items()
-    }
-
-    # downsample
-    emg_rectified_ds = {
-        chname + '_Rectified': scipy.signal.resample(chdata, nframes)
-        for chname, chdata in emg_rectified.items()
-    }
-    emg_linearenvelope_ds = {
-        chname + '_LinearEnvelope': scipy.signal.resample(chdata, nframes)
-        for chname, chdata in emg_rectified_lpf.items()
-    }
-
-    return emg_linearenvelope_ds
-
-
-def _channel_context(chname, idx_mapper):
-    """Try to figure out channel context.
-
-    idx_mapper must be a dict that maps channel index to context.
-    """
-    if chname[0] in 'LR':  # Myon naming
-        return chname[0]
-    elif chname[:3] == 'EMG':  # Noraxon naming
-        dot_pos = chname.find('.')
-        idx = chname[3:dot_pos]  # channel index
-        try:
-            return idx_mapper(int(idx))
-        except ValueError:
-            raise ValueError('cannot parse channel name %s' % chname)
-    else:  # unrecognized channel
-        return None
-
-
-def _auto_adjust(ws):
-    dims = {}
-    for row in ws.rows:
-        for cell in row:
-            if cell.value:
-                dims[cell.column_letter] = max(
-                    (dims.get(cell.column_letter, 0), len(str(cell.value)))
-                )
-    for col, value in dims.items():
-        ws.column_dimensions[col].width = value
-
+def _write_sheet_header(wb, c3dfile, ncycles):
+    """Start a new sheet for a trial and write the metadata and column headers"""
+    wb.create_sheet(op.splitext(op.split(c3dfile)[-1])[0][:31])
+    wb.append([])
+    wb.append(['Trial name:', op.split(c3dfile)[-1]], bold_cols=[0])
+    wb.append(['N of cycles right:', ncycles['R']], bold_cols=[0])
+    wb.append(['N of cycles left:', ncycles['L']], bold_cols=[0])
+    col_headers = [''] + ['frame %d' % k for k in range(101)]
+    wb.append(col_headers, bold_cols=range(len(col_headers)))
 
-# %% read through EMG, compute envelopes, save averaged data into XLSX
 
-# emg1-6 oikea, paitsi Vilma emg1-6 vasen
+def _write_cycles(wb, res):
+    """Write individual cycles for each channel, one row per cycle"""
+    ctxts = res['ctxts']
+    norm_data = cycle_norm.split_channels(res['norm_tensor'], res['mask'], ctxts)
+    for chname in sorted(norm_data):
+        for curve_ind, curve in enumerate(norm_data[chname], 1):
+            label = '%s (context=%s), cycle %d' % (chname, ctxts[chname], curve_ind)
+            wb.append([label] + curve.tolist(), bold_cols=[0])
 
-# Noraxon-specific mapping from ch index to context
-idx_mapper = lambda idx: 'R' if idx <= 6 else 'L'
-idx_mapper_reverse = lambda idx: 'L' if idx <= 6 else 'R'
 
-cfg.autoproc.nexus_forceplate_devnames = []  # read all forceplates
+# %% read through EMG, compute envelopes, save averaged data into XLSX
 
 session_root = r'C:\Users\hus20664877\Downloads\C3D files'
 
 fname_xls = op.join(session_root, 'emg_envelopes.xlsx')
 
-norm_data = dict()
-wb = openpyxl.Workbook()
+# number of worker processes; None to use all cores, 1 to process serially.
+# Use more than 1 only when running the cells in a console: this file has no
+# __main__ guard, so when it is run as a script, the worker processes (spawned
+# on Windows) would run it again
+MAX_WORKERS = 1
+# cache for computed envelopes; None to disable caching
+CACHE_DIR = op.join(op.expanduser('~'), '.emg_envelope_cache')
+
+wb = StreamingWorkbook()
 
-# be more tolerant about toeoffs
-cfg.trial.no_toeoff = 'reject'
-cfg.trial.multiple_toeoffs = 'reject'
+_configure()
 
 # get the c3ds
-allfiles = list()
-for d0, dirs, files in os.walk(session_root):
-    allfiles.extend(op.join(d0, fn) for fn in files if '.c3d' in fn.lower())
+allfiles = find_c3ds(session_root)
 
 # compute envelopes, normalize to cycles (for matching context) and average (one per trial)
-for n, c3dfile in enumerate(sorted(allfiles)):
-    try:
-        lenv = _compute_emg_envelope_c3d(c3dfile)
-    except GaitDataError:
-        logger.warning('cannot read EMG from %s, skipping' % c3dfile)
-        continue
-    tr = trial.Trial(c3dfile)
-    this_cycles = tr.get_cycles('all')
-    # count L/R cycles
-    ncycles = {
-        ctxt: len([c for c in this_cycles if c.context == ctxt]) for ctxt in 'LR'
-    }
-    # for Vilma, we have a different channel mapping
-    _idx_mapper = idx_mapper_reverse if 'VILMA' in c3dfile.upper() else idx_mapper
-    norm_data = dict()
-    chs_valid = [ch for ch in lenv if _channel_context(ch, _idx_mapper) is not None]
-    for chname in chs_valid:
-        chdata = lenv[chname]
-        ctxt_this = _channel_context(chname, idx_mapper)
-        norm_data[chname] = list()
-        for cyc in this_cycles:
-            if ctxt_this != cyc.context:
-                continue
-            chdata_norm = cyc.normalize(chdata)[1]
-            norm_data[chname].append(chdata_norm)
-        norm_data[chname] = np.array(norm_data[chname])
-
-    avg_data = dict()
-    std_data = dict()
-    for chname in chs_valid:
-        avg_data[chname] = norm_data[chname].mean(axis=0)
-        std_data[chname] = norm_data[chname].std(axis=0)
-
-    # one trial per sheet
-    ws = wb.active if n == 0 else wb.create_sheet()
-    ws.title = op.splitext(op.split(c3dfile)[-1])[0][:31]
-
-    # write some metadata
-    _bold_cell(ws, column=1, row=2, value='Trial name:')
-    _bold_cell(ws, column=1, row=3, value='N of cycles right:')
-    _bold_cell(ws, column=1, row=4, value='N of cycles left:')
-
-    ws.cell(column=2, row=2, value=op.split(c3dfile)[-1])
-    ws.cell(column=2, row=3, value=ncycles['L'])
-    ws.cell(column=2, row=4, value=ncycles['R'])
+results = process_c3ds(
+    allfiles, _compute_emg_envelope_c3d, max_workers=MAX_WORKERS, cachedir=CACHE_DIR
+)
 
-    col_headers = [''] + ['frame %d' % k for k in range(101)]
+for res in results:
+    chnames = list(res['ctxts'])
+    avg_data, std_data = cycle_norm.mean_std(res['norm_tensor'], res['mask'])
 
-    for col, txt in enumerate(col_headers, 1):
-        _bold_cell(ws, column=col, row=5, value=txt)
+    # one trial per sheet
+    _write_sheet_header(wb, res['c3dfile'], res['ncycles'])
 
     # write channel avg and std data
-    for _row, chname in enumerate(sorted(chs_valid), 3):
-
-        # average
-        _bold_cell(ws, column=1, row=_row * 2, value='%s / average' % chname)
-        for col, val in enumerate(avg_data[chname], 2):
-            ws.cell(column=col, row=_row * 2, value=val)
-
-        # stddev
-        _bold_cell(ws, column=1, row=_row * 2 + 1, value='%s / stddev' % chname)
-        for col, val in enumerate(std_data[chname], 2):
-            ws.cell(column=col, row=_row * 2 + 1, value=val)
-
-    _auto_adjust(ws)
+    for chname in sorted(chnames):
+        k = chnames.index(chname)
+        wb.append(['%s / average' % chname] + avg_data[k].tolist(), bold_cols=[0])
+        wb.append(['%s / stddev' % chname] + std_data[k].tolist(), bold_cols=[0])
 
-wb.save(filename=fname_xls)
+wb.save(fname_xls)
 
 
 # %% read through EMG, compute envelopes, save complete (not averaged) cycle
-# data into XLSX
-
-# emg1-6 oikea, paitsi Vilma emg1-6 vasen
-
-# Noraxon-specific mapping from ch index to context
-idx_mapper = lambda idx: 'R' if idx <= 6 else 'L'
-idx_mapper_reverse = lambda idx: 'L' if idx <= 6 else 'R'
-
-cfg.autoproc.nexus_forceplate_devnames = []  # read all forceplates
+# data into XLSX and Parquet
 
 session_root = r'C:\Users\hus20664877\Downloads\C3D files'
 
 fname_xls = op.join(session_root, 'emg_envelopes_individual.xlsx')
+# columnar output for further analysis; None to skip
+fname_parquet = op.join(session_root, 'emg_envelopes_individual.parquet')
+
+# number of worker processes; None to use all cores, 1 to process serially.
+# Use more than 1 only when running the cells in a console: this file has no
+# __main__ guard, so when it is run as a script, the worker processes (spawned
+# on Windows) would run it again
+MAX_WORKERS = 1
+# cache for computed envelopes; None to disable caching
+CACHE_DIR = op.join(op.expanduser('~'), '.emg_envelope_cache')
 
-norm_data = dict()
-wb = openpyxl.Workbook()
+wb = StreamingWorkbook()
 
-# be more tolerant about toeoffs
-cfg.trial.no_toeoff = 'reject'
-cfg.trial.multiple_toeoffs = 'reject'
+_configure()
 
 # get the c3ds
-allfiles = list()
-for d0, dirs, files in os.walk(session_root):
-    allfiles.extend(op.join(d0, fn) for fn in files if '.c3d' in fn.lower())
+allfiles = find_c3ds(session_root)
 
-# compute envelopes, normalize to cycles (for matching context) and average (one per trial)
-for n, c3dfile in enumerate(sorted(allfiles)):
-    try:
-        lenv = _compute_emg_envelope_c3d(c3dfile)
-    except GaitDataError:
-        logger.warning('cannot read EMG from %s, skipping' % c3dfile)
-        continue
-    tr = trial.Trial(c3dfile)
-    this_cycles = tr.get_cycles('all')
-    # count L/R cycles
-    ncycles = {
-        ctxt: len([c for c in this_cycles if c.context == ctxt]) for ctxt in 'LR'
-    }
-    # for Vilma, we have a different channel mapping
-    _idx_mapper = idx_mapper_reverse if 'VILMA' in c3dfile.upper() else idx_mapper
-    norm_data = dict()
-    chs_valid = [ch for ch in lenv if _channel_context(ch, _idx_mapper) is not None]
-    ctxts = dict()  # context for each channel
-    for chname in chs_valid:
-        chdata = lenv[chname]
-        ctxt_this = _channel_context(chname, idx_mapper)
-        ctxts[chname] = ctxt_this
-        norm_data[chname] = list()
-        for cyc in this_cycles:
-            if ctxt_this != cyc.context:
-                continue
-            chdata_norm = cyc.normalize(chdata)[1]
-            norm_data[chname].append(chdata_norm)
-        norm_data[chname] = np.array(norm_data[chname])
-
-    avg_data = dict()
-    std_data = dict()
-    for chname in chs_valid:
-        avg_data[chname] = norm_data[chname].mean(axis=0)
-        std_data[chname] = norm_data[chname].std(axis=0)
+# compute envelopes, normalize to cycles (for matching context)
+results = process_c3ds(
+    allfiles, _compute_emg_envelope_c3d, max_workers=MAX_WORKERS, cachedir=CACHE_DIR
+)
 
+for res in results:
     # one trial per sheet
-    ws = wb.active if n == 0 else wb.create_sheet()
-    ws.title = op.splitext(op.split(c3dfile)[-1])[0][:31]
-
-    # write some metadata
-    _bold_cell(ws, column=1, row=2, value='Trial name:')
-    _bold_cell(ws, column=1, row=3, value='N of cycles right:')
-    _bold_cell(ws, column=1, row=4, value='N of cycles left:')
-
-    ws.cell(column=2, row=2, value=op.split(c3dfile)[-1])
-    ws.cell(column=2, row=3, value=ncycles['R'])
-    ws.cell(column=2, row=4, value=ncycles['L'])
-
-    col_headers = [''] + ['frame %d' % k for k in range(101)]
+    _write_sheet_header(wb, res['c3dfile'], res['ncycles'])
+    wb.append([])
+    _write_cycles(wb, res)
 
-    for col, txt in enumerate(col_headers, 1):
-        _bold_cell(ws, column=col, row=5, value=txt)
+wb.save(fname_xls)
 
-    # loop over channels
-    row = 7
-    for ch_ind, chname in enumerate(sorted(chs_valid), 3):
-        chdata = norm_data[chname]
-        for curve_ind, curve in enumerate(chdata, 1):
-            _bold_cell(ws, column=1, row=row, value='%s (context=%s), cycle %d' % (chname, ctxts[chname], curve_ind))
-            for col, val in enumerate(curve, 2):
-                ws.cell(column=col, row=row, value=val)
-            row += 1
-
-    _auto_adjust(ws)
-
-wb.save(filename=fname_xls)
+if fname_parquet is not None:
+    with CycleWriter(fname_parquet) as writer:
+        for res in results:
+            writer.write_trial(res)
 
 
 # %% read through EMG, compute RMS envelopes, save complete (not averaged) cycle
-# data into XLSX
-
-# emg1-6 oikea, paitsi Vilma emg1-6 vasen
-
-# Noraxon-specific mapping from ch index to context
-idx_mapper = lambda idx: 'R' if idx <= 6 else 'L'
-idx_mapper_reverse = lambda idx: 'L' if idx <= 6 else 'R'
-
-cfg.autoproc.nexus_forceplate_devnames = []  # read all forceplates
+# data into XLSX and Parquet
 
 session_root = r'C:\Users\hus20664877\Downloads\C3D files'
 
 fname_xls = op.join(session_root, 'emg_rms_individual.xlsx')
+# columnar output for further analysis; None to skip
+fname_parquet = op.join(session_root, 'emg_rms_individual.parquet')
+
+# number of worker processes; None to use all cores, 1 to process serially.
+# Use more than 1 only when running the cells in a console: this file has no
+# __main__ guard, so when it is run as a script, the worker processes (spawned
+# on Windows) would run it again
+MAX_WORKERS = 1
+# cache for computed envelopes; None to disable caching
+CACHE_DIR = op.join(op.expanduser('~'), '.emg_envelope_cache')
 
-norm_data = dict()
-wb = openpyxl.Workbook()
+wb = StreamingWorkbook()
 
-# be more tolerant about toeoffs
-cfg.trial.no_toeoff = 'reject'
-cfg.trial.multiple_toeoffs = 'reject'
+_configure()
 
 # get the c3ds
-allfiles = list()
-for d0, dirs, files in os.walk(session_root):
-    allfiles.extend(op.join(d0, fn) for fn in files if '.c3d' in fn.lower())
+allfiles = find_c3ds(session_root)
 
-# compute envelopes, normalize to cycles (for matching context) and average (one per trial)
-for n, c3dfile in enumerate(sorted(allfiles)):
-    try:
-        lenv = _compute_rms_envelope_c3d(c3dfile)
-    except GaitDataError:
-        logger.warning('cannot read EMG from %s, skipping' % c3dfile)
-        continue
-    tr = trial.Trial(c3dfile)
-    this_cycles = tr.get_cycles('all')
-    # count L/R cycles
-    ncycles = {
-        ctxt: len([c for c in this_cycles if c.context == ctxt]) for ctxt in 'LR'
-    }
-    # for Vilma, we have a different channel mapping
-    _idx_mapper = idx_mapper_reverse if 'VILMA' in c3dfile.upper() else idx_mapper
-    norm_data = dict()
-    chs_valid = [ch for ch in lenv if _channel_context(ch, _idx_mapper) is not None]
-    ctxts = dict()  # context for each channel
-    for chname in chs_valid:
-        chdata = lenv[chname]
-        ctxt_this = _channel_context(chname, idx_mapper)
-        ctxts[chname] = ctxt_this
-        norm_data[chname] = list()
-        for cyc in this_cycles:
-            if ctxt_this != cyc.context:
-                continue
-            chdata_norm = cyc.normalize(chdata)[1]
-            norm_data[chname].append(chdata_norm)
-        norm_data[chname] = np.array(norm_data[chname])
-
-    avg_data = dict()
-    std_data = dict()
-    for chname in chs_valid:
-        avg_data[chname] = norm_data[chname].mean(axis=0)
-        std_data[chname] = norm_data[chname].std(axis=0)
+# compute envelopes, normalize to cycles (for matching context)
+results = process_c3ds(
+    allfiles, _compute_rms_envelope_c3d, max_workers=MAX_WORKERS, cachedir=CACHE_DIR
+)
 
+for res in results:
     # one trial per sheet
-    ws = wb.active if n == 0 else wb.create_sheet()
-    ws.title = op.splitext(op.split(c3dfile)[-1])[0][:31]
-
-    # write some metadata
-    _bold_cell(ws, column=1, row=2, value='Trial name:')
-    _bold_cell(ws, column=1, row=3, value='N of cycles right:')
-    _bold_cell(ws, column=1, row=4, value='N of cycles left:')
-
-    ws.cell(column=2, row=2, value=op.split(c3dfile)[-1])
-    ws.cell(column=2, row=3, value=ncycles['R'])
-    ws.cell(column=2, row=4, value=ncycles['L'])
-
-    col_headers = [''] + ['frame %d' % k for k in range(101)]
-
-    for col, txt in enumerate(col_headers, 1):
-        _bold_cell(ws, column=col, row=5, value=txt)
-
-    # loop over channels
-    row = 7
-    for ch_ind, chname in enumerate(sorted(chs_valid), 3):
-        chdata = norm_data[chname]
-        for curve_ind, curve in enumerate(chdata, 1):
-            _bold_cell(ws, column=1, row=row, value='%s (context=%s), cycle %d' % (chname, ctxts[chname], curve_ind))
-            for col, val in enumerate(curve, 2):
-                ws.cell(column=col, row=row, value=val)
-            row += 1
+    _write_sheet_header(wb, res['c3dfile'], res['ncycles'])
+    wb.append([])
+    _write_cycles(wb, res)
 
-    _auto_adjust(ws)
+wb.save(fname_xls)
 
-wb.save(filename=fname_xls)
+if fname_parquet is not None:
+    with CycleWriter(fname_parquet) as writer:
+        for res in results:
+            writer.write_trial(res)
 
 
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+
+Persistent catalog of trial metadata.
+
+Batch scripts typically find the c3d files of a session or a cohort, and then
+open each file just to find out whether it qualifies (Eclipse tag, trial type,
+channels...). TrialCatalog keeps the header-level metadata of each c3d file and
+its Eclipse .enf file in an SQLite database, so trials can be selected with a
+query instead:
+
+    with TrialCatalog('catalog.db') as catalog:
+        catalog.refresh(root)
+        c3dfiles = catalog.query(root, tags=['E1', 'T1'], trial_type='dynamic')
+
+refresh() only reads the files whose modification time or size changed since
+the last refresh, and removes the trials whose c3d files are gone. The c3d
+metadata is read with ezc3d (see read_c3d_header()). ezc3d has no header-only
+mode, so the files are decoded in full when they are read for the catalog;
+queries do not touch the c3d files at all.
+
+The catalog stores, for each trial: session path and date, frame and analog
+rates, first frame and length, the Eclipse keys, the point and analog channel
+names, and the events.
+
+This module can also be run as a script to refresh a catalog and print a
+query; run with --help for the options.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import os
+import sqlite3
+import argparse
+import datetime
+import logging
+import numpy as np
+from pathlib import Path
+import ezc3d
+
+from gaitutils import eclipse
+
+from trial_files import find_c3ds, find_enf
+
+logger = logging.getLogger(__name__)
+
+# bump this to rebuild existing catalogs, e.g. if the schema changes
+CATALOG_VERSION = 2
+# Eclipse keys searched for tags (as in the gaitutils default config)
+TAG_KEYS = ['DESCRIPTION', 'NOTES']
+# POINT parameters that list the model outputs (as written by Nexus)
+MODEL_OUTPUT_GROUPS = ['ANGLES', 'FORCES', 'MOMENTS', 'POWERS', 'SCALARS']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (
+    c3dfile TEXT PRIMARY KEY,
+    sessionpath TEXT NOT NULL,
+    trialname TEXT NOT NULL,
+    session_date TEXT,
+    c3d_mtime REAL NOT NULL,
+    c3d_size INTEGER NOT NULL,
+    enffile TEXT,
+    enf_mtime REAL,
+    trial_type TEXT,
+    framerate REAL,
+    analograte REAL,
+    first_frame INTEGER,
+    length INTEGER
+);
+CREATE TABLE IF NOT EXISTS eclipse_keys (
+    c3dfile TEXT NOT NULL REFERENCES trials(c3dfile) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS channels (
+    c3dfile TEXT NOT NULL REFERENCES trials(c3dfile) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    c3dfile TEXT NOT NULL REFERENCES trials(c3dfile) ON DELETE CASCADE,
+    context TEXT,
+    label TEXT NOT NULL,
+    frame INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS eclipse_keys_c3dfile ON eclipse_keys(c3dfile);
+CREATE INDEX IF NOT EXISTS channels_c3dfile ON channels(c3dfile);
+CREATE INDEX IF NOT EXISTS channels_name ON channels(name);
+CREATE INDEX IF NOT EXISTS events_c3dfile ON events(c3dfile);
+"""
+
+
+def read_c3d_header(c3dfile):
+    """Read the header-level metadata of a c3d file.
+
+    Returns a dict with the keys framerate, analograte, first_frame (1-based,
+    as in the c3d file), length (in frames), points and analogs (lists of
+    channel names), model_outputs (the points listed as model outputs, e.g.
+    angles), analog_descriptions and events (a list of (context, label, frame)
+    with 0-based frames relative to the start of the trial data, as in
+    gaitutils).
+    """
+    acq = ezc3d.c3d(str(c3dfile))
+    header = acq['header']
+    params = acq['parameters']
+
+    def _param(group, name, default=None):
+        try:
+            return params[group][name]['value']
+        except KeyError:
+            return default
+
+    # ezc3d gives 0-based frame numbers
+    first_frame = header['points']['first_frame'] + 1
+    last_frame = header['points']['last_frame'] + 1
+    # for long trials, the frame numbers do not fit in the header
+    start = _param('TRIAL', 'ACTUAL_START_FIELD')
+    end = _param('TRIAL', 'ACTUAL_END_FIELD')
+    if start is not None and end is not None:
+        start, end = start.astype(np.uint16), end.astype(np.uint16)
+        first_frame = int(start[0]) + 65536 * int(start[1])
+        last_frame = int(end[0]) + 65536 * int(end[1])
+    rate = _param('POINT', 'RATE')
+    framerate = float(rate[0]) if rate is not None else header['points']['frame_rate']
+    rate = _param('ANALOG', 'RATE')
+    analograte = float(rate[0]) if rate is not None else header['analogs']['frame_rate']
+
+    events = list()
+    contexts = _param('EVENT', 'CONTEXTS', [])
+    labels = _param('EVENT', 'LABELS', [])
+    if (used := _param('EVENT', 'USED')) is not None:
+        labels = labels[: int(used[0])]
+    times = _param('EVENT', 'TIMES')
+    for k, label in enumerate(labels):
+        # times are (minutes, seconds); frames as computed by btk, minus offset
+        t = 60 * times[0, k] + times[1, k]
+        frame = int(round(t * framerate)) + 1 - first_frame
+        events.append((contexts[k] if k < len(contexts) else None, label, frame))
+
+    def _labels(group, name):
+        # more than 255 labels continue in LABELS2, LABELS3...
+        labels = list(_param(group, name, []))
+        k = 2
+        while (more := _param(group, f'{name}{k}')) is not None:
+            labels += more
+            k += 1
+        return labels
+
+    return {
+        'framerate': framerate,
+        'analograte': analograte,
+        'first_frame': first_frame,
+        'length': last_frame - first_frame + 1,
+        'points': _labels('POINT', 'LABELS'),
+        'model_outputs': [
+            lbl for group in MODEL_OUTPUT_GROUPS for lbl in _labels('POINT', group)
+        ],
+        'analogs': _labels('ANALOG', 'LABELS'),
+        'analog_descriptions': _labels('ANALOG', 'DESCRIPTIONS'),
+        'events': events,
+    }
+
+
+def _upper(s):
+    return None if s is None else s.upper()
+
+
+def _session_date(sessionpath):
+    """Session date from a session name of the form YYYY_MM_DD_..., or None"""
+    try:
+        return datetime.datetime.strptime(Path(sessionpath).name[:10], '%Y_%m_%d')
+    except ValueError:
+        return None
+
+
+class TrialCatalog:
+    """SQLite catalog of c3d and Eclipse metadata.
+
+    Can be used as a context manager, or call close() when done.
+
+    Parameters
+    ----------
+    dbfile : str | Path
+        The database file. It is created if it does not exist.
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = Path(dbfile)
+        self._conn = sqlite3.connect(self.dbfile)
+        self._conn.execute('PRAGMA foreign_keys = ON;')
+        # SQLite upper() only handles ASCII; use the Python one as in gaitutils
+        self._conn.create_function('py_upper', 1, _upper, deterministic=True)
+        (version,) = self._conn.execute('PRAGMA user_version;').fetchone()
+        if version != CATALOG_VERSION:
+            for table in ['eclipse_keys', 'channels', 'events', 'trials']:
+                self._conn.execute(f'DROP TABLE IF EXISTS {table}')
+            self._conn.execute(f'PRAGMA user_version = {CATALOG_VERSION};')
+        self._conn.executescript(SCHEMA)
+
+    def _insert_trial(self, c3dfile, enffile):
+        """Read the metadata of a trial and insert it"""
+        c3dfile = Path(c3dfile)
+        meta = read_c3d_header(c3dfile)
+        st = c3dfile.stat()
+        if enffile is not None:
+            edata = eclipse.get_eclipse_keys(enffile)
+            enf_mtime = enffile.stat().st_mtime
+        else:
+            edata, enf_mtime = dict(), None
+        session_date = _session_date(c3dfile.parent)
+        self._conn.execute(
+            'INSERT INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                str(c3dfile),
+                str(c3dfile.parent),
+                c3dfile.stem,
+                session_date and session_date.date().isoformat(),
+                st.st_mtime,
+                st.st_size,
+                enffile and str(enffile),
+                enf_mtime,
+                edata.get('TYPE', '').lower() or None,
+                meta['framerate'],
+                meta['analograte'],
+                meta['first_frame'],
+                meta['length'],
+            ),
+        )
+        self._conn.executemany(
+            'INSERT INTO eclipse_keys VALUES (?, ?, ?)',
+            [(str(c3dfile), key, value) for key, value in edata.items()],
+        )
+        descs = meta['analog_descriptions']
+        channels = [(str(c3dfile), 'point', name, None) for name in meta['points']]
+        channels += [
+            (str(c3dfile), 'analog', name, descs[k] if k < len(descs) else None)
+            for k, name in enumerate(meta['analogs'])
+        ]
+        self._conn.executemany('INSERT INTO channels VALUES (?, ?, ?, ?)', channels)
+        self._conn.executemany(
+            'INSERT INTO events VALUES (?, ?, ?, ?)',
+            [(str(c3dfile),) + ev for ev in meta['events']],
+        )
+
+    def refresh(self, root):
+        """Update the catalog for all c3d files under root.
+
+        Only trials whose c3d or .enf file is new or has a different mtime or
+        size are read. Trials under root whose c3d file no longer exists are
+        removed. Returns a tuple of (number of trials read, number of trials
+        removed).
+        """
+        root = Path(root)
+        prefix = str(root) + os.sep
+        recorded = {
+            row[0]: row[1:]
+            for row in self._conn.execute(
+                'SELECT c3dfile, c3d_mtime, c3d_size, enffile, enf_mtime FROM trials'
+                ' WHERE substr(c3dfile, 1, ?) = ?',
+                (len(prefix), prefix),
+            )
+        }
+        c3dfiles = [Path(c3dfile) for c3dfile in find_c3ds(root)]
+        nread = 0
+        with self._conn:
+            for c3dfile in c3dfiles:
+                enffile = find_enf(c3dfile)
+                st = c3dfile.stat()
+                enf_mtime = enffile and enffile.stat().st_mtime
+                sig = (st.st_mtime, st.st_size, enffile and str(enffile), enf_mtime)
+                if recorded.get(str(c3dfile)) == sig:
+                    continue
+                self._conn.execute(
+                    'DELETE FROM trials WHERE c3dfile = ?', (str(c3dfile),)
+                )
+                try:
+                    self._insert_trial(c3dfile, enffile)
+                except (OSError, ValueError, RuntimeError) as e:
+                    logger.warning(f'cannot read metadata from {c3dfile}: {e}')
+                    continue
+                nread += 1
+            removed = set(recorded) - {str(c3dfile) for c3dfile in c3dfiles}
+            self._conn.executemany(
+                'DELETE FROM trials WHERE c3dfile = ?', [(fn,) for fn in removed]
+            )
+        return nread, len(removed)
+
+    def query(
+        self,
+        root=None,
+        tags=None,
+        trial_type=None,
+        date_from=None,
+        date_to=None,
+        channels=None,
+        tag_keys=None,
+    ):
+        """Select trials from the catalog.
+
+        Parameters
+        ----------
+        root : str | Path | None
+            Only return trials under this directory.
+        tags : list | None
+            Only return trials that have any of the tags in the Eclipse keys
+            given by tag_keys.
+        trial_type : str | None
+            Trial type (Eclipse TYPE field), e.g. 'dynamic' or 'static'.
+        date_from, date_to : datetime.date | str | None
+            Session date range (inclusive). Trials whose session date cannot
+            be parsed are excluded if a date range is given.
+        channels : list | None
+            Only return trials that have all of these point or analog
+            channels. The Nexus 'Voltage.' style prefixes are ignored.
+        tag_keys : list | None
+            The Eclipse keys to search for tags. Defaults to TAG_KEYS.
+
+        Returns
+        -------
+        list
+            Sorted list of c3d filenames.
+
+        As in gaitutils.sessionutils.get_c3ds(), tags and trial type match if
+        they are contained in the Eclipse key values (case insensitive).
+        """
+        where, args = list(), list()
+        if root is not None:
+            prefix = str(Path(root)) + os.sep
+            where.append('substr(c3dfile, 1, ?) = ?')
+            args.extend([len(prefix), prefix])
+        if tags:
+            tag_keys = tag_keys or TAG_KEYS
+            where.append(
+                'EXISTS (SELECT 1 FROM eclipse_keys e WHERE e.c3dfile = t.c3dfile'
+                ' AND py_upper(e.key) IN (%s) AND (%s))'
+                % (
+                    ', '.join('?' * len(tag_keys)),
+                    ' OR '.join(['instr(py_upper(e.value), ?) > 0'] * len(tags)),
+                )
+            )
+            args.extend(key.upper() for key in tag_keys)
+            args.extend(tag.upper() for tag in tags)
+        if trial_type is not None:
+            where.append('instr(py_upper(trial_type), ?) > 0')
+            args.append(trial_type.upper())
+        for op, date in [('>=', date_from), ('<=', date_to)]:
+            if date is not None:
+                where.append(f'session_date {op} ?')
+                args.append(str(date))
+        for ch in channels or []:
+            where.append(
+                'EXISTS (SELECT 1 FROM channels c WHERE c.c3dfile = t.c3dfile'
+                " AND (c.name = ? OR c.name LIKE ?))"
+            )
+            args.extend([ch, '%.' + ch])
+        sql = 'SELECT c3dfile FROM trials t'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return [row[0] for row in self._conn.execute(sql + ' ORDER BY c3dfile', args)]
+
+    def get_metadata(self, c3dfile):
+        """Return the catalog metadata of a trial as a dict, or None"""
+        self._conn.row_factory = sqlite3.Row
+        try:
+            row = self._conn.execute(
+                'SELECT * FROM trials WHERE c3dfile = ?', (str(c3dfile),)
+            ).fetchone()
+            if row is None:
+                return None
+            meta = dict(row)
+            key = (str(c3dfile),)
+            meta['eclipse_data'] = {
+                r['key']: r['value']
+                for r in self._conn.execute(
+                    'SELECT key, value FROM eclipse_keys WHERE c3dfile = ?', key
+                )
+            }
+            meta['channels'] = [
+                dict(r)
+                for r in self._conn.execute(
+                    'SELECT kind, name, description FROM channels WHERE c3dfile = ?',
+                    key,
+                )
+            ]
+            meta['events'] = [
+                tuple(r)
+                for r in self._conn.execute(
+                    'SELECT context, label, frame FROM events WHERE c3dfile = ?'
+                    ' ORDER BY frame',
+                    key,
+                )
+            ]
+            return meta
+        finally:
+            self._conn.row_factory = None
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh and query a trial catalog')
+    parser.add_argument('dbfile', help='the catalog database')
+    parser.add_argument('root', help='root directory of the trials')
+    parser.add_argument('--tags', nargs='+', help='Eclipse tags to select')
+    parser.add_argument('--type', help='trial type, e.g. dynamic or static')
+    parser.add_argument('--date-from', help='first session date (YYYY-MM-DD)')
+    parser.add_argument('--date-to', help='last session date (YYYY-MM-DD)')
+    parser.add_argument('--channels', nargs='+', help='required channels')
+    args = parser.parse_args()
+    with TrialCatalog(args.dbfile) as catalog:
+        nread, nremoved = catalog.refresh(args.root)
+        logging.basicConfig(level=logging.INFO)
+        logger.info(f'read {nread} trials, removed {nremoved}')
+        for c3dfile in catalog.query(
+            args.root,
+            tags=args.tags,
+            trial_type=args.type,
+            date_from=args.date_from,
+            date_to=args.date_to,
+            channels=args.channels,
+        ):
+            print(c3dfile)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+
+Lightweight forceplate contact view of a c3d trial.
+
+Creating a gaitutils Trial decodes the whole c3d file and runs the forceplate
+detection, and it also scans the gait cycles. Scripts that only need the
+forceplate contacts (e.g. to rank trials for tagging) can use TrialEvents
+instead. The contacts are computed lazily, on first access, starting from the
+forceplate data only:
+
+-a plate has a contact if its force passes the threshold checks of the
+ forceplate detection; if no plate has one, the trial has no contacts and
+ nothing else is read
+-if the Eclipse forceplate keys of the trial are used and set (Left, Right or
+ Invalid for each plate with a contact, as written by autoprocessing), the
+ contexts of the contacts are taken from them
+-otherwise, the contacts are detected from the forceplate and foot marker
+ data, as for Trial
+
+Use get_trial_events() to get the views; they are cached per file, so e.g.
+ranking the same trials again does not read anything. A cached view is
+discarded if the modification time or size of the c3d file changes.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import os
+import logging
+import functools
+import numpy as np
+from scipy import signal
+
+from gaitutils import cfg, eclipse, read_data, sessionutils, utils
+from gaitutils.envutils import GaitDataError
+from gaitutils.events import GaitEvents
+from gaitutils.numutils import _baseline, falling_zerocross, rising_zerocross
+
+from trial_files import find_enf
+
+logger = logging.getLogger(__name__)
+
+# Eclipse forceplate values -> contexts (None for no valid contact)
+ECLIPSE_FP_CONTEXTS = {'Right': 'R', 'Left': 'L', 'Invalid': None}
+
+# cached views, keyed by c3d file; values are ((mtime, size), view)
+_cache = dict()
+
+
+def _force_contact(fpdata, bodymass=None):
+    """Check the force of a plate for a contact.
+
+    As in gaitutils.utils.detect_forceplate_events(), the force is thresholded
+    relative to the body mass (or to the peak force, if the body mass is not
+    known), and there is a contact if the force rises above and falls below
+    the threshold around its peak.
+    """
+    forcetot = _baseline(signal.medfilt(fpdata['Ftot'], kernel_size=3))
+    fmaxind = np.argmax(forcetot)
+    if bodymass is None:
+        f_threshold = cfg.autoproc.forceplate_contact_threshold * forcetot[fmaxind]
+    else:
+        f_threshold = cfg.autoproc.forceplate_contact_threshold * bodymass * 9.81
+    rising = rising_zerocross(forcetot - f_threshold)
+    falling = falling_zerocross(forcetot - f_threshold)
+    return bool(np.any(rising < fmaxind) and np.any(falling > fmaxind))
+
+
+class TrialEvents:
+    """Forceplate contacts of a c3d trial.
+
+    The attributes are computed on first access.
+
+    Parameters
+    ----------
+    c3dfile : str | Path
+        The c3d file.
+    eclipse_fp_info : dict | None
+        The Eclipse forceplate keys of the trial (e.g. {'FP1': 'Left'}). If
+        None, they are read from the .enf file, if there is one.
+    """
+
+    def __init__(self, c3dfile, eclipse_fp_info=None):
+        self.c3dfile = c3dfile
+        self._eclipse_fp_info = eclipse_fp_info
+
+    @functools.cached_property
+    def eclipse_fp_info(self):
+        """The Eclipse forceplate keys, or None if they should not be used"""
+        if not cfg.trial.use_eclipse_fp_info:
+            return None
+        quirks = sessionutils.load_quirks(os.path.dirname(self.c3dfile))
+        if 'ignore_eclipse_fp_info' in quirks:
+            return None
+        if self._eclipse_fp_info is not None:
+            return self._eclipse_fp_info
+        if (enffile := find_enf(self.c3dfile)) is None:
+            return None
+        return eclipse._eclipse_forceplate_keys(eclipse.get_eclipse_keys(enffile))
+
+    @functools.cached_property
+    def fp_events(self):
+        """The forceplate events, detected as for Trial"""
+        try:
+            return utils.detect_forceplate_events(
+                self.c3dfile, eclipse_fp_info=self.eclipse_fp_info
+            )
+        except GaitDataError:
+            logger.warning(f'Could not detect forceplate events for {self.c3dfile}')
+            return GaitEvents()
+
+    @functools.cached_property
+    def fp_force_ok(self):
+        """Whether each forceplate has a contact by force, keyed by Eclipse key.
+
+        Only the forceplate data (and the subject body mass) is read.
+        """
+        try:
+            fpdata = read_data.get_forceplate_data(self.c3dfile)
+            meta = read_data.get_metadata(self.c3dfile)
+        except GaitDataError:
+            logger.warning(f'Could not read forceplate data for {self.c3dfile}')
+            return dict()
+        bodymass = meta['subj_params']['Bodymass']
+        return {fp['eclipse_key']: _force_contact(fp, bodymass) for fp in fpdata}
+
+    @functools.cached_property
+    def fp_contacts(self):
+        """Number of valid forceplate contacts for each context, as a dict"""
+        contact_plates = [plate for plate, ok in self.fp_force_ok.items() if ok]
+        fp_info = self.eclipse_fp_info or dict()
+        # the Eclipse keys of the plates without contacts do not matter
+        if all(fp_info.get(plate) in ECLIPSE_FP_CONTEXTS for plate in contact_plates):
+            contexts = [ECLIPSE_FP_CONTEXTS[fp_info[plate]] for plate in contact_plates]
+        else:
+            strikes = self.fp_events.get_events(event_type='strike')
+            contexts = [ev.context for ev in strikes]
+        return {context: contexts.count(context) for context in 'LR'}
+
+
+def get_trial_events(c3dfile, eclipse_fp_info=None):
+    """Return the (cached) TrialEvents view of a c3d file.
+
+    eclipse_fp_info is used only if the view is not in the cache.
+    """
+    st = os.stat(c3dfile)
+    sig = (st.st_mtime, st.st_size)
+    key = os.path.abspath(c3dfile)
+    if key in _cache and _cache[key][0] == sig:
+        return _cache[key][1]
+    view = TrialEvents(c3dfile, eclipse_fp_info)
+    _cache[key] = (sig, view)
+    return view
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+
+Helpers for finding and hashing the files of trials.
+
+These are shared by the batch scripts and modules (EMG processing, trial
+catalog, MATLAB export, file copying).
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import os
+import os.path as op
+import re
+import hashlib
+from pathlib import Path
+
+
+def find_c3ds(session_root):
+    """Recursively find all c3d files under session_root, in sorted order"""
+    allfiles = list()
+    for d0, dirs, files in os.walk(session_root):
+        allfiles.extend(op.join(d0, fn) for fn in files if '.c3d' in fn.lower())
+    return sorted(allfiles)
+
+
+def find_enf(c3dfile):
+    """Return the Eclipse .enf file of a trial, or None (as gaitutils Trial)"""
+    c3dfile = Path(c3dfile)
+    trialname = c3dfile.stem
+    enfpath = c3dfile.parent / Path(trialname).with_suffix('.Trial.enf')
+    if not enfpath.is_file():
+        trialn = re.search(r'\.*(\d*)$', trialname).group(1)
+        if trialn:
+            enfpath = c3dfile.parent / f'{trialname}.Trial{trialn}.enf'
+    return enfpath if enfpath.is_file() else None
+
+
+def file_hash(fname, chunksize=1024**2):
+    """Compute SHA1 hash of file content"""
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+
+Pipelined trial prefetching for batch loops.
+
+Batch loops over the trials of a session are serial: open a trial, read it,
+compute, write, and only then move on to the next one. prefetch() runs a load
+function for the upcoming trials on a background thread while the current
+trial is being processed, so that the decoding or I/O latency is hidden. The
+number of trials loaded ahead is bounded by the prefetch depth, which also
+bounds the memory use.
+
+Two load functions are provided:
+
+load_trial_c3d : decode a c3d file (metadata, EMG, events and gait cycles),
+    for loops that compute from the c3d data
+warm_trial_files : read the files of a trial without decoding them, so that
+    they are in the OS file cache when Nexus opens the trial
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from gaitutils import read_data, trial
+
+from emg_c3d import strip_voltage_prefix
+
+logger = logging.getLogger(__name__)
+
+# default number of trials to load ahead
+PREFETCH_DEPTH = 2
+
+
+def prefetch(items, load, depth=PREFETCH_DEPTH):
+    """Iterate over items, loading them ahead on a background thread.
+
+    Yields (item, load(item)) tuples in the order of items. While the caller
+    processes an item, up to depth next items are loaded. If load raises an
+    exception, it is raised here when the corresponding item is reached; wrap
+    load to handle errors for single items instead.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(load, item)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            item, future = pending.popleft()
+            # keep the queue full while the caller works on this item
+            for next_item in items:
+                pending.append((next_item, executor.submit(load, next_item)))
+                break
+            yield item, future.result()
+
+
+def load_trial_c3d(c3dfile):
+    """Decode the data of a c3d file needed for EMG processing.
+
+    Returns a dict with the keys c3dfile, meta (see read_data.get_metadata),
+    emg (dict of EMG data for each channel; the Voltage. prefix is stripped to
+    match Nexus channel names) and trial (a gaitutils Trial instance, which
+    has the events and gait cycles).
+    """
+    return {
+        'c3dfile': c3dfile,
+        'meta': read_data.get_metadata(c3dfile),
+        'emg': strip_voltage_prefix(read_data.get_emg_data(c3dfile)['data']),
+        'trial': trial.Trial(c3dfile),
+    }
+
+
+def warm_trial_files(trialfile, chunksize=1024**2):
+    """Read all files belonging to a trial, to get them into the OS file cache.
+
+    trialfile is any file of the trial (e.g. the c3d file); all files in the
+    same directory that share its base name are read. Returns the number of
+    bytes read.
+    """
+    trialfile = Path(trialfile)
+    nbytes = 0
+    prefix = trialfile.stem + '.'
+    for fn in trialfile.parent.iterdir():
+        if not fn.name.startswith(prefix) or not fn.is_file():
+            continue
+        try:
+            with open(fn, 'rb') as f:
+                while chunk := f.read(chunksize):
+                    nbytes += len(chunk)
+        except OSError:
+            logger.warning(f'cannot read {fn}')
+    return nbytes
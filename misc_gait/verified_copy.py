@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+
+Parallel, verified copy of a directory tree, e.g. a session to the network
+drive.
+
+shutil.copytree copies one file at a time and does not check the result, so
+there is no guarantee that the copy is intact. copy_tree() here copies the
+files in a thread pool (the copy is I/O bound, so the threads run in
+parallel). Each file is hashed (SHA1) while it is being copied, copied into a
+temporary file, and read back from the destination in a separate pass to
+check its hash. Only then is the temporary file renamed, so a destination
+file with the final name is always complete.
+
+The read-back bypasses the OS file cache, so that the data is really read
+from the destination: on Windows, the file is opened for unbuffered reads
+(FILE_FLAG_NO_BUFFERING, via pywin32), which also bypasses the SMB client
+cache of network drives; elsewhere, it is evicted from the cache with
+os.posix_fadvise before reading. On other platforms, the read-back may be
+served from memory, and a warning is logged.
+
+The hashes are recorded in a manifest (see export_manifest), which is saved
+regularly during the copy. An interrupted copy can be resumed by running
+copy_tree() again: files whose destination already has the same size and hash
+are not copied again.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import os
+import sys
+import mmap
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from trial_files import file_hash
+from export_manifest import ExportManifest
+
+logger = logging.getLogger(__name__)
+
+# number of files copied in parallel
+MAX_WORKERS = 8
+# read/write block size
+CHUNKSIZE = 1024**2
+# save the manifest after this many files
+SAVE_INTERVAL = 50
+# suffix for files that are being copied
+TMP_SUFFIX = '.copying'
+
+
+def _file_hash_unbuffered_win32(fname, chunksize=CHUNKSIZE):
+    """Compute SHA1 hash of file content, bypassing the Windows file cache"""
+    import win32file
+
+    size = os.path.getsize(fname)
+    handle = win32file.CreateFile(
+        str(fname),
+        win32file.GENERIC_READ,
+        win32file.FILE_SHARE_READ,
+        None,
+        win32file.OPEN_EXISTING,
+        win32file.FILE_FLAG_NO_BUFFERING,
+        None,
+    )
+    # unbuffered reads need a sector aligned buffer and size; an anonymous
+    # mmap is page aligned, and chunksize is a multiple of the sector size
+    buf = mmap.mmap(-1, chunksize)
+    h = hashlib.sha1()
+    try:
+        while size > 0:
+            _, data = win32file.ReadFile(handle, buf)
+            if not data:
+                raise IOError(f'unexpected end of file in {fname}')
+            data = bytes(data[:size])
+            h.update(data)
+            size -= len(data)
+    finally:
+        handle.Close()
+        buf.close()
+    return h.hexdigest()
+
+
+def _file_hash_uncached(fname, chunksize=CHUNKSIZE):
+    """Compute SHA1 hash of a (closed and synced) file, read from its disk"""
+    if sys.platform == 'win32':
+        return _file_hash_unbuffered_win32(fname, chunksize)
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(fname, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    else:
+        logger.warning(f'cannot bypass the file cache, verifying {fname} from it')
+    return file_hash(fname, chunksize)
+
+
+def _copy_file(src, dest, chunksize=CHUNKSIZE):
+    """Copy a file, hashing the data on the way. Returns the SHA1 hash.
+
+    The data is written into a temporary file, which is renamed to dest only
+    after it has been closed, read back and verified.
+    """
+    tmpname = dest.with_name(dest.name + TMP_SUFFIX)
+    h = hashlib.sha1()
+    with open(src, 'rb') as fsrc, open(tmpname, 'wb') as fdest:
+        for chunk in iter(lambda: fsrc.read(chunksize), b''):
+            h.update(chunk)
+            fdest.write(chunk)
+        fdest.flush()
+        os.fsync(fdest.fileno())
+    sha1 = h.hexdigest()
+    # verify in a separate pass, from the destination instead of the cache
+    if _file_hash_uncached(tmpname, chunksize) != sha1:
+        tmpname.unlink()
+        raise IOError(f'verification failed for {dest}')
+    shutil.copystat(src, tmpname)
+    os.replace(tmpname, dest)
+    return sha1
+
+
+def _sync_file(src, dest):
+    """Copy a file, unless dest already has the same content.
+
+    Returns (copied, size, sha1).
+    """
+    size = os.path.getsize(src)
+    if dest.is_file() and dest.stat().st_size == size:
+        sha1 = file_hash(src)
+        if _file_hash_uncached(dest) == sha1:
+            return False, size, sha1
+    return True, size, _copy_file(src, dest)
+
+
+def default_manifest(src):
+    """Default manifest filename for a source dir (next to the dir)"""
+    src = Path(src)
+    return src.with_name(src.name + '.copy_manifest.json')
+
+
+def copy_tree(src, dest, manifest_fname=None, max_workers=MAX_WORKERS):
+    """Copy a directory tree, verifying each file.
+
+    The manifest is written into manifest_fname (by default, see
+    default_manifest()); its trials dict has the size and hash of each file,
+    keyed by the path relative to src. Raises IOError if any files could not
+    be copied; the other files are copied anyway. Returns a tuple of (number
+    of copied files, number of files that were already up to date).
+    """
+    src, dest = Path(src), Path(dest)
+    if manifest_fname is None:
+        manifest_fname = default_manifest(src)
+    manifest = ExportManifest(manifest_fname, {'src': str(src), 'dest': str(dest)})
+
+    relpaths = list()
+    for dirpath, _, filenames in os.walk(src):
+        reldir = Path(dirpath).relative_to(src)
+        (dest / reldir).mkdir(parents=True, exist_ok=True)
+        relpaths.extend(reldir / fname for fname in filenames)
+    # forget files that no longer exist in src
+    keys = {relpath.as_posix() for relpath in relpaths}
+    manifest.trials = {k: v for k, v in manifest.trials.items() if k in keys}
+
+    n_copied = n_skipped = 0
+    failed = list()
+    try:
+        with ThreadPoolExecutor(max_workers) as executor:
+            futures = {
+                executor.submit(_sync_file, src / relpath, dest / relpath): relpath
+                for relpath in relpaths
+            }
+            try:
+                for k, future in enumerate(as_completed(futures), 1):
+                    relpath = futures[future]
+                    try:
+                        copied, size, sha1 = future.result()
+                    except OSError as e:
+                        logger.warning(f'cannot copy {relpath}: {e}')
+                        failed.append(relpath)
+                        manifest.trials.pop(relpath.as_posix(), None)
+                        continue
+                    manifest.trials[relpath.as_posix()] = {'size': size, 'sha1': sha1}
+                    if copied:
+                        n_copied += 1
+                    else:
+                        n_skipped += 1
+                    if k % SAVE_INTERVAL == 0:
+                        manifest.save()
+            except BaseException:
+                # do not start the queued copies; the running ones finish
+                executor.shutdown(cancel_futures=True)
+                raise
+    finally:
+        manifest.save()
+    logger.info(
+        f'{src} -> {dest}: {n_copied} files copied, {n_skipped} already up to date'
+    )
+    if failed:
+        raise IOError(f'could not copy {len(failed)} files from {src}: {failed}')
+    return n_copied, n_skipped
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+
+Bounded concurrent video conversion.
+
+gaitutils.videos.convert_videos() starts a converter process for every file
+at once, and the caller then has to poll the processes until they are done.
+For a patient with several sessions, that means dozens of simultaneous
+converters, which slows down the whole workstation. convert_videos() here
+runs at most max_concurrent converters at a time from a single queue, which
+can hold the videos of all sessions. Each converter is waited for by a worker
+thread, so the progress is updated as soon as a conversion finishes instead
+of by polling. The progress is printed with the throughput and the estimated
+time remaining.
+
+The converter command, its options and the target format are the same as in
+gaitutils.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+import os
+import sys
+import time
+import logging
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from gaitutils import cfg
+
+logger = logging.getLogger(__name__)
+
+# max number of simultaneous converter processes; None for one per CPU core
+MAX_CONCURRENT = None
+# extension for converted files (as in gaitutils)
+TARGET_SUFFIX = '.ogv'
+# Windows process creation flag to prevent opening of consoles
+CREATE_NO_WINDOW = 0x08000000
+# Windows error mode flag to disable protection fault dialogs
+SEM_NOGPFAULTERRORBOX = 0x0002
+
+
+def target_file(vidfile):
+    """Return the converted file for a video file"""
+    return Path(vidfile).with_suffix(TARGET_SUFFIX)
+
+
+def _converter_cmd():
+    """Return the configured converter command (without the video file)"""
+    vidconv_bin = Path(cfg.general.videoconv_path)
+    if not (vidconv_bin.is_file() and os.access(vidconv_bin, os.X_OK)):
+        raise RuntimeError(f'Invalid configured video converter: {vidconv_bin}')
+    return [str(vidconv_bin)] + cfg.general.videoconv_opts.split()
+
+
+def _convert(cmd, vidfile):
+    """Run the converter for a file and wait for it to finish"""
+    flags = CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+    return subprocess.run(cmd + [str(vidfile)], stdout=None, creationflags=flags)
+
+
+def _format_time(secs):
+    mins, secs = divmod(int(round(secs)), 60)
+    return f'{mins}:{secs:02d}'
+
+
+def convert_videos(vidfiles, max_concurrent=MAX_CONCURRENT, force=False):
+    """Convert video files, running at most max_concurrent converters at once.
+
+    Files that have already been converted are skipped, unless force is True;
+    then the existing converted files are deleted first, so that failed
+    conversions can be detected. Blocks until all conversions are done. If
+    interrupted (e.g. by Ctrl-C), the queued conversions are cancelled.
+    Returns the list of files that could not be converted (the converted file
+    does not exist afterwards).
+    """
+    vidfiles = [Path(vidfile) for vidfile in vidfiles]
+    if not force:
+        vidfiles = [vf for vf in vidfiles if not target_file(vf).is_file()]
+    if not vidfiles:
+        return list()
+    cmd = _converter_cmd()
+    if sys.platform == 'win32':
+        import ctypes
+
+        # the converter may crash after the conversion is complete; this
+        # disables the Windows protection fault dialogs
+        ctypes.windll.kernel32.SetErrorMode(SEM_NOGPFAULTERRORBOX)
+    if max_concurrent is None:
+        max_concurrent = os.cpu_count() or 1
+
+    if force:
+        for vidfile in vidfiles:
+            target_file(vidfile).unlink(missing_ok=True)
+
+    n_files = len(vidfiles)
+    print(f'Converting {n_files} videos, {min(max_concurrent, n_files)} at a time')
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_concurrent) as executor:
+        futures = [executor.submit(_convert, cmd, vidfile) for vidfile in vidfiles]
+        try:
+            for n_done, future in enumerate(as_completed(futures), 1):
+                # the return codes are not checked, since the converter may
+                # crash after a successful conversion
+                future.result()
+                elapsed = time.perf_counter() - t0
+                rate = n_done / elapsed
+                eta = (n_files - n_done) / rate
+                print(
+                    f'Converting videos: {n_done} of {n_files} files done, '
+                    f'{60 * rate:.1f} files/min, ETA {_format_time(eta)}'
+                )
+        except BaseException:
+            # do not start the queued conversions; the running ones finish
+            executor.shutdown(cancel_futures=True)
+            raise
+    failed = [vidfile for vidfile in vidfiles if not target_file(vidfile).is_file()]
+    for vidfile in failed:
+        logger.warning(f'conversion failed for {vidfile}')
+    return failed